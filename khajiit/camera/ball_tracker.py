@@ -0,0 +1,126 @@
+from typing import List, Optional, Tuple
+
+# Rectangle in ball mask coordinates: panorama x (mask row), YUYV y (mask column), width, height
+Rect = Tuple[int, int, int, int]
+
+
+class Track:
+    def __init__(self, x, y, w, h):
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.vx = 0.0
+        self.vy = 0.0
+
+    @property
+    def center(self):
+        return self.x + self.w / 2.0, self.y + self.h / 2.0
+
+    def predict(self):
+        """
+        Constant velocity prediction of the rectangle in the next frame
+        """
+        return self.x + self.vx, self.y + self.vy, self.w, self.h
+
+    def update(self, x, y, w, h, smoothing=0.5):
+        cx, cy = self.center
+        nx, ny = x + w / 2.0, y + h / 2.0
+        self.vx = smoothing * (nx - cx) + (1 - smoothing) * self.vx
+        self.vy = smoothing * (ny - cy) + (1 - smoothing) * self.vy
+        self.x, self.y, self.w, self.h = x, y, w, h
+
+
+class BallTracker:
+    """
+    Predict where balls are going to be on the panorama so that ball detection can be
+    limited to small windows around the predictions.
+
+    Full panorama scan is requested every full_scan_interval frames and whenever
+    the tracker loses confidence: a predicted ball was not found, a ball touched
+    the border of its window or there is nothing to track.
+    """
+
+    def __init__(self, full_scan_interval=10, margin=24, match_distance=40, height=4320, width=300):
+        self.full_scan_interval = full_scan_interval
+        self.margin = margin
+        self.match_distance = match_distance
+        self.height = height
+        self.width = width
+        self.tracks: List[Track] = []
+        self.frame_count = 0
+        self.confident = False
+        self.full_scans = 0
+
+    def windows(self) -> Optional[List[Rect]]:
+        """
+        Return search windows for the next frame as (x, y, w, h) or None when full scan is needed
+        """
+        self.frame_count += 1
+        if not self.confident or not self.tracks or self.frame_count % self.full_scan_interval == 0:
+            self.full_scans += 1
+            return None
+
+        windows = []
+        for track in self.tracks:
+            x, y, w, h = track.predict()
+            margin_x = self.margin + abs(track.vx)
+            margin_y = self.margin + abs(track.vy)
+            x0, y0 = max(int(x - margin_x), 0), max(int(y - margin_y), 0)
+            x1, y1 = min(int(x + w + margin_x) + 1, self.height), min(int(y + h + margin_y) + 1, self.width)
+            if x1 > x0 and y1 > y0:
+                windows.append((x0, y0, x1 - x0, y1 - y0))
+        return self.merge(windows)
+
+    @staticmethod
+    def merge(windows: List[Rect]) -> List[Rect]:
+        """
+        Merge overlapping windows so that no ball gets detected twice
+        """
+        merged = []
+        for x, y, w, h in sorted(windows):
+            for index, (mx, my, mw, mh) in enumerate(merged):
+                if x < mx + mw and mx < x + w and y < my + mh and my < y + h:
+                    x0, y0 = min(x, mx), min(y, my)
+                    merged[index] = x0, y0, max(x + w, mx + mw) - x0, max(y + h, my + mh) - y0
+                    break
+            else:
+                merged.append((x, y, w, h))
+        if len(merged) != len(windows):
+            return BallTracker.merge(merged)
+        return merged
+
+    def update(self, rects: List[Rect], windows: Optional[List[Rect]] = None):
+        """
+        Associate detected ball rectangles with tracks, windows are the ones returned by .windows()
+        """
+        unmatched = list(self.tracks)
+        tracks = []
+        confident = True
+
+        for x, y, w, h in rects:
+            nx, ny = x + w / 2.0, y + h / 2.0
+            best, best_dist = None, self.match_distance
+            for track in unmatched:
+                px, py, pw, ph = track.predict()
+                dist = abs(px + pw / 2.0 - nx) + abs(py + ph / 2.0 - ny)
+                if dist < best_dist:
+                    best, best_dist = track, dist
+            if best is not None:
+                unmatched.remove(best)
+                best.update(x, y, w, h)
+            else:
+                best = Track(x, y, w, h)
+            tracks.append(best)
+
+            # Ball cut by the window border might be bigger than it looks
+            for wx, wy, ww, wh in windows or ():
+                if wx <= x < wx + ww and wy <= y < wy + wh and (
+                        (x == wx and wx > 0) or (y == wy and wy > 0) or
+                        (x + w == wx + ww and wx + ww < self.height) or
+                        (y + h == wy + wh and wy + wh < self.width)):
+                    confident = False
+
+        if windows is not None and unmatched:
+            # Predicted ball vanished, moved too fast or was hidden
+            confident = False
+
+        self.tracks = tracks
+        self.confident = confident
@@ -0,0 +1,294 @@
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+
+from .ball_tracker import BallTracker
+from .color_lut import unpack
+from .geometry import CaptureMode
+from .image_recognition import ImageRecognition
+
+logger = logging.getLogger("benchmark")
+
+STAGES = ("classify", "field", "goals", "balls", "closest edge", "serialize", "total")
+PERCENTILES = (50, 90, 99)
+BUDGET = 0.016  # Time available for a frame at 60 fps (s)
+
+
+def load_frames(path, camera_config=None):
+    """
+    Load recorded YUYV panoramas from a directory, either NumPy .npy files or raw frame dumps
+    in the capture mode of the camera settings
+    """
+    shape = CaptureMode.from_config(camera_config).panorama_shape
+    frames = []
+    for filename in sorted(os.listdir(path)):
+        filename = os.path.join(path, filename)
+        if filename.endswith(".npy"):
+            frame = np.load(filename)
+        else:
+            frame = np.fromfile(filename, dtype=np.uint8)
+            if frame.size != np.prod(shape):
+                logger.warning("Skipping %s, not a raw YUYV panorama", filename)
+                continue
+        frames.append(frame.reshape(shape))
+    return frames
+
+
+def synthetic_frames(color_config, count=30, seed=0, camera_config=None):
+    """
+    Generate YUYV panoramas with field, goals and balls in the middle of their configured color ranges,
+    scenes are drawn at 640x480 and scaled and cropped to the capture mode of the camera settings
+    """
+    def color(name):
+        lower, upper = unpack(color_config[name])
+        return [(low + high) // 2 for low, high in zip(lower, upper)]
+
+    mode = CaptureMode.from_config(camera_config)
+    full = CaptureMode(cameras=mode.cameras)
+    width = full.panorama_width
+    # Lines and YUYV columns of the 640x480 scene sampled by the capture mode
+    lines = (np.arange(mode.panorama_shape[0]) / mode.factor).astype(int)
+    kept = ((np.arange(mode.columns) + mode.crop[0]) / mode.factor).astype(int)
+
+    rng = np.random.RandomState(seed)
+    rows = np.arange(width)
+    columns = np.arange(full.columns)
+    balls = list(zip(rng.randint(0, width - 40, 8), rng.randint(150, 280, 8)))
+    frames = []
+    for index in range(count):
+        shift = index * 37
+        frame = np.empty(full.panorama_shape, dtype=np.uint8)
+        frame[:] = (200, 128, 200, 128)  # walls
+
+        # Field edge bends between the cameras
+        edge = (90 + 40 * np.abs(np.sin((rows + shift) / 480.0 * np.pi))).astype(int)
+        frame[:3840][columns >= edge[:, None]] = color("field")
+
+        for start, name in ((600 + shift, "goal A"), (2600 + shift, "goal B")):
+            goal = np.arange(start, start + 300) % width
+            for row in goal:
+                frame[row, max(edge[row] - 60, 0):edge[row] + 5] = color(name)
+
+        # Balls roll steadily between the frames for the ball tracker to follow
+        for row, column in balls:
+            row = (row + index * 6) % (width - 40)
+            frame[row:row + 12, column:column + 6] = color("ball")
+
+        frame += rng.randint(0, 3, frame.shape).astype(np.uint8)  # sensor noise
+        frame[width:] = frame[:full.lines]
+        if mode != full:
+            frame = np.ascontiguousarray(frame[lines][:, kept])
+        frames.append(frame)
+    return frames
+
+
+def production_recognition(camera_config=None, color_config=None, executor=None):
+    """
+    Return recognition set up like ImageRecognizer does, with the ball tracker and ball limit of the settings
+    """
+    global_config = (camera_config or {}).get('global', {})
+    mode = CaptureMode.from_config(camera_config)
+    ball_tracker = None
+    if global_config.get('ball full scan interval'):
+        ball_tracker = BallTracker(global_config['ball full scan interval'])
+        ball_tracker.height = mode.panorama_shape[0]
+        ball_tracker.width = mode.column(ImageRecognition.BALLS_BOTTOM)
+    return ImageRecognition(camera_config=camera_config, color_config=color_config, executor=executor,
+                            ball_tracker=ball_tracker, ball_limit=global_config.get('ball limit'), mode=mode)
+
+
+def percentiles(values):
+    """
+    Return percentiles and maximum of timings in milliseconds
+    """
+    values = np.array(values) * 1000
+    result = dict(("p%d" % p, float(np.percentile(values, p))) for p in PERCENTILES)
+    result["max"] = float(values.max())
+    return result
+
+
+def profile_stages(frames, camera_config=None, color_config=None, threads=1, repeats=3):
+    """
+    Return percentiles of per stage timings of a single persistent recognition
+    """
+    executor = ThreadPoolExecutor(threads) if threads > 1 else None
+    recognition = production_recognition(camera_config, color_config, executor)
+    recognition.process(frames[0])  # Allocate buffers
+
+    timings = dict((stage, []) for stage in STAGES)
+    for _ in range(repeats):
+        for frame in frames:
+            start = time()
+            recognition.process(frame)
+            then = time()
+            recognition.serialize()
+            now = time()
+            for stage, elapsed in recognition.stage_timings.items():
+                timings[stage].append(elapsed)
+            timings["serialize"].append(now - then)
+            timings["total"].append(now - start)
+
+    if executor:
+        executor.shutdown()
+    return dict((stage, percentiles(values)) for stage, values in timings.items() if values)
+
+
+def check_crops(frames, camera_config=None, color_config=None, crops=((0, 320), (40, 320))):
+    """
+    Return indices of uncropped 640x480 frames whose field edge results differ between
+    the crops, which are given in 640x480 YUYV columns
+    """
+    results = []
+    for crop in crops:
+        config = dict(camera_config or {}, **{"capture mode": dict(resolution=(640, 480), crop=crop)})
+        mode = CaptureMode.from_config(config)
+        recognition = ImageRecognition(camera_config=config, color_config=color_config)
+        results.append([])
+        for frame in frames:
+            r = recognition.process(np.ascontiguousarray(frame[:, mode.crop[0]:mode.crop[1]]))
+            results[-1].append((r.closest_edge.serialize(), r.goal_angle_adjust, r.h_bigger, r.h_smaller))
+    return [index for index, outcomes in enumerate(zip(*results)) if any(o != outcomes[0] for o in outcomes)]
+
+
+def _throughput_worker(frames, camera_config, color_config, count, barrier, results):
+    recognition = production_recognition(camera_config, color_config)
+    recognition.process(frames[0])
+    barrier.wait()
+    for index in range(count):
+        recognition.process(frames[index % len(frames)]).serialize()
+    results.put(count)
+
+
+def measure_throughput(frames, camera_config=None, color_config=None, workers=1, count=60):
+    """
+    Return frames per second recognized by worker processes each handling count frames
+    """
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(workers + 1)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_throughput_worker,
+                        args=(frames[index::workers] or frames, camera_config, color_config, count, barrier, results))
+        for index in range(workers)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time()
+    total = sum(results.get() for _ in processes)
+    elapsed = time() - start
+    for process in processes:
+        process.join()
+    return total / elapsed
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Return list of regressions of results against the baseline, slower stage timings
+    and lower throughput beyond the relative tolerance count
+    """
+    regressions = []
+    for stage, current in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        for key in ("p50", "p90"):
+            if current[key] > previous[key] * (1 + tolerance):
+                regressions.append("%s %s %.2fms -> %.2fms" % (stage, key, previous[key], current[key]))
+    for workers, fps in results["throughput"].items():
+        previous = baseline.get("throughput", {}).get(workers)
+        if previous and fps < previous * (1 - tolerance):
+            regressions.append("throughput at %s workers %.1ffps -> %.1ffps" % (workers, previous, fps))
+    return regressions
+
+
+if __name__ == "__main__":
+    """
+    Benchmark image recognition without GUI or ROS, usage:
+    python3 -m camera.benchmark --frames ~/panoramas --save baseline.json
+    python3 -m camera.benchmark --frames ~/panoramas --compare baseline.json
+    """
+    import sys
+    from argparse import ArgumentParser
+
+    import yaml
+
+    parser = ArgumentParser()
+    parser.add_argument("--frames", help="directory of recorded YUYV panoramas, synthetic frames if omitted")
+    parser.add_argument("--workers", default="1,2,4,8", help="worker process counts for throughput")
+    parser.add_argument("--threads", type=int, default=1, help="recognition threads for stage timings")
+    parser.add_argument("--repeats", type=int, default=3, help="passes over the frames for stage timings")
+    parser.add_argument("--save", help="save results as baseline JSON")
+    parser.add_argument("--compare", help="compare results to baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown tolerated")
+    parser.add_argument("--check-crops", action="store_true",
+                        help="check uncropped frames give the same field edge results under different crops")
+    args = parser.parse_args()
+
+    with open("config/camera.yaml") as fh:
+        camera_config = yaml.safe_load(fh)
+    with open("config/color.yaml") as fh:
+        color_config = yaml.safe_load(fh)
+
+    if args.frames:
+        frames = load_frames(args.frames, camera_config)
+    else:
+        frames = synthetic_frames(color_config, camera_config=camera_config)
+    print("%d %s frames" % (len(frames), "recorded" if args.frames else "synthetic"))
+
+    results = dict(
+        frames=len(frames),
+        source=args.frames or "synthetic",
+        stages=profile_stages(frames, camera_config, color_config, args.threads, args.repeats),
+        throughput=dict((workers, measure_throughput(frames, camera_config, color_config, int(workers)))
+                        for workers in args.workers.split(",")))
+
+    print("%-14s" % "stage (ms)" + "".join("%9s" % key for key in results["stages"]["total"]))
+    for stage, values in results["stages"].items():
+        print("%-14s" % stage + "".join("%9.2f" % value for value in values.values()))
+    for workers, fps in results["throughput"].items():
+        print("%s workers: %.1f fps" % (workers, fps))
+
+    status = 0
+    if args.check_crops:
+        # Crops are taken of uncropped 640x480 frames
+        uncropped = dict(camera_config, **{"capture mode": {}})
+        if not args.frames:
+            full_frames = synthetic_frames(color_config, camera_config=uncropped)
+        elif frames and frames[0].shape == CaptureMode.from_config(uncropped).panorama_shape:
+            full_frames = frames
+        else:
+            print("recorded frames are cropped or scaled, checking crops of synthetic frames")
+            full_frames = synthetic_frames(color_config, camera_config=uncropped)
+        mismatched = check_crops(full_frames, camera_config, color_config)
+        for index in mismatched:
+            print("MISMATCH field edge of frame %d depends on the crop" % index)
+        if mismatched:
+            status = 1
+        else:
+            print("field edge results independent of the crop")
+
+    if results["stages"]["total"]["p90"] > BUDGET * 1000:
+        print("p90 of %.2fms exceeds frame budget of %.0fms" % (results["stages"]["total"]["p90"], BUDGET * 1000))
+        status = 1
+
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            status = 1
+        else:
+            print("no regressions against %s" % args.compare)
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(results, fh, indent=1)
+        print("baseline saved to %s" % args.save)
+
+    sys.exit(status)
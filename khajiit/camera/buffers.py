@@ -0,0 +1,58 @@
+import tracemalloc
+
+import numpy as np
+
+
+class BufferPool:
+    """
+    Named arrays reused from frame to frame, memory is allocated only when a buffer
+    is requested for the first time or with a different shape
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocated_bytes = 0  # Bytes allocated by the pool, grows only on misses
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype=dtype)
+            self.allocated_bytes += buffer.nbytes
+        return buffer
+
+    def zeros(self, name, shape, dtype=np.uint8):
+        buffer = self.get(name, shape, dtype)
+        buffer.fill(0)
+        return buffer
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+
+class AllocationMeter:
+    """
+    Measure heap growth of a block with tracemalloc, NumPy and OpenCV arrays are traced too
+
+    with AllocationMeter() as meter:
+        ...
+    meter.peak_bytes  # most memory held at once by allocations made within the block
+    meter.bytes  # memory still held after the block
+    """
+
+    def __init__(self):
+        self.baseline = 0
+        self.bytes = 0
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc_info):
+        current, peak = tracemalloc.get_traced_memory()
+        self.bytes = current - self.baseline
+        self.peak_bytes = peak - self.baseline
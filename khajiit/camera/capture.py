@@ -0,0 +1,486 @@
+"""
+Capture backends of the grabbers: V4L2 devices and simulated cameras for running
+the capture pipeline without hardware. A backend tells whether the camera is plugged in
+and opens it, the opened device signals ready frames on a file descriptor and hands out
+driver buffers with .dequeue() until they are handed back with .requeue().
+"""
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import select
+from collections import deque
+from threading import Lock, Thread, Event
+from time import time, sleep, monotonic
+
+import numpy as np
+
+from .v4l2 import *
+
+logger = logging.getLogger("capture")
+
+SHAPE = (480, 320, 4)  # YUYV frame of a camera at 640x480
+
+
+class V4L2Device:
+    """
+    Opened V4L2 capture device streaming to mmap'd driver buffers
+    """
+
+    def __init__(self, path, fps=None, exposure=None, gain=None, saturation=None, buffers=4, resolution=(640, 480)):
+        logger.info("Opening %s requesting %dx%d at %d fps", path, resolution[0], resolution[1], fps)
+        self.shape = (resolution[1], resolution[0] // 2, 4)
+        vd = self.vd = open(os.path.realpath(path), 'rb+', buffering=0)
+
+        # Query camera capabilities
+        cp = v4l2_capability()
+        fcntl.ioctl(vd, VIDIOC_QUERYCAP, cp)
+        self.driver = "".join((chr(c) for c in cp.driver if c))
+
+        # logger.info("Disabling auto white balance for %s", path)
+        ctrl = v4l2_control()
+        ctrl.id = V4L2_CID_AUTO_WHITE_BALANCE
+        ctrl.value = 0
+        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        if saturation is not None:
+            # logger.info("Setting saturation for %s to %d", path, saturation)
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_SATURATION
+            ctrl.value = saturation
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        if exposure is not None:
+            # logger.info("Setting exposure for %s to %d", path, exposure)
+            # Disable auto exposure
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_EXPOSURE_AUTO
+            ctrl.value = V4L2_EXPOSURE_MANUAL
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+            # Set exposure manually
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_EXPOSURE
+            ctrl.value = exposure
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        else:
+            # Enable auto exposure
+            # logger.info("Setting auto exposure for %s", path)
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_EXPOSURE_AUTO
+            ctrl.value = V4L2_EXPOSURE_AUTO
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        # Flip camera horizontally
+        ctrl = v4l2_control()
+        ctrl.id = V4L2_CID_HFLIP
+        ctrl.value = 0
+        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        # Flip camera vertically
+        ctrl = v4l2_control()
+        ctrl.id = V4L2_CID_VFLIP
+        ctrl.value = 1
+        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        if gain is not None:
+            # Disable autogain
+            # logger.info("Setting gain for %s to %d", path, gain)
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_AUTOGAIN
+            ctrl.value = 0
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+            # Set gain manually
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_GAIN
+            ctrl.value = gain
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        else:
+            # Enable autogain
+            # logger.info("Setting autogain for %s", path)
+            ctrl = v4l2_control()
+            ctrl.id = V4L2_CID_AUTOGAIN
+            ctrl.value = 1
+            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
+
+        # Set resolution, frame rates above 60 fps are available only at 320x240
+        fmt = v4l2_format()
+        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fmt.fmt.pix.width, fmt.fmt.pix.height = resolution
+        fmt.fmt.pix.pixelformat = V4L2_PIX_FMT_YUYV
+        fmt.fmt.pix.field = V4L2_FIELD_NONE
+        fcntl.ioctl(vd, VIDIOC_S_FMT, fmt)
+
+        if fps is not None:
+            # Set framerate
+            parm = v4l2_streamparm()
+            parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            parm.parm.capture.capability = V4L2_CAP_TIMEPERFRAME
+            fcntl.ioctl(vd, VIDIOC_G_PARM, parm)  # get current camera settings
+            parm.parm.capture.timeperframe.numerator = 1
+            parm.parm.capture.timeperframe.denominator = fps
+            fcntl.ioctl(vd, VIDIOC_S_PARM, parm)  # change camera capture settings
+
+        # Initalize mmap with multiple buffers
+        req = v4l2_requestbuffers()
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = V4L2_MEMORY_MMAP
+        req.count = buffers  # nr of buffer frames
+        try:
+            fcntl.ioctl(vd, VIDIOC_REQBUFS, req)
+        except Exception as e:
+            vd.close()
+            raise e
+
+        self.buffers = []
+
+        # Setup buffers
+        for i in range(req.count):
+            buf = v4l2_buffer()
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_MMAP
+            buf.index = i
+            fcntl.ioctl(vd, VIDIOC_QUERYBUF, buf)
+            mm = mmap.mmap(vd.fileno(), buf.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+                           offset=buf.m.offset)
+            self.buffers.append(mm)
+            fcntl.ioctl(vd, VIDIOC_QBUF, buf)
+
+        # Start streaming
+        fcntl.ioctl(vd, VIDIOC_STREAMON, v4l2_buf_type(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+
+        # Wait cameras to get ready
+        t0 = time()
+        max_t = 1
+        ready_to_read, ready_to_write, in_error = ([], [], [])
+        while len(ready_to_read) == 0 and time() - t0 < max_t:
+            ready_to_read, ready_to_write, in_error = select.select([vd], [], [], max_t)
+
+        self.dequeued = {}  # Buffers handed out by index
+
+    def fileno(self):
+        return self.vd.fileno()
+
+    def set_blocking(self, blocking):
+        os.set_blocking(self.vd.fileno(), blocking)
+
+    def dequeue(self):
+        """
+        Return buffer index, frame in the buffer, kernel timestamp (s) and sequence number of the next frame
+        """
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self.vd, VIDIOC_DQBUF, buf)  # deque from v4l
+        self.dequeued[buf.index] = buf
+        frame = np.asarray(self.buffers[buf.index], dtype=np.uint8).reshape(self.shape)
+        return buf.index, frame, buf.timestamp.secs + buf.timestamp.usecs * 1e-6, buf.sequence
+
+    def requeue(self, index):
+        fcntl.ioctl(self.vd, VIDIOC_QBUF, self.dequeued.pop(index))
+
+    def close(self):
+        try:
+            fcntl.ioctl(self.vd, VIDIOC_STREAMOFF, v4l2_buf_type(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        except OSError:
+            pass  # Unplugged already
+        self.vd.close()
+
+
+class V4L2Camera:
+    """
+    Camera behind a /dev/v4l/by-path symlink
+    """
+    hotplug = True  # Reattaching is noticed by watching /dev/v4l/by-path
+
+    def __init__(self, path, **settings):
+        self.path = path
+        self.settings = settings
+        self.attached = None
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def open(self):
+        return V4L2Device(self.path, **self.settings)
+
+
+def generate_frames(index, count=30, shape=SHAPE):
+    """
+    Return YUYV frames of a bright bar moving over a gradient, different for every camera
+    """
+    rows = np.arange(shape[0])
+    base = np.empty(shape, dtype=np.uint8)
+    base[:] = (64 + (rows * 128 // shape[0]))[:, None, None]
+    base[:, :, 1::2] = 128 + 8 * index
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        bar = i * shape[0] // count
+        frame[bar:bar + 24, :, 0::2] = 235
+        frames.append(frame)
+    return frames
+
+
+def load_frames(path, index=0, shape=SHAPE):
+    """
+    Load recorded frames of a camera: NumPy .npy of camera frames or panoramas, or raw YUYV camera frames
+    """
+    if path.endswith(".npy"):
+        frames = np.load(path, mmap_mode="r")
+    else:
+        frames = np.fromfile(path, dtype=np.uint8).reshape((-1,) + shape)
+    if frames.ndim == 3:
+        frames = frames[None]
+    if frames.shape[1] > shape[0]:
+        # Panoramas, cameras stacked vertically
+        frames = frames[:, index * shape[0]:(index + 1) * shape[0]]
+    return frames
+
+
+class SimulatedDevice:
+    """
+    Opened simulated camera. A sensor thread fills free buffers at the frame rate with
+    gaussian jitter of capture times, drops frames at random or when every buffer is
+    out of the driver, as V4L2 does, and signals each ready frame with a byte on a pipe
+    so that the device can be polled like a real one.
+    """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.buffers = [np.empty(camera.shape, dtype=np.uint8) for _ in range(camera.buffers)]
+        self.free = deque(range(camera.buffers))
+        self.ready = deque()  # Index, capture timestamp and sequence number of filled buffers
+        self.lock = Lock()
+        self.closed = Event()
+        self.fd, self.signal = os.pipe()
+        self.sensor = Thread(target=self.capture, name=camera.name + " sensor", daemon=True)
+        self.sensor.start()
+
+    def capture(self):
+        camera = self.camera
+        period = 1.0 / camera.fps
+        due = monotonic() + period
+        unplug = due + camera.unplug_interval if camera.unplug_interval else None
+        sequence = 0
+        while not self.closed.is_set():
+            captured = due + camera.random.normal(0, camera.jitter)
+            self.closed.wait(max(captured - monotonic(), 0))
+            due += period
+            if unplug and captured >= unplug:
+                camera.unplug()
+                os.close(self.signal)  # Readers get EOF
+                self.signal = None
+                return
+            sequence += 1
+            if camera.random.random_sample() < camera.drop_rate:
+                continue
+            with self.lock:
+                if not self.free:
+                    continue  # Every buffer is out of the driver
+                index = self.free.popleft()
+            self.buffers[index][...] = camera.frames[sequence % len(camera.frames)]
+            with self.lock:
+                self.ready.append((index, captured, sequence))
+            try:
+                os.write(self.signal, b"\0")
+            except OSError:
+                return
+
+    def fileno(self):
+        return self.fd
+
+    def set_blocking(self, blocking):
+        os.set_blocking(self.fd, blocking)
+
+    def dequeue(self):
+        """
+        Return buffer index, frame in the buffer, capture timestamp (s) and sequence number of the next frame
+        """
+        if not os.read(self.fd, 1):
+            raise OSError(errno.ENODEV, "Simulated camera unplugged")
+        with self.lock:
+            index, captured, sequence = self.ready.popleft()
+        return index, self.buffers[index], captured, sequence
+
+    def requeue(self, index):
+        with self.lock:
+            self.free.append(index)
+
+    def close(self):
+        if not self.closed.is_set():
+            self.closed.set()
+            self.sensor.join()
+            os.close(self.fd)
+            if self.signal is not None:
+                os.close(self.signal)
+
+
+class SimulatedCamera:
+    """
+    Camera serving generated or given frames at the configured rate, unplugged every
+    unplug_interval seconds for replug_delay seconds if unplug_interval is set
+    """
+    hotplug = False  # Reattaching is signalled by calling .attached
+
+    def __init__(self, name, frames=None, index=0, fps=30, buffers=4, jitter=0.002, drop_rate=0.0,
+                 unplug_interval=0, replug_delay=1.0, seed=None, resolution=(640, 480)):
+        """
+        Keyword arguments:
+        frames -- YUYV frames served in turns, generated if omitted
+        index -- Position of the camera in the panorama
+        jitter -- Standard deviation of capture times (s)
+        drop_rate -- Probability of a frame getting lost
+        """
+        self.name = name
+        self.path = name
+        self.shape = (resolution[1], resolution[0] // 2, 4)
+        self.frames = frames if frames is not None else generate_frames(index, shape=self.shape)
+        self.fps = fps
+        self.buffers = buffers
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.unplug_interval = unplug_interval
+        self.replug_delay = replug_delay
+        self.random = np.random.RandomState(seed)
+        self.unplugged = False
+        self.attached = None  # Called when plugged back in
+
+    def available(self):
+        return not self.unplugged
+
+    def open(self):
+        if self.unplugged:
+            raise OSError(errno.ENODEV, "Simulated camera unplugged")
+        return SimulatedDevice(self)
+
+    def unplug(self):
+        logger.info("Unplugging simulated %s for %.1fs", self.name, self.replug_delay)
+        self.unplugged = True
+        Thread(target=self.replug, daemon=True).start()
+
+    def replug(self):
+        sleep(self.replug_delay)
+        self.unplugged = False
+        if self.attached:
+            self.attached()
+
+
+class ReplayCamera(SimulatedCamera):
+    """
+    Simulated camera replaying recorded frames, by default without jitter and drops
+    """
+
+    def __init__(self, name, path, index=0, jitter=0.0, resolution=(640, 480), **kwargs):
+        frames = load_frames(path, index, (resolution[1], resolution[0] // 2, 4))
+        SimulatedCamera.__init__(self, name, frames, index, jitter=jitter, resolution=resolution, **kwargs)
+
+
+def create_camera(backend, index, path, simulation=None, **settings):
+    """
+    Return capture backend of camera index (0 based), one of "v4l2", "simulated" and "replay"
+
+    simulation -- Simulation config: jitter (ms), drop rate, unplug interval (s), replug delay (s), frames
+    settings -- fps, buffers, resolution, exposure, gain and saturation
+    """
+    if backend == "v4l2":
+        return V4L2Camera(path, **settings)
+
+    simulation = simulation or {}
+    kwargs = dict(
+        fps=settings.get("fps") or 30,
+        buffers=settings.get("buffers", 4),
+        jitter=simulation.get("jitter", 2) / 1000.0,
+        drop_rate=simulation.get("drop rate", 0.0),
+        unplug_interval=simulation.get("unplug interval", 0),
+        replug_delay=simulation.get("replug delay", 1.0),
+        resolution=settings.get("resolution", (640, 480)),
+        seed=index)
+    name = "camera%d" % (index + 1)
+    if backend == "simulated":
+        return SimulatedCamera(name, index=index, **kwargs)
+    if backend == "replay":
+        kwargs["jitter"] = simulation.get("jitter", 0) / 1000.0
+        return ReplayCamera(name, os.path.expanduser(simulation["frames"]), index, **kwargs)
+    raise ValueError("Unknown capture backend %s" % backend)
+
+
+if __name__ == "__main__":
+    """
+    Benchmark panorama capture on simulated cameras, no cameras needed, usage:
+    python3 -m camera.capture --engine epoll --duration 10
+    python3 -m camera.capture --backend replay --frames ~/panoramas.npy
+    python3 -m camera.capture --resolution 320x240 --fps 120 --crop 0,300
+    """
+    from argparse import ArgumentParser
+
+    import yaml
+
+    from config_manager import Settings
+    from camera.grabber import PanoramaGrabber, observer
+
+    parser = ArgumentParser()
+    parser.add_argument("--backend", default="simulated", help="simulated or replay")
+    parser.add_argument("--engine", default="epoll", help="epoll or threads")
+    parser.add_argument("--frames", help="recorded frames to replay, .npy of camera frames or panoramas")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to capture")
+    parser.add_argument("--jitter", type=float, help="standard deviation of capture times (ms)")
+    parser.add_argument("--drop-rate", type=float, help="probability of a frame getting lost")
+    parser.add_argument("--unplug-interval", type=float, help="seconds between unplugging each camera")
+    parser.add_argument("--resolution", help="capture resolution, e.g. 320x240")
+    parser.add_argument("--fps", type=int, help="capture frame rate")
+    parser.add_argument("--crop", help="first and last YUYV column kept in 640x480 columns, e.g. 0,300")
+    parser.add_argument("--sync-wait", type=float, help="wait for closer frames up to this long (ms)")
+    args = parser.parse_args()
+
+    with open("config/camera.yaml") as fh:
+        config = Settings(yaml.safe_load(fh))
+    config["global"]["capture backend"] = args.backend
+    config["global"]["capture engine"] = args.engine
+    if args.sync_wait is not None:
+        config["global"]["sync wait"] = args.sync_wait
+    mode = config.setdefault("capture mode", {})
+    if args.resolution:
+        mode["resolution"] = [int(size) for size in args.resolution.split("x")]
+    if args.fps:
+        mode["fps"] = args.fps
+    if args.crop:
+        mode["crop"] = [int(column) for column in args.crop.split(",")]
+    simulation = config.setdefault("simulation", {})
+    for key, value in (("frames", args.frames), ("jitter", args.jitter), ("drop rate", args.drop_rate),
+                       ("unplug interval", args.unplug_interval)):
+        if value is not None:
+            simulation[key] = value
+
+    grabber = PanoramaGrabber(config)
+    queue = grabber.get_queue()
+    grabber.start()
+
+    latencies, spreads = [], []
+    start = time()
+    while time() - start < args.duration:
+        slot, seq = queue.get()
+        if grabber.publish_latency:
+            latencies.append(grabber.publish_latency[-1])
+        if grabber.spread:
+            spreads.append(grabber.spread[-1])
+    elapsed = time() - start
+    grabber.stop()
+    grabber.join()
+    observer.stop()
+
+    print("%s backend, %s engine, %dx%d@%d crop %s: %.1f panoramas/s" % (
+        args.backend, args.engine, grabber.mode.width, grabber.mode.height, grabber.mode.fps, grabber.mode.crop,
+        len(latencies) / elapsed))
+    for name, values in ("DQBUF to publish", latencies), ("capture time spread", spreads):
+        if values:
+            values = np.array(values) * 1000
+            print("%-20s p50 %6.2fms p90 %6.2fms max %6.2fms" % (
+                name, np.percentile(values, 50), np.percentile(values, 90), values.max()))
+    for slave in grabber.slaves:
+        print("%s frames: %d dropped: %d copied: %d errors: %d" % (
+            slave.name, slave.frame_count, slave.dropped_count, slave.copied_count, slave.error_count))
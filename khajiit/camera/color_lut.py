@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger("color_lut")
+
+
+def unpack(mapping):
+    """
+    Convert color config section to YUYV lower and upper bounds
+    """
+    luma = mapping['luma']
+    chroma_red = mapping['chroma red']
+    chroma_blue = mapping['chroma blue']
+    lower, upper = zip(luma, chroma_blue, luma, chroma_red)
+    return lower, upper
+
+
+class ColorClassifier:
+    """
+    Label every pixel of a YUYV frame with the color classes it belongs to in a single pass.
+
+    Each color class owns one bit of the label image. The lookup table holds per YUYV channel
+    (Y0, U, Y1, V) the classes whose range contains the value, a pixel belongs to a class
+    only if all four channels agree, which is the same test cv2.inRange performs.
+    The channel tables are combined into two tables of 65536 entries, indexed by
+    the Y0, U and Y1, V byte pairs of the macropixel read as 16-bit words,
+    so labeling takes two lookups and one AND per macropixel.
+    """
+    CLASSES = ("field", "ball", "goal A", "goal B")
+    # Rows looked up at once, their table indices are widened into a buffer that stays in cache
+    CHUNK_ROWS = 480
+
+    def __init__(self, color_config=None):
+        color_config = color_config or {}
+        self.bits = {}
+        self.lut = np.zeros((256, 1, 4), dtype=np.uint8)
+
+        for index, name in enumerate(self.CLASSES):
+            bit = 1 << index
+            self.bits[name] = bit
+
+            mapping = color_config.get(name)
+            if not mapping:
+                logger.warning("No color range configured for %s", name)
+                continue
+            lower, upper = unpack(mapping)
+            for channel, (low, high) in enumerate(zip(lower, upper)):
+                self.lut[max(low, 0):min(high, 255) + 1, 0, channel] |= bit
+
+        # Entry for low byte Y and high byte chroma, the order of the bytes in a little-endian word
+        luma, chroma_blue, chroma_red = self.lut[:, 0, 0], self.lut[:, 0, 1], self.lut[:, 0, 3]
+        self.luma_blue = (chroma_blue[:, None] & luma[None, :]).ravel()
+        self.luma_red = (chroma_red[:, None] & luma[None, :]).ravel()
+
+    def classify(self, frame, buffers=None):
+        """
+        Return label image for YUYV frame, one byte per macropixel
+
+        buffers -- BufferPool to write intermediate and resulting images to
+        """
+        rows, columns = frame.shape[:2]
+        chunk = min(rows, self.CHUNK_ROWS)
+        if buffers is not None:
+            labels = buffers.get("labels", (rows, columns))
+            red = buffers.get("labels luma red", (rows, columns))
+            indices = buffers.get("labels indices", (chunk, columns), np.intp)
+        else:
+            labels, red = np.empty((rows, columns), np.uint8), np.empty((rows, columns), np.uint8)
+            indices = np.empty((chunk, columns), np.intp)
+
+        # Y0 | U << 8 and Y1 | V << 8, take() would widen them to a temporary of the whole frame
+        words = frame.view("<u2")
+        for start in range(0, rows, chunk):
+            stop = min(start + chunk, rows)
+            index = indices[:stop - start]
+            for word, table, dst in ((0, self.luma_blue, labels), (1, self.luma_red, red)):
+                np.copyto(index, words[start:stop, :, word])
+                # Words are always in range, wrapping skips the bounds check
+                np.take(table, index, out=dst[start:stop], mode="wrap")
+        return cv2.bitwise_and(labels, red, dst=labels)
+
+    def mask(self, labels, name, dst=None):
+        """
+        Extract 0/255 mask of a single color class from the label image
+        """
+        dst = cv2.bitwise_and(labels, self.bits[name], dst=dst)
+        return cv2.compare(dst, 0, cv2.CMP_NE, dst=dst)
@@ -0,0 +1,136 @@
+import cv2
+import numpy as np
+
+
+class FieldEdge:
+    """
+    Locate the far edge of the field in every panorama column and fit it with
+    a straight line per camera, as field edges are straight within a single camera.
+
+    The edge of a column is where the field color mask is best split into non-field
+    above and field below: the cumulative count of field pixels gives the number of
+    misclassified pixels for every possible edge at once and the edge with fewest wins.
+    Stray field colored pixels on the walls and holes in the carpet do not move it,
+    whatever is left is rejected as outliers of the line fit.
+    """
+
+    def __init__(self, top=30, bottom=250, depth=300, cameras=8, camera_width=480, tolerance=8, iterations=2):
+        """
+        Keyword arguments:
+        top -- Topmost mask column that can be field, everything above is ignored
+        bottom -- Mask columns from here down to depth always belong to the field (robot's surroundings)
+        depth -- Mask columns from here on are masked out
+        cameras -- Number of cameras in the panorama
+        camera_width -- Panorama columns per camera (px)
+        tolerance -- Largest deviation from the fitted line for the column to count in the refit
+        iterations -- Number of refits without outliers
+        """
+        self.top = top
+        self.bottom = bottom
+        self.depth = depth
+        self.cameras = cameras
+        self.camera_width = camera_width
+        self.tolerance = tolerance
+        self.iterations = iterations
+        self.ramp = None  # Pixels above each edge candidate times 255, for every panorama column
+        self.design = None  # Powers of the camera column for the line fit
+        self.columns = None  # Column index of every field mask pixel
+
+    def profile(self, mask, buffers=None):
+        """
+        Return the mask column of the field edge for each panorama column of the 0/255 field color mask
+        """
+        get = buffers.get if buffers else lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+        span = mask[:, self.top:self.bottom]
+        height, width = span.shape
+        # Cumulative field pixels of every column from the integral image as the difference of its rows,
+        # NumPy cumsum would allocate a temporary of the whole span for casting the 8-bit mask
+        integral = get("field edge integral", (height + 1, width + 1), np.int32)
+        cv2.integral(span, sum=integral, sdepth=cv2.CV_32S)
+        cumulative = get("field edge cumulative", (height, width + 1), np.int32)
+        np.subtract(integral[1:], integral[:-1], out=cumulative)
+        # Misclassified pixels of an edge, up to a constant: field pixels above it count twice
+        # as the pixels below it are counted by the position of the edge
+        if self.ramp is None or self.ramp.shape != cumulative.shape:
+            # Full size as adding a broadcast row would allocate iteration buffers on every call
+            self.ramp = np.repeat(np.arange(width + 1, dtype=np.int32)[None] * 255, height, axis=0)
+        np.multiply(cumulative, 2, out=cumulative)
+        np.subtract(self.ramp, cumulative, out=cumulative)
+        edge = get("field edge", (height,), np.intp)
+        cumulative.argmax(axis=1, out=edge)
+        np.add(edge, self.top, out=edge)
+        return edge
+
+    def fit(self, edge, buffers=None):
+        """
+        Return straight line fit of the field edge for each camera evaluated at every panorama column
+        """
+        get = buffers.get if buffers else lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+        shape = self.cameras, self.camera_width
+        if self.design is None or self.design.shape[0] != self.camera_width:
+            x = np.arange(self.camera_width, dtype=np.float64)
+            # Columns give the weighted sums of 1, x and x^2, rows of the transpose evaluate a line
+            self.design = np.stack((np.ones_like(x), x, x * x), axis=1)
+        y = get("field fit edge", shape, np.float64)
+        weights = get("field fit weights", shape, np.float64)
+        weighted = get("field fit weighted", shape, np.float64)
+        fitted = get("field fit line", shape, np.float64)
+        inliers = get("field fit inliers", shape, np.bool_)
+        moments = get("field fit moments", (self.cameras, 3), np.float64)
+        products = get("field fit products", (self.cameras, 2), np.float64)
+        line = get("field fit coefficients", (self.cameras, 2), np.float64)
+        found = get("field fit found", (self.cameras,), np.bool_)
+        np.copyto(y, edge[:self.cameras * self.camera_width].reshape(shape))
+        weights.fill(1)
+        for _ in range(self.iterations + 1):
+            np.matmul(weights, self.design, out=moments)
+            np.multiply(weights, y, out=weighted)
+            np.matmul(weighted, self.design[:, :2], out=products)
+            sw, sx, sxx = moments.T
+            sy, sxy = products.T
+            det = sw * sxx - sx * sx
+            slope = np.divide(sw * sxy - sx * sy, det, out=line[:, 1], where=det != 0)
+            slope[det == 0] = 0
+            np.divide(sy - slope * sx, sw, out=line[:, 0])
+            np.matmul(line, self.design[:, :2].T, out=fitted)
+            np.subtract(y, fitted, out=weighted)
+            np.abs(weighted, out=weighted)
+            np.less_equal(weighted, self.tolerance, out=inliers)
+            np.copyto(weights, inliers)
+            # Nothing agrees with the line, keep fitting all of the columns
+            np.any(inliers, axis=1, out=found)
+            for camera in np.flatnonzero(~found):
+                weights[camera] = 1
+        np.rint(fitted, out=fitted)
+        np.clip(fitted, self.top, self.bottom, out=fitted)
+        result = get("field fit", (self.cameras * self.camera_width,), np.int32)
+        np.copyto(result.reshape(shape), fitted, casting="unsafe")
+        return result
+
+    def fill(self, edge, dst, buffers=None):
+        """
+        Fill the field mask of shape (columns, depth or more) below the edge with 255
+        """
+        get = buffers.get if buffers else lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+        if self.columns is None or self.columns.shape != dst.shape:
+            self.columns = np.repeat(np.arange(dst.shape[1], dtype=np.int16)[None], dst.shape[0], axis=0)
+        # Edge repeated along the row compared with the column index, broadcasting copy allocates nothing
+        # unlike a broadcasting comparison, which needs iteration buffers, or cv2.repeat, which is slow
+        rows = get("field fill edges", dst.shape, np.int16)
+        np.copyto(rows, edge[:, None], casting="unsafe")
+        cv2.compare(self.columns, rows, cv2.CMP_GE, dst=dst)
+        dst[:, self.depth:] = 0
+        return dst
+
+    def tops(self, edge):
+        """
+        Return topmost field edge column of each camera
+        """
+        return edge.reshape(self.cameras, self.camera_width).min(axis=1)
+
+    def find(self, mask, dst, buffers=None):
+        """
+        Return field mask filled below the fitted field edge and topmost edge column of each camera
+        """
+        edge = self.fit(self.profile(mask, buffers), buffers)
+        return self.fill(edge, dst, buffers), self.tops(edge)
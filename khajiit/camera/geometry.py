@@ -0,0 +1,177 @@
+import math
+
+import numpy as np
+
+
+class CaptureMode:
+    """
+    Capture resolution, frame rate and window of YUYV columns kept of every camera frame.
+
+    Cameras are mounted sideways: lines of a camera frame become panorama columns
+    and the YUYV columns, two pixels each, run from the horizon down towards the robot.
+    Sizes throughout the recognition are given for 640x480 capture and scaled with .scale(),
+    column positions are converted to the cropped frame with .column().
+    """
+    FULL_WIDTH = 640
+
+    def __init__(self, resolution=(640, 480), fps=30, crop=None, cameras=8):
+        """
+        Keyword arguments:
+        resolution -- Sensor width and height (px)
+        fps -- Frame rate requested from the cameras
+        crop -- First and last (exclusive) YUYV column kept in 640x480 columns, everything if omitted
+        cameras -- Number of cameras in the panorama
+        """
+        self.width, self.height = resolution
+        self.fps = fps
+        self.cameras = cameras
+        self.factor = self.width / float(self.FULL_WIDTH)
+        start, stop = crop or (0, self.FULL_WIDTH // 2)
+        self.crop = (self.scale(start), min(self.scale(stop), self.width // 2))
+
+        self.lines = self.height  # Panorama columns of a camera
+        self.columns = self.crop[1] - self.crop[0]  # YUYV columns kept of a line
+        self.panorama_width = self.cameras * self.lines
+        self.sensor_shape = (self.lines, self.width // 2, 4)
+        self.frame_shape = (self.lines, self.columns, 4)
+        # Cameras followed by the first camera again for wraparound
+        self.panorama_shape = ((self.cameras + 1) * self.lines, self.columns, 4)
+
+    @classmethod
+    def from_config(cls, camera_config=None):
+        camera_config = camera_config or {}
+        global_config = camera_config.get('global', {})
+        mode = camera_config.get('capture mode', {})
+        return cls(tuple(mode.get('resolution', (640, 480))), mode.get('fps', global_config.get('fps', 30)),
+                   mode.get('crop'), global_config.get('cameras', 8))
+
+    def __eq__(self, other):
+        return isinstance(other, CaptureMode) and \
+               (self.width, self.height, self.fps, self.crop, self.cameras) == \
+               (other.width, other.height, other.fps, other.crop, other.cameras)
+
+    def scale(self, size):
+        """
+        Convert size at 640x480 capture to this mode
+        """
+        return int(round(size * self.factor))
+
+    def column(self, column):
+        """
+        Convert YUYV column of 640x480 capture to the cropped frame of this mode
+        """
+        return min(max(self.scale(column) - self.crop[0], 0), self.columns)
+
+    def full_y(self, y):
+        """
+        Convert panorama y coordinate to the one of uncropped 640x480 capture
+        """
+        return (y + 2 * self.crop[0]) / self.factor
+
+
+class PanoramaGeometry:
+    """
+    Conversions between panorama pixels and polar coordinates around the robot.
+
+    Camera height, mount radius, field of view and kicker offset are fixed for
+    a camera config, so the angle of every panorama column (at half pixel resolution)
+    and the distance of every row are computed once and looked up afterwards.
+    Conversions accept single numbers as well as NumPy arrays for batch conversion.
+    """
+
+    def __init__(self, kicker_offset=0, camera_height=0.265, camera_mount_radius=0.07,
+                 camera_vert_fov=72, camera_horiz_fov=54, width=3840, height=640, y_offset=0):
+        """
+        Keyword arguments:
+        kicker_offset -- Panorama x coordinate of the kicker
+        camera_height -- Camera height from the floor (m)
+        camera_mount_radius -- Camera distance from the center of the robot (m)
+        camera_vert_fov -- Camera field of view vertically (deg)
+        camera_horiz_fov -- Camera field of view horizontally (deg)
+        width -- Panorama width covering 360 degrees (px)
+        height -- Panorama height covering vertical field of view (px)
+        y_offset -- Panorama y coordinate of the first row kept when frames are cropped
+        """
+        self.kicker_offset = kicker_offset
+        self.camera_height = camera_height
+        self.camera_mount_radius = camera_mount_radius
+        self.camera_vert_fov_rad = math.radians(camera_vert_fov)
+        self.camera_horiz_fov_rad = math.radians(camera_horiz_fov)
+        self.width = width
+        self.height = height
+        self.y_offset = y_offset
+
+        # Goal centers fall on half pixels and goal windows reach past the wraparound copy
+        self.rad_list = [self._x_to_rad(x / 2.0) for x in range(4 * width)]
+        self.rad_table = np.array(self.rad_list)
+        # Balls below the image center reach beyond the panorama height
+        self.dist_list = [self._y_to_dist(y) for y in range(2 * height)]
+        self.dist_table = np.array(self.dist_list)
+
+        # Round trip is exact to a panorama column, narrower panoramas have wider columns
+        assert abs(self.x_to_deg(self.deg_to_x(50)) - 50) < max(0.1, 360.0 / width), self.x_to_deg(self.deg_to_x(50))
+        assert abs(self.y_to_dist(self.dist_to_y(2.0)) - 2.0) < 0.1
+
+    @classmethod
+    def from_config(cls, camera_config=None, mode=None, **kwargs):
+        camera_config = camera_config or {}
+        mode = mode or CaptureMode.from_config(camera_config)
+        # Kicker offset is configured for 640x480 capture
+        kicker_offset = mode.scale(camera_config.get('global', {}).get('kicker offset', 0))
+        return cls(kicker_offset, width=mode.panorama_width, height=mode.width, y_offset=2 * mode.crop[0], **kwargs)
+
+    def _x_to_rad(self, x):
+        d = (x - self.kicker_offset) * (math.pi * 2) / self.width
+        if d > math.pi:
+            d -= math.pi * 2
+        if d < -math.pi:
+            d += math.pi * 2
+        return d
+
+    def _y_to_dist(self, y):
+        j = math.tan((y + self.y_offset) * self.camera_vert_fov_rad / self.height)
+        if j != 0:
+            return self.camera_height / j + self.camera_mount_radius
+        return 99999999  # infinity to prevent division by zero
+
+    def x_to_rad(self, x):
+        """
+        Convert panorama image x coordinate to angle in radians from the center of the image
+        (angle from the the kicker)
+        """
+        if isinstance(x, np.ndarray):
+            return self.rad_table[np.rint(x * 2).astype(np.int64) % len(self.rad_list)]
+        index = int(x * 2)
+        if index != x * 2:
+            return self._x_to_rad(x)
+        return self.rad_list[index % len(self.rad_list)]
+
+    def y_to_dist(self, y):
+        """
+        Convert panorama image y coordinate to distance
+        """
+        if isinstance(y, np.ndarray):
+            return self.dist_table[np.clip(np.rint(y).astype(np.int64), 0, len(self.dist_list) - 1)]
+        index = int(y)
+        if index != y or not 0 <= index < len(self.dist_list):
+            return self._y_to_dist(y)
+        return self.dist_list[index]
+
+    def dist_to_y(self, d):
+        """
+        Convert object distance to panorama image y coordinate
+        """
+        return int(self.height * math.atan2(self.camera_height, d - self.camera_mount_radius) /
+                   self.camera_vert_fov_rad) - self.y_offset
+
+    def deg_to_x(self, d):
+        """
+        Convert degrees from the kicker to panorama image x coordinate
+        """
+        d = d % 360
+        if d > 180: d -= 360
+        return int(d * self.width / 360) + self.kicker_offset
+
+    def x_to_deg(self, x):
+        d = (x - self.kicker_offset) * 360 / self.width
+        return d % 360
@@ -0,0 +1,214 @@
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+# Rectangle in panorama coordinates: x, y, width, height with y in full resolution pixels
+Rect = Tuple[int, int, int, int]
+
+
+class GoalFinder:
+    """
+    Find goals as runs of occupied panorama columns.
+
+    The goal mask is reduced to an occupancy profile with one pass over the image,
+    each panorama column telling how many goal pixels it has. Runs of occupied columns
+    separated by at most gap empty columns form a goal candidate, the run crossing
+    the panorama seam is joined with its continuation at the beginning of the panorama.
+    Vertical extent is looked up only for the few candidates found.
+    """
+
+    def __init__(self, min_area=100, gap=8, max_span=1440, width=3840):
+        """
+        Keyword arguments:
+        min_area -- Smallest number of goal pixels of a run, smaller ones are noise
+        gap -- Longest run of empty columns bridged within a goal (px)
+        max_span -- Widest run considered a goal, three cameras by default, wider runs are
+                    clipped to their densest part (px)
+        width -- Panorama width covering 360 degrees (px)
+        """
+        self.min_area = min_area
+        self.gap = gap
+        self.max_span = max_span
+        self.width = width
+
+    @staticmethod
+    def profile(mask, dst=None):
+        """
+        Return number of goal pixels of each panorama column of the 0/255 mask,
+        dst is optional int32 buffer of (columns, 1) for the counts
+        """
+        counts = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dst=dst, dtype=cv2.CV_32S).ravel()
+        return np.floor_divide(counts, 255, out=counts)
+
+    def extent(self, mask, start, end):
+        """
+        Return topmost and bottommost goal pixel of the run, wrapping over the seam
+        """
+        rows = cv2.reduce(mask[start:min(end, self.width)], 0, cv2.REDUCE_MAX)
+        if end > self.width:
+            rows = cv2.max(rows, cv2.reduce(mask[:end - self.width], 0, cv2.REDUCE_MAX))
+        occupied = np.flatnonzero(rows)
+        return int(occupied[0]), int(occupied[-1])
+
+    def runs(self, counts):
+        """
+        Return start and end (exclusive) of runs of occupied columns with small gaps bridged,
+        the run crossing the seam ends past the panorama width
+        """
+        occupied = np.flatnonzero(counts)
+        if not len(occupied):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # New run begins wherever the distance to the previous occupied column exceeds the gap
+        breaks = np.flatnonzero(np.diff(occupied) > self.gap + 1) + 1
+        starts = occupied[np.r_[0, breaks]]
+        ends = occupied[np.r_[breaks - 1, len(occupied) - 1]] + 1
+
+        # Join the last run with the first one over the seam
+        if len(starts) > 1 and starts[0] + self.width - ends[-1] <= self.gap:
+            starts = np.r_[starts[1:-1], starts[-1]]
+            ends = np.r_[ends[1:-1], ends[0] + self.width]
+        return starts, ends
+
+    def area(self, counts, start, end):
+        """
+        Return goal pixels of the run, wrapping over the seam
+        """
+        area = int(counts[start:min(end, self.width)].sum())
+        if end > self.width:
+            area += int(counts[:end - self.width].sum())
+        return area
+
+    def densest(self, counts, start, end):
+        """
+        Return start and end of the max_span wide window of the run with most goal pixels,
+        trimmed to its solid columns, for goals joined with noise into an over-wide run
+        """
+        columns = counts[np.arange(start, end) % self.width]
+        # Noise columns have a few pixels while goal columns are about as tall as the tallest one
+        columns[columns * 8 < columns.max()] = 0
+        sums = np.cumsum(np.r_[0, columns])
+        best = int(np.argmax(sums[self.max_span:] - sums[:-self.max_span]))
+        occupied = np.flatnonzero(columns[best:best + self.max_span])
+        start, end = start + best + int(occupied[0]), start + best + int(occupied[-1]) + 1
+        if start >= self.width:
+            start, end = start - self.width, end - self.width
+        return start, end
+
+    def find(self, mask, profile=None) -> List[Rect]:
+        """
+        Return bounding rectangles of goal candidates in the rotated goal mask, widest first,
+        profile is optional int32 buffer of (width, 1) for the column counts
+        """
+        mask = mask[:self.width]
+        counts = self.profile(mask, profile)
+        starts, ends = self.runs(counts)
+        if not len(starts):
+            return []
+        # Goal bridged with noise columns into a run too wide for a goal is clipped to its densest part
+        for i in np.flatnonzero(ends - starts > self.max_span).tolist():
+            starts[i], ends[i] = self.densest(counts, starts[i], ends[i])
+        widths = ends - starts
+
+        rects = []
+        for i in np.argsort(-widths, kind="stable").tolist():
+            if self.area(counts, starts[i], ends[i]) <= self.min_area:
+                continue
+            top, bottom = self.extent(mask, starts[i], ends[i])
+            # Mask has one column per YUYV macropixel, panorama has two pixels
+            rects.append((int(starts[i]), 2 * top, int(widths[i]), 2 * (bottom - top + 1)))
+        return rects
+
+
+def find_goal_hulls(mask, overlap=4):
+    """
+    Previous goal search kept for comparison: convex hull of goal contours per camera,
+    then the widest bounding rectangle over hulls of three consecutive cameras
+    """
+    cnts = []
+    for j in range(0, 8):
+        roi = mask[j * 480:j * 480 + 480]
+        contours = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        contours = [c for c in contours if cv2.contourArea(c) > 100]
+        cnts.append(cv2.convexHull(np.vstack(contours)) if contours else None)
+    for j in range(0, overlap):
+        cnts.append(cnts[j])
+
+    maxwidth, rect = 0, None
+    for j in range(0, 11):
+        contours = [c + (0, i * 480) for i, c in enumerate(cnts[j:j + 3]) if c is not None]
+        if not contours:
+            continue
+        y, x, h, w = cv2.boundingRect(cv2.convexHull(np.vstack(contours)))
+        if w > maxwidth:
+            maxwidth, rect = w, ((x + j * 480), 2 * y, w, h * 2)
+    return [rect] if rect else []
+
+
+if __name__ == "__main__":
+    """
+    Benchmark goal search on goal masks of a recorded videofile or synthetic masks, usage:
+    python3 -m camera.goal_finder [filename.avi]
+    """
+    import sys
+    from time import time
+
+    import yaml
+
+    if len(sys.argv) > 1:
+        from camera.image_recognition import ImageRecognition, rgb_to_yuyv
+
+        with open("config/camera.yaml") as fh:
+            camera_config = yaml.safe_load(fh)
+        with open("config/color.yaml") as fh:
+            color_config = yaml.safe_load(fh)
+        recognition = ImageRecognition(camera_config=camera_config, color_config=color_config)
+
+        masks = []
+        cap = cv2.VideoCapture(sys.argv[1])
+        while True:
+            succ, frame = cap.read()
+            if not succ:
+                break
+            recognition.process(rgb_to_yuyv(frame))
+            masks.append(recognition.goal_blue_mask.copy())
+            masks.append(recognition.goal_yellow_mask.copy())
+    else:
+        rng = np.random.RandomState(0)
+        masks = []
+        for _ in range(100):
+            mask = np.zeros((3840, 250), dtype=np.uint8)
+            x, w = rng.randint(0, 3840), rng.randint(100, 900)
+            y, h = rng.randint(20, 100), rng.randint(20, 100)
+            mask[np.arange(x, x + w) % 3840, y:y + h] = 255
+            mask[rng.randint(0, 3840, 50), rng.randint(10, 250, 50)] = 255  # noise
+            masks.append(mask)
+
+    finder = GoalFinder()
+    for name, find in ("hulls", lambda m: find_goal_hulls(m.copy())), ("projection", finder.find):
+        start = time()
+        results = [find(mask) for mask in masks]
+        elapsed = time() - start
+        print("%-10s %6.2f ms per mask, %d goals" % (
+            name, elapsed * 1000 / len(masks), sum(1 for rects in results if rects)))
+
+    # Compare goal centers of both methods
+    differences = []
+    for mask in masks:
+        a, b = find_goal_hulls(mask.copy()), finder.find(mask)
+        if a and b:
+            ca = (a[0][0] + a[0][2] / 2.0) % 3840
+            cb = (b[0][0] + b[0][2] / 2.0) % 3840
+            differences.append(min(abs(ca - cb), 3840 - abs(ca - cb)) * 360 / 3840.0)
+    if differences:
+        print("goal center difference deg: mean %.2f max %.2f" % (np.mean(differences), np.max(differences)))
+
+    # Goal joined over the seam with a sparse noise run into one run wider than max_span
+    mask = np.zeros((3840, 250), dtype=np.uint8)
+    mask[np.arange(3500, 4100) % 3840, 40:120] = 255
+    mask[260:2000:6, 200] = 255
+    rects = finder.find(mask)
+    if not rects or rects[0][:3] != (3500, 80, 600):
+        print("goal joined with noise: expected (3500, 80, 600, 160), got", rects)
+        sys.exit(1)
+    print("goal joined with noise: found", rects[0])
@@ -3,20 +3,21 @@ As OpenCV doesn't handle camera unplugging very well
 here is an example using inotify and udev symlinks
 """
 from messenger import is_running
-from .v4l2 import *
-import fcntl
-import mmap
+from shared import FrameRing, PANORAMA_CHANNEL
+from .capture import V4L2Camera, create_camera
+from .geometry import CaptureMode
+from .managed_threading import Mailbox
 import select
 import cv2
 from collections import deque
+from functools import partial
 import os
-from threading import Thread, Event
-from time import sleep, time
+from threading import Thread, Event, Lock
+from time import time
 import numpy as np
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import logging
-from queue import Queue, Empty
 import ctypes
 
 libc = ctypes.cdll.LoadLibrary('libc.so.6')
@@ -32,9 +33,6 @@ with open(os.path.join(self.sysfs_path, "authorized"), "w") as fh:
     fh.write("0")
 """
 
-# TODO: why 4 channels
-BLANK = np.zeros((480, 320, 4), dtype=np.uint8)
-
 observer = Observer()
 observer.start()
 
@@ -51,16 +49,65 @@ class CaptureHotplugHandler(FileSystemEventHandler):
         self.grabber.wake.set()
 
 
+class Lease:
+    """
+    Consumer's hold on a captured frame. Frames in driver buffers are requeued to the driver
+    only once every lease on them is released, copied out frames hold no driver buffer.
+    Release with .release() or use as a context manager.
+    """
+
+    def __init__(self, frame, captured=None, sequence=None, release=None):
+        self.frame = frame
+        self.captured = captured  # Kernel timestamp (s)
+        self.sequence = sequence  # Kernel sequence number
+        self._release = release
+        self._lock = Lock()
+
+    def release(self):
+        with self._lock:
+            release, self._release = self._release, None
+        if release:
+            release()
+
+    def __enter__(self):
+        return self.frame
+
+    def __exit__(self, *exc):
+        self.release()
+
+
 class Grabber(Thread):
-    def __init__(self, device, fps=30, exposure=None, gain=None, saturation=None, name=None):
+    def __init__(self, device, fps=30, exposure=None, gain=None, saturation=None, name=None, buffers=4,
+                 lease_timeout=None, camera=None, min_backoff=0.1, max_backoff=5.0, resolution=(640, 480), crop=None):
+        """
+        Keyword arguments:
+        resolution -- Sensor width and height (px)
+        crop -- First and last (exclusive) YUYV column of the frame copied to the panorama, everything if omitted
+        min_backoff -- Delay before reopening a camera that failed to open (s), doubled on every failure
+        max_backoff -- Longest delay between attempts to reopen (s)
+        camera -- Capture backend from camera.capture, V4L2 device at /dev/v4l/by-path/device if omitted
+        buffers -- Number of driver buffers, more of them let consumers hold frames longer
+                   at the cost of latency as the driver queues frames in them
+        lease_timeout -- Once a consumer holds a frame this long (s) or the driver is about to
+                         run out of buffers, consumers get copies of the frames, never if None
+        """
         Thread.__init__(self)
         logger.info("Starting grabber for: %s", device)
-        self.path = os.path.join("/dev/v4l/by-path", device)
+        self.camera = camera or V4L2Camera(os.path.join("/dev/v4l/by-path", device), fps=fps, exposure=exposure,
+                                           gain=gain, saturation=saturation, buffers=buffers,
+                                           resolution=resolution)
+        self.path = self.camera.path
 
         self.fps = fps
         self.exposure = exposure
         self.gain = gain
         self.saturation = saturation
+        self.depth = buffers
+        self.lease_timeout = lease_timeout
+        self.crop = slice(*crop) if crop else slice(None)
+        self.leases = {}  # Buffers out of the driver by index: buffer, number of leases, dequeue time
+        self.lease_lock = Lock()
+        self.copied_count = 0  # Frames copied out as consumers held the buffers too long
 
         self.ready = Event()  # Used to tell consumers that new frame is available
         self.ready.clear()
@@ -73,16 +120,38 @@ class Grabber(Thread):
         self.daemon = True
         self.running = True  # Whether thread is running
         self.alive = False  # Whether frames are being captured
-        self.vd = 0  # Video capture descriptor
+        self.vd = None  # Opened capture device
+        self.tid = 0  # Kernel thread ID once started
+        self.dequeued = 0  # Time of the last VIDIOC_DQBUF
+        self.captured = None  # Kernel timestamp of the last frame, CLOCK_MONOTONIC (s)
+        self.sequence = None  # Kernel sequence number of the last frame
         self.latencies = deque(maxlen=10)
         self.timestamp = time()
         self.frame_count = 0
-        self.error_count = 0 if os.path.exists(self.path) else 1
+        self.error_count = 0 if self.camera.available() else 1
         self.dropped_count = 0
+        self.overwrite_count = 0  # Frames consumers never got as newer ones replaced them in the queue
+
+        # Recovery of the camera after it failed, the other cameras keep capturing meanwhile
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.retry_at = 0  # Time of the next attempt to reopen
+        self.died = None  # Time the camera stopped delivering frames
+        self.recovery_times = deque(maxlen=10)  # From failure to the first frame after reopening (s)
 
         self.queues = set()
         self.frame = None
-        if observer:
+
+        # Panorama slice the next frame is copied to, set by PanoramaGrabber
+        self.target = None
+        self.target_lock = Lock()
+        self.written = Event()  # Set once a frame is copied to the target
+        self.accept = None  # Called with capture timestamp, tells whether the frame replaces the one in target
+
+        if not self.camera.hotplug:
+            self.camera.attached = self.wake.set
+        elif observer:
             try:
                 observer.schedule(CaptureHotplugHandler(self), "/dev/v4l/by-path", recursive=False)
             except:
@@ -92,235 +161,182 @@ class Grabber(Thread):
 
     def get_queue(self):
         """
-        Create queue for new consumer
+        Create mailbox for new consumer
         """
-        q = Queue(maxsize=1)
-        self.queues.add(q)
-        return q
+        mailbox = Mailbox()
+        self.queues.add(mailbox)
+        return mailbox
 
     def open(self):
-        logger.info("Opening %s requesting %d fps", self.path, self.fps)
-        vd = open(os.path.realpath(self.path), 'rb+', buffering=0)
-
-        # Query camera capabilities
-        cp = v4l2_capability()
-        fcntl.ioctl(vd, VIDIOC_QUERYCAP, cp)
-        self.driver = "".join((chr(c) for c in cp.driver if c))
-
-        # logger.info("Disabling auto white balance for %s", self.path)
-        ctrl = v4l2_control()
-        ctrl.id = V4L2_CID_AUTO_WHITE_BALANCE
-        ctrl.value = 0
-        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        if self.saturation is not None:
-            # logger.info("Setting saturation for %s to %d", self.path, self.saturation)
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_SATURATION
-            ctrl.value = self.saturation
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        if self.exposure is not None:
-            # logger.info("Setting exposure for %s to %d", self.path, self.exposure)
-            # Disable auto exposure
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_EXPOSURE_AUTO
-            ctrl.value = V4L2_EXPOSURE_MANUAL
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-            # Set exposure manually
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_EXPOSURE
-            ctrl.value = self.exposure
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        else:
-            # Enable auto exposure
-            # logger.info("Setting auto exposure for %s", self.path)
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_EXPOSURE_AUTO
-            ctrl.value = V4L2_EXPOSURE_AUTO
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        # Flip camera horizontally
-        ctrl = v4l2_control()
-        ctrl.id = V4L2_CID_HFLIP
-        ctrl.value = 0
-        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        # Flip camera vertically
-        ctrl = v4l2_control()
-        ctrl.id = V4L2_CID_VFLIP
-        ctrl.value = 1
-        fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        if self.gain is not None:
-            # Disable autogain
-            # logger.info("Setting gain for %s to %d", self.path, self.gain)
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_AUTOGAIN
-            ctrl.value = 0
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-            # Set gain manually
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_GAIN
-            ctrl.value = self.gain
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        else:
-            # Enable autogain
-            # logger.info("Setting autogain for %s", self.path)
-            ctrl = v4l2_control()
-            ctrl.id = V4L2_CID_AUTOGAIN
-            ctrl.value = 1
-            fcntl.ioctl(vd, VIDIOC_S_CTRL, ctrl)
-
-        if self.fps is not None:
-            # Set framerate
-            parm = v4l2_streamparm()
-            parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-            parm.parm.capture.capability = V4L2_CAP_TIMEPERFRAME
-            fcntl.ioctl(vd, VIDIOC_G_PARM, parm)  # get current camera settings
-            parm.parm.capture.timeperframe.numerator = 1
-            parm.parm.capture.timeperframe.denominator = self.fps
-            fcntl.ioctl(vd, VIDIOC_S_PARM, parm)  # change camera capture settings
-
-        # Initalize mmap with multiple buffers
-        req = v4l2_requestbuffers()
-        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-        req.memory = V4L2_MEMORY_MMAP
-        req.count = 4  # nr of buffer frames
-        try:
-            fcntl.ioctl(vd, VIDIOC_REQBUFS, req)
-        except Exception as e:
-            vd.close()
-            raise e
-
-        self.buffers = []
-
-        # Setup buffers
-        for i in range(req.count):
-            buf = v4l2_buffer()
-            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-            buf.memory = V4L2_MEMORY_MMAP
-            buf.index = i
-            fcntl.ioctl(vd, VIDIOC_QUERYBUF, buf)
-            mm = mmap.mmap(vd.fileno(), buf.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
-                           offset=buf.m.offset)
-            self.buffers.append(mm)
-            fcntl.ioctl(vd, VIDIOC_QBUF, buf)
-
-        # Start streaming
-        fcntl.ioctl(vd, VIDIOC_STREAMON, v4l2_buf_type(V4L2_BUF_TYPE_VIDEO_CAPTURE))
-
-        # Wait cameras to get ready
-        t0 = time()
-        max_t = 1
-        ready_to_read, ready_to_write, in_error = ([], [], [])
-        while len(ready_to_read) == 0 and time() - t0 < max_t:
-            ready_to_read, ready_to_write, in_error = select.select([vd], [], [], max_t)
-        return vd
+        device = self.camera.open()
+        with self.lease_lock:
+            self.leases.clear()  # Leases on buffers of the previous device do not requeue anything
+        return device
 
     def run(self):
-        wait_count = 0
+        self.tid = libc.syscall(186)
         while self.running and is_running():
-            sleep(0.005)
             self.ready.clear()
 
-            if not self.vd:
-                # give some time for cameras to recover
-                sleep(0.1)
-                # Check if /dev/v4l/by-path/bla symlink exists
-                if not os.path.exists(self.path):
-                    logger.critical("Waiting for %s to become available", self.path)
-                    self.wake.wait(timeout=0.2)
-                    self.wake.clear()
-                    wait_count += 1
-                    if wait_count < 3:
-                        continue
-
-                else:
-                    try:
-                        self.vd = self.open()
-                    except OSError as e:
-                        logger.error("OSError: Failed to open: %s\n%s", self.path, e)
-                        self.vd = None
-                    except Exception as e:
-                        logger.error("Exception: Failed to open: %s\n%s", self.path, e)
-                        self.vd = None
-
-                if not self.vd:
-                    self.die("FUCK this")
-                    os.system('rosnode kill octocamera')
-
-            wait_count = 0
-            # get image from the driver queue
-            buf = v4l2_buffer()
-            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
-            buf.memory = V4L2_MEMORY_MMAP
+            if not self.vd and not self.reconnect(nonblocking=True):
+                # Hotplug handler cuts the wait short when the camera is plugged back in
+                self.wake.wait(timeout=max(self.retry_at - time(), 0.005))
+                continue
 
             try:
-                fcntl.ioctl(self.vd, VIDIOC_DQBUF, buf)  # deque from v4l
-                mm = self.buffers[buf.index]
-
-                self.frame = np.asarray(mm, dtype=np.uint8).reshape((480, 320, 4))
-
-                for output_queue in self.queues:
-                    try:
-                        output_queue.get_nowait()
-                    except Empty:
-                        pass
-                    finally:
-                        output_queue.put((self.frame,))
-
-                self.ready.set()
-                now = time()
-                delta = now - self.timestamp
-                if self.fps is not None:
-                    if delta > 2.0 / self.fps:
-                        self.dropped_count += 1
-                self.latencies.append(delta)
-                self.timestamp = now
-                self.alive = True
-                self.frame_count += 1
-                sleep(0.005)
-                fcntl.ioctl(self.vd, VIDIOC_QBUF, buf)  # requeue the buffer
-            except OSError:
-                self.die("Camera unplugged")
-                os.system('rosnode kill octocamera')
-                self.frame = None
-            except IOError:
+                # Woken by the driver as soon as a frame is ready, timeout to notice shutdown
+                if select.select([self.vd], [], [], 0.2)[0]:
+                    self.grab()
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                logger.error("%s failed: %s", self.path, e)
                 self.die("Camera unplugged")
-                os.system('rosnode kill octocamera')
-                logger.info("%s dropped frame!", self.path)
-                self.dropped_count += 1
-            except BaseException:
-                self.die("BaseException")
-                os.system('rosnode kill octocamera')
+            except Exception:
+                logger.exception("%s failed", self.path)
+                self.die("Exception")
 
         # Graceful shutdown
-        if self.vd:
-            fcntl.ioctl(self.vd, VIDIOC_STREAMOFF, v4l2_buf_type(V4L2_BUF_TYPE_VIDEO_CAPTURE))
         self.die("Graceful shutdown")
 
+    def reconnect(self, nonblocking=False):
+        """
+        Reopen the camera unless backing off after a failed attempt, return whether it succeeded.
+        The backoff doubles with every failure up to max_backoff, hotplug events end it early.
+        """
+        if time() < self.retry_at and not self.wake.is_set():
+            return False
+        self.wake.clear()
+        if self.connect(nonblocking):
+            return True
+        if self.died is None:
+            self.died = time()
+        self.retry_at = time() + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+        return False
+
+    def connect(self, nonblocking=False):
+        """
+        Open the capture device if it is plugged in, return whether it succeeded
+        """
+        if not self.camera.available():
+            logger.critical("Waiting for %s to become available", self.path)
+            return False
+        try:
+            self.vd = self.open()
+        except Exception as e:
+            logger.error("Failed to open: %s\n%s", self.path, e)
+            self.vd = None
+            return False
+        if nonblocking:
+            self.vd.set_blocking(False)
+        return True
+
+    def lease(self, index, vd):
+        """
+        Return release callback of a new lease on the dequeued buffer
+        """
+        with self.lease_lock:
+            self.leases[index][1] += 1
+        return partial(self.unlease, index, vd)
+
+    def unlease(self, index, vd):
+        """
+        Release a lease on the buffer, the last one hands the buffer back to the driver
+        """
+        with self.lease_lock:
+            held = self.leases.get(index)
+            if not held or held[0] is not vd:
+                return  # Device was reopened meanwhile
+            held[1] -= 1
+            if held[1]:
+                return
+            del self.leases[index]
+        if vd is self.vd:
+            try:
+                vd.requeue(index)  # requeue the buffer
+            except (OSError, ValueError):
+                pass  # Device died meanwhile
+
+    def starving(self, now):
+        """
+        Check whether consumers should get copies instead of leases: they have held
+        a buffer longer than the lease timeout or the driver is about to run out of buffers
+        """
+        if self.lease_timeout is None:
+            return False
+        with self.lease_lock:
+            held = [dequeued for _, count, dequeued in self.leases.values()]
+        return bool(held) and (len(held) >= self.depth - 2 or min(held) < now - self.lease_timeout)
+
+    def grab(self):
+        """
+        Dequeue a frame from the driver and copy it to the target. Consumers of .get_queue()
+        get (frame, lease) where frame is a view of the driver buffer, the buffer is requeued
+        once every lease is released.
+        """
+        # get image from the driver queue
+        vd = self.vd
+        index, self.frame, captured, sequence = vd.dequeue()
+        self.dequeued = time()
+        copy_out = self.queues and self.starving(self.dequeued)
+        with self.lease_lock:
+            self.leases[index] = [vd, 1, self.dequeued]  # Held by the grabber until consumers got theirs
+        # Frames skipped by the driver show up as gaps in the sequence, it restarts with streaming
+        if self.sequence is not None and sequence > self.sequence + 1:
+            self.dropped_count += sequence - self.sequence - 1
+        self.sequence = sequence
+        self.captured = captured
+        if self.died is not None:
+            self.recovery_times.append(self.dequeued - self.died)
+            logger.info("%s recovered in %.0fms", self.path, (self.dequeued - self.died) * 1000)
+            self.died = None
+            self.backoff = self.min_backoff
+
+        # The only copy of the frame, straight into the panorama being assembled
+        with self.target_lock:
+            if self.target is not None and (self.accept is None or self.accept(self.captured)):
+                self.target[...] = self.frame[:, self.crop]
+                self.written.set()
+
+        if copy_out:
+            copy = self.frame.copy()
+            self.copied_count += 1
+        for mailbox in self.queues:
+            if copy_out:
+                lease = Lease(copy, self.captured, self.sequence)
+            else:
+                lease = Lease(self.frame, self.captured, self.sequence, self.lease(index, vd))
+            stale = mailbox.put((lease.frame, lease))
+            if stale:
+                stale[1].release()
+                self.overwrite_count += 1
+
+        self.ready.set()
+        now = time()
+        delta = now - self.timestamp
+        self.latencies.append(delta)
+        self.timestamp = now
+        self.alive = True
+        self.frame_count += 1
+        self.unlease(index, vd)
+
     def die(self, reason):
         if self.vd:
-            fcntl.ioctl(self.vd, VIDIOC_STREAMOFF, v4l2_buf_type(V4L2_BUF_TYPE_VIDEO_CAPTURE))
             try:
                 self.vd.close()
             except:
                 pass
-            
+
         self.vd = None
+        if self.died is None:
+            self.died = time()
         self.alive = False
         self.error_count += 1
         self.frame = None
         self.ready.clear()
-        self.running = False
         # clear cached frames
         logger.info("%s dying because %s", self.path, reason)
-        sleep(0.1)
 
     def restart(self):
         self.die("restart")
@@ -337,15 +353,52 @@ class Grabber(Thread):
 
 
 class PanoramaGrabber(Thread):
-    def __init__(self, config):
+    def __init__(self, config, ring=None):
+        """
+        Keyword arguments:
+        config -- Camera config
+        ring -- shared.FrameRing the grabbers assemble panoramas into, four slot ring if omitted
+        """
         Thread.__init__(self)
         self.last_product = 0
+        self.sequence = -1
 
         global_config = config.prop("global")
         kwargs = dict((k, v) for k, v in global_config.items() if k in ("fps", "gain", "exposure", "saturation"))
+        self.mode = CaptureMode.from_config(config)
+        kwargs.update(fps=self.mode.fps, resolution=(self.mode.width, self.mode.height))
+        self.blank = np.zeros(self.mode.frame_shape, dtype=np.uint8)
+        lease_timeout = global_config.get("lease timeout")
+        lease_timeout = lease_timeout / 1000.0 if lease_timeout is not None else None
+        # "v4l2" for the cameras, "simulated" or "replay" to run without them
+        backend = global_config.get("capture backend", "v4l2")
         self.slaves = []
         for i in range(1, global_config.get("cameras", 0) + 1):
-            self.slaves.append(Grabber(config.get("camera%d" % i, {}).get("path"), name="camera%d" % i, **kwargs))
+            camera_config = config.get("camera%d" % i, {})
+            # Driver buffers per camera, latency traded against frames dropped while consumers hold them
+            buffers = camera_config.get("buffers", global_config.get("buffers", 4))
+            path = camera_config.get("path")
+            camera = create_camera(backend, i - 1, os.path.join("/dev/v4l/by-path", path or ""),
+                                   config.get("simulation"), buffers=buffers, **kwargs)
+            self.slaves.append(Grabber(path, name="camera%d" % i, buffers=buffers, lease_timeout=lease_timeout,
+                                       camera=camera, crop=self.mode.crop, **kwargs))
+
+        # Capture timestamps of the frames in the panorama being assembled
+        self.captured = np.full(len(self.slaves), np.nan)
+        self.captured_lock = Lock()
+        self.refreshed = Event()  # Set whenever a frame of the panorama being assembled is replaced
+        for index, slave in enumerate(self.slaves):
+            slave.accept = partial(self.accept, index)
+        self.period = 1.0 / self.mode.fps
+        # Panorama is published right away once capture times are this close (s)
+        self.sync_tolerance = global_config.get("sync tolerance", 2) / 1000.0
+        # Longest wait for the camera that captured earliest to deliver a closer frame (s), at most a frame period.
+        # Off by default as it costs panoramas without narrowing the spread when cameras are not in phase.
+        self.sync_wait = min(global_config.get("sync wait", 0) / 1000.0, self.period)
+        # Longest wait for live cameras that stopped delivering, the panorama is published without them (s)
+        self.stall_timeout = 0.2
+        self.skew = np.full(len(self.slaves), np.nan)  # Capture time of the last panorama relative to earliest (s)
+        self.spread = deque(maxlen=30)  # Capture time spread of the recent panoramas (s)
 
         self.tid = 0
         self.running = False
@@ -353,42 +406,70 @@ class PanoramaGrabber(Thread):
 
         self.latency = deque(maxlen=10)
         self.rate = deque(maxlen=10)
+        self.overwrite_count = 0  # Panoramas consumers never got as newer ones replaced them in the queue
 
         self.rotate = config.get("global", {}).get("rotate")
+        # "threads" runs a thread per camera, "epoll" captures from all cameras in this thread
+        self.engine = config.get("global", {}).get("capture engine", "threads")
+        self.publish_latency = deque(maxlen=30)  # From first VIDIOC_DQBUF of a panorama to publishing it
         self.queues = set()
-        self.input_queues = [slave.get_queue() for slave in self.slaves]  # [0].get_queue()
+        # Cameras followed by the first camera again for wraparound
+        self.ring = ring or FrameRing(PANORAMA_CHANNEL, 4, self.mode.panorama_shape,
+                                      stamps=len(self.slaves))
 
     def start(self):
-        for slave in self.slaves:
-            slave.start()
+        if self.engine != "epoll":
+            for slave in self.slaves:
+                slave.start()
         Thread.start(self)
 
     def get_queue(self, lossy=True):
         """
-        Create queue for new consumer
+        Create mailbox for new consumer, always lossy as capture can not wait for consumers
         """
-        q = Queue(maxsize=1)
-        self.queues.add(q)
-        return q
+        mailbox = Mailbox()
+        self.queues.add(mailbox)
+        return mailbox
 
-    def get_panorama(self):
+    def metrics(self):
         """
-        Return view of captured frames merged as one
+        Return capture rate, latency and spread of capture times of panoramas and counters of each camera,
+        times in milliseconds
         """
-        slaves = self.slaves + self.slaves[:1]
-        frames = [slave.frame if slave.alive else BLANK for slave in slaves]
+        def average(values):
+            return round(sum(values) * 1000 / len(values), 2) if values else None
 
-        if self.rotate:
-            return np.rot90(np.vstack(frames), 3).copy()
-        else:
-            return np.hstack(frames).copy()
+        cameras = {}
+        for slave in self.slaves:
+            cameras[slave.name] = dict(
+                alive=slave.alive,
+                frames=slave.frame_count,
+                dropped=slave.dropped_count,
+                copied=slave.copied_count,
+                errors=slave.error_count,
+                down=round((time() - slave.died) * 1000) if slave.died is not None else None,
+                recovery=round(slave.recovery_times[-1] * 1000) if slave.recovery_times else None)
+        return dict(
+            fps=round(len(self.rate) / sum(self.rate), 2) if self.rate else None,
+            latency=average(self.publish_latency),
+            spread=average(self.spread),
+            cameras=cameras)
+
+    def get_panorama(self):
+        """
+        Return view of the latest assembled panorama, frames stacked vertically
+        """
+        frame = self.ring.get(self.sequence) if self.sequence >= 0 else None
+        if self.rotate and frame is not None:
+            return np.rot90(frame, 3)
+        return frame
 
     def get_panorama_hsv(self):
         """
         Return view of captured frames merged as one
         """
         slaves = self.slaves + self.slaves[:1]
-        frames = [slave.hsv if slave.alive else BLANK for slave in slaves]
+        frames = [slave.hsv if slave.alive else self.blank for slave in slaves]
 
         if self.rotate:
             return np.rot90(np.vstack(frames), 3).copy()
@@ -400,7 +481,7 @@ class PanoramaGrabber(Thread):
         Return view of captured frames merged as one
         """
         half = len(self.slaves) >> 1
-        frames = [slave.frame if slave.alive else BLANK for slave in self.slaves]
+        frames = [slave.frame if slave.alive else self.blank for slave in self.slaves]
         if self.rotate:
             return np.vstack([
                 np.swapaxes(np.vstack(frames[:half]), 1, 0),
@@ -412,39 +493,209 @@ class PanoramaGrabber(Thread):
                 np.hstack(frames[half:])
             ])
 
+    def claim(self):
+        """
+        Claim next ring slot and point the grabbers to their slices of it
+        """
+        seq, slot = self.ring.claim()
+        lines = self.mode.lines
+        with self.captured_lock:
+            self.captured[:] = np.nan
+        for index, slave in enumerate(self.slaves):
+            with slave.target_lock:
+                slave.written.clear()
+                slave.target = slot[index * lines:(index + 1) * lines]
+        return seq, slot
+
+    def accept(self, index, timestamp):
+        """
+        Tell whether a frame captured at timestamp replaces the frame of the camera in the
+        panorama being assembled. Until every live camera has delivered the newest frame is kept,
+        after that a frame is taken only if it narrows the spread of capture times.
+        """
+        with self.captured_lock:
+            captured = self.captured
+            complete = all(not np.isnan(captured[i]) for i, slave in enumerate(self.slaves) if slave.alive)
+            previous = captured[index]
+            complete = complete and not np.isnan(previous)
+            spread = np.nanmax(captured) - np.nanmin(captured) if complete else None
+            captured[index] = timestamp
+            if complete and np.nanmax(captured) - np.nanmin(captured) >= spread:
+                captured[index] = previous
+                return False
+        self.refreshed.set()
+        return True
+
+    def synchronized(self):
+        """
+        Check whether the panorama being assembled is worth publishing: every live camera
+        has delivered and the spread of capture times can not be narrowed by the next frame
+        of the camera that captured earliest
+        """
+        live = [index for index, slave in enumerate(self.slaves) if slave.alive]
+        with self.captured_lock:
+            captured = self.captured[live]
+        if not len(captured) or np.isnan(captured).any():
+            return False
+        earliest = captured.argmin()
+        spread = captured.max() - captured[earliest]
+        if spread <= self.sync_tolerance or len(captured) < 2:
+            return True
+        captured[earliest] += self.period  # Expected capture time of its next frame
+        return captured.max() - captured.min() >= spread
+
+    def release(self, slot):
+        """
+        Detach grabbers from the slot, waiting for copies in progress, and complete the panorama
+        """
+        lines = self.mode.lines
+        for index, slave in enumerate(self.slaves):
+            with slave.target_lock:
+                slave.target = None
+                if not slave.written.is_set():
+                    slot[index * lines:(index + 1) * lines] = self.blank
+        slot[len(self.slaves) * lines:] = slot[:lines]
+
+    def publish(self, seq, slot):
+        """
+        Complete the panorama in the slot and pump it to consumers, they read the slot in place
+        """
+        self.release(slot)
+        with self.captured_lock:
+            captured = self.captured.copy()
+        for index, slave in enumerate(self.slaves):
+            if not slave.written.is_set():
+                captured[index] = np.nan  # Filled with blank
+        if self.ring.stamps is not None:
+            self.ring.stamps[seq % self.ring.slots] = captured
+        self.ring.commit(seq)
+        self.sequence = seq
+        if not np.isnan(captured).all():
+            self.skew = captured - np.nanmin(captured)
+            self.spread.append(np.nanmax(self.skew))
+
+        dequeued = [slave.dequeued for slave in self.slaves if slave.written.is_set()]
+        if dequeued:
+            self.publish_latency.append(time() - min(dequeued))
+
+        for mailbox in self.queues:
+            if mailbox.put((slot, seq)):
+                self.overwrite_count += 1
+            self.last_product = time()
+
     def run(self):
         self.tid = libc.syscall(186)
         logger.info("%s thread spawned with PID %d", self.__class__.__name__, self.tid)
         self.running = True
 
+        if self.engine == "epoll":
+            self.run_epoll()
+            return
+
+        seq, slot = self.claim()
         while self.running and is_running():
             then = time()
-            # Synchronize producers
-            products = [(queue.get() if slave.alive else (BLANK,)) for queue, slave in
-                        zip(self.input_queues, self.slaves)]
-            products.append(products[0])
+            # Synchronize producers, each of them copies its frame to the slot
+            stalled = then + self.stall_timeout
+            for slave in self.slaves:
+                if slave.alive:
+                    slave.written.wait(timeout=max(stalled - time(), 0))
+            # Give the cameras that captured earliest a while to catch up
+            deadline = time() + self.sync_wait
+            while self.sync_wait and not self.synchronized() and time() < deadline:
+                self.refreshed.wait(timeout=deadline - time())
+                self.refreshed.clear()
             then2 = time()
+            self.publish(seq, slot)
             now = time()
             self.latency.append(now - then2)
             self.rate.append(now - then)
+            seq, slot = self.claim()
 
-            stacked = np.vstack([frame for frame, in products])
-            # Pump panorama frames to consumers
-            for queue in self.queues:
+    def run_epoll(self):
+        """
+        Capture from all cameras in one loop, dequeue whichever camera is ready and
+        publish the panorama as soon as every live camera has delivered a fresh frame
+        """
+        epoll = select.epoll()
+        devices = {}  # File descriptor to grabber
+
+        def register(slave):
+            devices[slave.vd.fileno()] = slave
+            epoll.register(slave.vd.fileno(), select.EPOLLIN)
+
+        def disconnect(slave, reason):
+            fd = slave.vd.fileno()
+            epoll.unregister(fd)
+            del devices[fd]
+            slave.die(reason)
+
+        for slave in self.slaves:
+            if slave.reconnect(nonblocking=True):
+                register(slave)
+
+        seq, slot = self.claim()
+        then = time()
+        logged = then
+        complete = None  # Since when every live camera has delivered
+        while self.running and is_running():
+            # Cameras that stay open but stop delivering hold the panorama back until it stalls
+            for fd, events in epoll.poll(max(min(then + self.stall_timeout - time(), 0.2), 0)):
+                slave = devices[fd]
                 try:
-                    queue.get_nowait()
-                except Empty:
+                    slave.grab()
+                except BlockingIOError:
                     pass
-                finally:
-                    queue.put((stacked,))
-                self.last_product = time()
+                except OSError as e:
+                    logger.error("%s failed: %s", slave.path, e)
+                    disconnect(slave, "Camera unplugged")
+                except Exception:
+                    logger.exception("%s failed", slave.path)
+                    disconnect(slave, "Exception")
+
+            # Reopen failed cameras with backoff, hotplug observer wakes the grabbers of reattached ones
+            for slave in self.slaves:
+                if not slave.vd and slave.reconnect(nonblocking=True):
+                    register(slave)
+
+            live = [slave for slave in self.slaves if slave.alive]
+            ready = False
+            if live and all(slave.written.is_set() for slave in live):
+                # Give the cameras that captured earliest a while to catch up
+                complete = complete or time()
+                ready = not self.sync_wait or time() - complete >= self.sync_wait or self.synchronized()
+            if ready or time() - then >= self.stall_timeout:
+                complete = None
+                then2 = time()
+                try:
+                    self.publish(seq, slot)
+                except Exception:
+                    logger.exception("Publishing panorama %d failed", seq)
+                now = time()
+                self.latency.append(now - then2)
+                self.rate.append(now - then)
+                then = now
+                seq, slot = self.claim()
+
+            if time() - logged > 10 and self.publish_latency:
+                logged = time()
+                logger.info("Capturing %.1f fps, DQBUF to publish %.1fms, capture time spread %.1fms",
+                            len(self.rate) / sum(self.rate),
+                            sum(self.publish_latency) * 1000 / len(self.publish_latency),
+                            sum(self.spread) * 1000 / max(len(self.spread), 1))
+
+        # Graceful shutdown
+        for slave in list(devices.values()):
+            disconnect(slave, "Graceful shutdown")
+        epoll.close()
 
     def stop(self):
         self.running = False
         for slave in self.slaves:
             slave.stop()
         for slave in self.slaves:
-            slave.join()
+            if slave.is_alive():
+                slave.join()
 
 
 if __name__ == "__main__":
@@ -458,7 +709,7 @@ if __name__ == "__main__":
     queue = grabber.get_queue()
     try:
         while True:
-            yuyv, = queue.get()
+            yuyv, seq = queue.get()
             frame = np.swapaxes(cv2.cvtColor(yuyv.reshape((-1, 640, 2)), cv2.COLOR_YUV2BGR_YUYV), 0, 1)
             frame = cv2.resize(frame, (0, 0), fx=0.5, fy=0.5)
 
@@ -1,5 +1,7 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from time import time
-from typing import Tuple
+from typing import Optional, Tuple
 
 import cv2
 import cv2.aruco as aruco
@@ -7,7 +9,13 @@ import numpy as np
 import math
 import logging
 
-from shared import get_image_publisher
+from shared import BundleRing, RECOGNIZER_CHANNEL
+from .ball_tracker import BallTracker
+from .buffers import AllocationMeter, BufferPool
+from .color_lut import ColorClassifier, unpack
+from .field_edge import FieldEdge
+from .geometry import CaptureMode, PanoramaGeometry
+from .goal_finder import GoalFinder
 from .line_fit import goal_to_dist
 from .managed_threading import ManagedThread, ThreadManager
 
@@ -94,70 +102,130 @@ class PolarPoint(Point):
 
 
 class ImageRecognition:
+    # Columns of 640x480 capture, see CaptureMode
     GOAL_FIELD_DILATION = 50
     GOAL_BOTTOM = 200
     # Ball search scope vertically
     BALLS_BOTTOM = 300
-
-    def __init__(self, frame, camera_height=0.265, camera_mount_radius=0.07, dist_goals=4.6,
-                 camera_vert_fov=72, camera_horiz_fov=54, camera_config=None, color_config=None):
+    # Erosion of the ball mask and smallest blob kept as a ball, scaled down along with the capture
+    BALL_EROSION = 1
+    BALL_MIN_SIZE = 2
+
+    def __init__(self, frame=None, camera_height=0.265, camera_mount_radius=0.07, dist_goals=4.6,
+                 camera_vert_fov=72, camera_horiz_fov=54, camera_config=None, color_config=None, classifier=None,
+                 executor=None, ball_tracker=None, ball_limit=None, geometry=None, buffers=None, goal_finder=None,
+                 field_edge=None, mode=None):
         """
         Create image recognition object for 8-headed camera mount which internally
         tracks the state and corrects sensor readings
 
         Keyword arguments:
-        frame -- 320x4230 YUYV frame
+        frame -- YUYV panorama of the capture mode, 320x4320 by default, processed right away if given
         dist_goals -- Goal to goal distance
         camera_height -- Camera height from the floor (m)
         camera_mount_radius -- Camera distance from the center of the robot (m)
         camera_vert_fov -- Camera field of view vertically (deg)
         camera_horiz_fov -- Camera field of view horizontally (deg)
+        classifier -- Prebuilt ColorClassifier, built from color_config if omitted
+        executor -- Thread pool for processing camera slices in parallel, serial if omitted
+        ball_tracker -- BallTracker limiting ball detection to predicted windows, full scan if omitted
+        ball_limit -- Number of closest balls reported, all if omitted
+        geometry -- Prebuilt PanoramaGeometry, built from camera parameters if omitted
+        buffers -- BufferPool holding masks between frames, private pool if omitted
+        goal_finder -- GoalFinder locating goals on goal masks, default one if omitted
+        field_edge -- FieldEdge locating field edges on the field mask, default one if omitted
+        mode -- CaptureMode the panoramas are captured in, taken from camera_config if omitted
         """
         # unused currently
         self.robot = None
         self.orientation = None
 
         camera_config = camera_config or {}
-        color_config = color_config or {}
-        self.kicker_offset = camera_config.get('global', {}).get('kicker offset', 0)
+        self.mode = mode or CaptureMode.from_config(camera_config)
+        self.kicker_offset = self.mode.scale(camera_config.get('global', {}).get('kicker offset', 0))
+        # Panorama layout and search scopes in the coordinates of the capture mode
+        self.width = self.mode.panorama_width
+        self.lines = self.mode.lines
+        self.balls_bottom = self.mode.column(self.BALLS_BOTTOM)
+        self.goal_field_dilation = self.mode.scale(self.GOAL_FIELD_DILATION)
+        # No erosion at 320x240 where a distant ball is only a pixel or two wide
+        self.ball_erosion = self.mode.scale(self.BALL_EROSION)
+        self.ball_min_size = max(self.mode.scale(self.BALL_MIN_SIZE), 1)
+        self.classifier = classifier or ColorClassifier(color_config)
+        self.executor = executor
+        self.ball_tracker = ball_tracker
+        self.ball_limit = ball_limit
+        self.buffers = buffers or BufferPool()
+        self.goal_finder = goal_finder or GoalFinder(
+            min_area=self.mode.scale(10) ** 2, gap=self.mode.scale(8), max_span=3 * self.lines, width=self.width)
+        self.field_edge = field_edge or FieldEdge(
+            top=self.mode.column(30), bottom=self.mode.column(250), depth=self.balls_bottom,
+            cameras=self.mode.cameras, camera_width=self.lines)
+        # Per stage list of per camera processing times (s)
+        self.camera_timings = {}
+        # Per stage processing time of the whole frame (s)
+        self.stage_timings = {}
 
-        field = color_config.get("field", {})
-        ball = color_config.get("ball", {})
-        goal_A = color_config.get("goal A", {})
-        goal_B = color_config.get("goal B", {})
+        self.dist_goals = dist_goals
+        self.geometry = geometry or PanoramaGeometry(
+            self.kicker_offset, camera_height, camera_mount_radius, camera_vert_fov, camera_horiz_fov,
+            self.width, self.mode.width, 2 * self.mode.crop[0])
 
-        self.FIELD_LOWER, self.FIELD_UPPER = self.unpack(field)
-        self.BALL_LOWER, self.BALL_UPPER = self.unpack(ball)
-        self.BLUE_LOWER, self.BLUE_UPPER = self.unpack(goal_A)
-        self.YELLOW_LOWER, self.YELLOW_UPPER = self.unpack(goal_B)
+        if frame is not None:
+            self.process(frame)
 
-        self.dist_goals = dist_goals
-        self.camera_height = camera_height
-        self.camera_mount_radius = camera_mount_radius
-        self.camera_horiz_fov_rad = math.radians(camera_horiz_fov)
-        self.camera_vert_fov_rad = math.radians(camera_vert_fov)
+    @classmethod
+    def mask_layout(cls, mode):
+        """
+        Return shape and dtype of the masks recognized on panoramas of the capture mode by name
+        """
+        width, balls_bottom = mode.panorama_width, mode.column(cls.BALLS_BOTTOM)
+        goal = ((width, balls_bottom - mode.scale(cls.GOAL_FIELD_DILATION)), np.uint8)
+        return dict(field_mask=((width, mode.columns), np.uint8),
+                    balls_mask=((width + mode.lines, balls_bottom), np.uint8),
+                    goal_blue_mask=goal, goal_yellow_mask=goal)
 
+    def process(self, frame):
+        """
+        Recognize objects on the frame, masks of the previous frame are overwritten
+        as they live in the same preallocated buffers
+        """
+        self.camera_timings = {}
+        self.stage_timings = {}
+        start = time()
         self.frame = frame
+        # Label every pixel once, the recognition stages slice their masks from this
+        self.labels = self.classifier.classify(frame[:self.width, :self.balls_bottom], self.buffers)
+        start = self._stage("classify", start)
         # self.markers = self._recognize_markers()
         # print([ (id, round(dist))for id, dist in self.markers.items()])
 
-        self.field_mask, self.field_contours = self._recognize_field(self.FIELD_LOWER, self.FIELD_UPPER)
+        self.field_mask, self.field_contours, self.field_edge_dists = self._recognize_field()
+        start = self._stage("field", start)
 
-        self.goal_blue_mask, self.goal_blue, self.goal_blue_rect, self.goal_blue_width_deg = \
-            self._recognize_goal(self.BLUE_LOWER, self.BLUE_UPPER, ids=[10, 11])
-
-        self.goal_yellow_mask, self.goal_yellow, self.goal_yellow_rect, self.goal_yellow_width_deg = \
-            self._recognize_goal(self.YELLOW_LOWER, self.YELLOW_UPPER)
+        # Goals are independent of each other
+        (self.goal_blue_mask, self.goal_blue, self.goal_blue_rect, self.goal_blue_width_deg), \
+        (self.goal_yellow_mask, self.goal_yellow, self.goal_yellow_rect, self.goal_yellow_width_deg) = \
+            self._map(self._recognize_goal, ("goal A", "goal B"), ([10, 11], []))
+        start = self._stage("goals", start)
 
         # Calculate x and y coords on the field and angle to grid
         # self.robot, self.orientation = self._position_robot()
 
         self.balls_mask, self.balls = self._recognize_balls()
+        start = self._stage("balls", start)
         self.closest_edge, self.field_center, \
         self.goal_angle_adjust, self.h_bigger, self.h_smaller = self._recognize_closest_edge()
+        self._stage("closest edge", start)
+        return self
 
-        assert abs(self.x_to_deg(self.deg_to_x(50)) - 50) < 0.1, self.x_to_deg(self.deg_to_x(50))
-        assert abs(self.y_to_dist(self.dist_to_y(2.0)) - 2.0) < 0.1
+    def _stage(self, stage, start):
+        """
+        Record time since start for the stage and return current time for the next stage
+        """
+        now = time()
+        self.stage_timings[stage] = now - start
+        return now
 
     def serialize(self):
         return dict(
@@ -166,18 +234,12 @@ class ImageRecognition:
             goal_blue=self.goal_blue and self.goal_blue.serialize(),
             closest_edge=self.closest_edge and self.closest_edge.serialize(),
             goal_angle_adjust=[self.goal_angle_adjust, self.h_bigger, self.h_smaller],
-            field_contours=[cv2.boundingRect(hull) for hull in self.field_contours],
+            field_contours=self.field_contours,
             goal_yellow_rect=self.goal_yellow_rect,
             goal_blue_rect=self.goal_blue_rect,
         )
 
-    @staticmethod
-    def unpack(mapping):
-        luma = mapping['luma']
-        chroma_red = mapping['chroma red']
-        chroma_blue = mapping['chroma blue']
-        lower, upper = zip(luma, chroma_blue, luma, chroma_red)
-        return lower, upper
+    unpack = staticmethod(unpack)
 
     def _recognize_closest_edge(self) -> Tuple[PolarPoint, PolarPoint, float, int, int]:
         """
@@ -188,11 +250,9 @@ class ImageRecognition:
         dx = 0
         dy = 0
         y_map = {}
-        for index, hull in enumerate(self.field_contours[:8]):
-            y, x, h, w = cv2.boundingRect(hull)
-            y_map[index] = y * 2
+        for index, ((y, x, h, w), dist) in enumerate(zip(self.field_contours, self.field_edge_dists)):
+            y_map[index] = self.mode.full_y(y * 2)  # Edge height at 640x480 capture regardless of the crop
             rotation = (index - 4) * (math.pi * 2 / 8.0)
-            dist = self.y_to_dist(y * 2)
             if dist < closest_dist:
                 closest_dist = dist
                 closest_angle = rotation
@@ -274,43 +334,37 @@ class ImageRecognition:
         orientation_rad = (-rad_blue - self.goal_blue.angle_rad) % (2 * math.pi)
         return Point(robot_x, robot_y), orientation_rad
 
-    def _recognize_field(self, lower, upper):
-        slices = []
-        hulls = []
-        overlap = 20  # overlap between cameras
+    def _map(self, function, *iterables):
+        """
+        Apply function over camera slices, in parallel if thread pool is available
+        """
+        if self.executor:
+            return list(self.executor.map(function, *iterables))
+        return list(map(function, *iterables))
 
-        mask = cv2.inRange(self.frame[:3840], lower, upper)
-        mask = np.vstack([mask, mask[:overlap]])
-        mask[:, :30] = 0
-        mask[:, 300:] = 0
-        mask[:, 250:300] = 1
+    def _timed(self, stage, results):
+        """
+        Record per camera timings of a stage and strip them from the results
+        """
+        self.camera_timings[stage] = [elapsed for elapsed, _ in results]
+        return [result for _, result in results]
+
+    def _recognize_field(self):
+        """
+        Return field mask filled below the field edge, per camera bounding rectangles
+        of the field as (y, x, h, w) in the rotated mask and per camera distances to the edge
+        """
+        start = time()
+        mask = self.buffers.get("field color", self.labels.shape)
+        self.classifier.mask(self.labels, "field", dst=mask)
 
-        # iterate over cameras because otherwise convex hull wraps around distorted field edges
         # field edges are straight lines within single camera scope
-        for j in range(0, 9):
-            begin, end = j * 480 - overlap, (j + 1) * 480 + overlap
-            begin2, end2 = overlap, -overlap
-            if begin < 0:
-                begin = 0
-                begin2 = 0
-            if end > 4320:
-                end = 4320
-                end2 = 480 + overlap
-            roi = mask[begin:end, :]
-            _, contours, hierarchy = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contours = [c for c in contours if cv2.contourArea(c) > 30]
-            if contours:
-                merged = np.vstack(contours)  # merge contours
-                hull = cv2.convexHull(merged)  # get convex hull poly
-                cv2.drawContours(roi, [hull], 0, 9, -1)  # Fill in mask with convex hull
-                hulls.append(hull)
-            slices.append(roi[begin2:end2])
-        mask = np.vstack(slices)
-        mask = mask[:3840]
-
-        assert mask.shape == (3840, 320), "got instead %s" % repr(mask.shape)
-
-        return mask, hulls
+        field = self.buffers.get("field", (self.width, self.mode.columns))
+        field, tops = self.field_edge.find(mask, field, self.buffers)
+        dists = self.geometry.y_to_dist(tops * 2).tolist()
+        self.camera_timings["field"] = [time() - start]
+
+        return field, [(top, 0, self.balls_bottom - top, self.lines) for top in tops.tolist()], dists
 
     def _recognize_markers(self):
         markers = {}
@@ -344,197 +398,224 @@ class ImageRecognition:
         #     print(self.markers)
         return markers
 
-    def _recognize_goal(self, lower, upper, overlap=4, ids=[]):
+    def _recognize_goal(self, name, ids=[]):
         # Recognize goal
-        field = self.frame[:3840, :self.BALLS_BOTTOM - self.GOAL_FIELD_DILATION]
-        mask = cv2.inRange(field, lower, upper)
-
-        mask = cv2.erode(mask, None, iterations=3)
-        mask = cv2.bitwise_and(mask, self.field_mask[:, self.GOAL_FIELD_DILATION:self.BALLS_BOTTOM])
-        mask[:, :10] = 0
-        mask[:, 250:] = 0
-
-        rect = None
-        rects = []
-        cnts = []
-
-        # Iterate over cameras separately and generate mask for each camera
-        for j in range(0, 8):
-            roi = mask[j * 480:j * 480 + 480:]  # one camera
-            _, contours, hierarchy = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contours = [c for c in contours if cv2.contourArea(c) > 100]
-            if contours:
-                hull = cv2.convexHull(np.vstack(contours))
-                y, x, h, w = cv2.boundingRect(hull)
-                rect = (x + j * 480), 2 * y, w, h * 2
-                rects.append(rect)
-                cnts.append(hull)
-            else:
-                cnts.append(None)
-
-        # Add two copies of contours to deal with goal having wider angle of three cameras in total
-        for j in range(0, overlap):
-            cnts.append(cnts[j])
-
-        # Find widest contour spanning over three cameras
-        maxwidth = 0
-        for j in range(0, 11):
-            # stack contours of three cameras
-            contours = [c + (0, i * 480) for i, c in enumerate(cnts[j:j + 3]) if c is not None]
-            if not contours:
-                continue
-            merged = np.vstack(contours)
-            hull = cv2.convexHull(merged)  # get convex hull poly
-            y, x, h, w = cv2.boundingRect(hull)
-            if w > maxwidth:
-                maxwidth = w
-                rect = (x + j * 480), 2 * y, w, h * 2
-
-        # print(time() - start, 'time')
-        if maxwidth:
-            x, y, w, h = rect  # done
-            dist = goal_to_dist(y + h) / 100
+        start = time()
+        labels = self.labels[:, :self.balls_bottom - self.goal_field_dilation]
+        scratch = self.buffers.get(name + " scratch", labels.shape)
+        mask = self.buffers.get(name + " mask", labels.shape)
+        self.classifier.mask(labels, name, dst=scratch)
+
+        cv2.erode(scratch, None, dst=mask, iterations=3)
+        cv2.bitwise_and(mask, self.field_mask[:, self.goal_field_dilation:self.balls_bottom], dst=mask)
+        mask[:, :self.mode.column(10)] = 0
+        mask[:, self.mode.column(250):] = 0
+
+        # Goal candidates over the whole panorama, widest first
+        rects = self.goal_finder.find(mask, self.buffers.get(name + " profile", (self.width, 1), np.int32))
+        self.camera_timings[name] = [time() - start]
+
+        if rects:
+            x, y, w, h = rects[0]
+            dist = goal_to_dist(self.mode.full_y(y + h)) / 100
 
             # markers = [dist for id, dist in self.markers.items() if id in ids]
             # if markers:
             #     dist = sum(markers) / len(markers) / 100
-            return mask, PolarPoint(self.x_to_rad(x + w / 2.0) + math.radians(1), dist), rects, w * 360 / 3840.0
+            return mask, PolarPoint(self.x_to_rad(x + w / 2.0) + math.radians(1), dist), rects, w * 360.0 / self.width
         return mask, None, [], 0
 
     def _recognize_balls(self):
         """
         Return mask for balls and list of balls
         """
-        mask = cv2.inRange(self.frame[:3840, :self.BALLS_BOTTOM], self.BALL_LOWER, self.BALL_UPPER)
-        mask = cv2.erode(mask, None, iterations=1)
-        mask = cv2.bitwise_and(mask, self.field_mask[:3840, :self.BALLS_BOTTOM])
-        mask = np.vstack([mask, mask[:480]])
-        cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-        balls = set()
-        skipped = set()
-
-        for c in cnts:
-            y, x, h, w = cv2.boundingRect(c)
-
-            # Balls on the other side look tiny
-            if w < 2 or h < 2:
-                continue
-
-            # Adjust for the fact that we have 320 YUYV pixels
-            diameter = w if w > h else (h << 1)
-            radius = diameter >> 1
-            cx = x + (w >> 1)
-            cy = (y << 1) + h  # bottom half is really bad seen and reflects field color (h >> 1)
-
-            # TODO: is this dependent on the size?
-            relative = PolarPoint(self.x_to_rad(cx), self.y_to_dist(cy + radius), radius=radius, vx=cx, vy=cy)
-
-            # TODO: most likely we dont need suspicious logic anymore, as balls are thrown in a basket.
-            suspicious = False
-            # SkipFlag balls in blue goal
-            if self.goal_blue:
-                bx, by, bw, bh = self.goal_blue_rect[0]
-                if cx + radius > bx and cx - radius < bx + bw and cy + radius > by and cy - radius < by + bh:
-                    suspicious = True
-
-            # Flag balls in yellow goal
-            if self.goal_yellow:
-                yx, yy, yw, yh = self.goal_yellow_rect[0]
-                if cx + radius > yx and cx - radius < yx + yw and cy + radius > yy and cy - radius < yy + yh:
-                    suspicious = True
-            relative.suspicious = suspicious
+        windows = self.ball_tracker.windows() if self.ball_tracker else None
+        if windows is None:
+            scratch = self.buffers.get("balls scratch", self.labels.shape)
+            mask = self.buffers.get("balls mask", (self.width + self.lines, self.balls_bottom))
+            self.classifier.mask(self.labels, "ball", dst=scratch)
+            cv2.erode(scratch, None, dst=mask[:self.width], iterations=self.ball_erosion)
+            cv2.bitwise_and(mask[:self.width], self.field_mask[:self.width, :self.balls_bottom], dst=mask[:self.width])
+            mask[self.width:] = mask[:self.lines]
+            stats = self._contour_stats(mask)
+        else:
+            mask, stats = self._recognize_balls_windowed(windows)
+
+        # Statistics of all blobs at once, columns being x, y, w, h as in the rotated panorama
+        x, y, w, h = stats.T
+
+        # Balls on the other side look tiny
+        visible = (w >= self.ball_min_size) & (h >= self.ball_min_size)
+        x, y, w, h = x[visible], y[visible], w[visible], h[visible]
+
+        # Adjust for the fact that we have 320 YUYV pixels
+        diameter = np.where(w > h, w, h << 1)
+        radius = diameter >> 1
+        cx = x + (w >> 1)
+        cy = (y << 1) + h  # bottom half is really bad seen and reflects field color (h >> 1)
+
+        # TODO: is this dependent on the size?
+        angle = self.geometry.x_to_rad(cx)
+        dist = self.geometry.y_to_dist(cy + radius)
+
+        # TODO: most likely we dont need suspicious logic anymore, as balls are thrown in a basket.
+        suspicious = np.zeros(len(cx), dtype=bool)
+        # Flag balls in blue and yellow goal
+        for goal, goal_rect in ((self.goal_blue, self.goal_blue_rect), (self.goal_yellow, self.goal_yellow_rect)):
+            if goal:
+                gx, gy, gw, gh = goal_rect[0]
+                suspicious |= (cx + radius > gx) & (cx - radius < gx + gw) & (cy + radius > gy) & (cy - radius < gy + gh)
+
+        # TODO: better alghoritm to sort balls
+        # key=lambda b: b[0].dist + abs(b[0].angle_deg / 180) / 10,
+        order = np.argsort(dist, kind="stable")[:self.ball_limit]
 
+        balls = []
+        for i in order.tolist():
+            relative = PolarPoint(float(angle[i]), float(dist[i]), suspicious=bool(suspicious[i]),
+                                  radius=int(radius[i]), vx=int(cx[i]), vy=int(cy[i]))
             if self.robot and self.orientation:
                 absolute = relative.rotate(-self.orientation).translate(self.robot)
             else:
                 absolute = None
-            ball_coords = relative, absolute, cx, cy, radius
-            balls.add(ball_coords)
+            balls.append((relative, absolute, relative.vx, relative.vy, relative.radius))
 
-        # TODO: better alghoritm to sort balls
-        # return mask, sorted(
-        #     balls,
-        #     key=lambda b: b[0].dist + abs(b[0].angle_deg / 180) / 10,
-        # )
+        if self.ball_tracker:
+            self.ball_tracker.update([tuple(stat) for stat in stats[visible][order].tolist()], windows)
 
-        return mask, sorted(balls, key=lambda b: b[0].dist)
+        return mask, balls
 
-    def dist_to_y(self, d):
+    @staticmethod
+    def _blob_stats(mask, offset_x=0, offset_y=0, labels=None):
         """
-        Convert object distance to panorama image y coordinate
+        Return x, y, w, h of all blobs in the rotated mask as one array,
+        labels is optional int32 buffer of mask shape for the label image
         """
-        return int(640 * math.atan2(self.camera_height, d - self.camera_mount_radius) / (0.2 * 2 * math.pi))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask, labels, connectivity=8)
+        # Skip background label, OpenCV columns are left, top, width, height in the rotated image
+        stats = stats[1:, [cv2.CC_STAT_TOP, cv2.CC_STAT_LEFT, cv2.CC_STAT_HEIGHT, cv2.CC_STAT_WIDTH]]
+        return stats + (offset_x, offset_y, 0, 0)
 
-    def y_to_dist(self, y):
+    @staticmethod
+    def _contour_stats(mask):
         """
-        Convert panorama image y coordinate to distance
+        Return x, y, w, h of the outer blobs in the rotated mask as one array, tracing the contours
+        of a sparse mask takes a fraction of labeling every pixel of it
         """
-        j = math.tan(y * self.camera_vert_fov_rad / 640)
-        if j != 0:
-            return self.camera_height / j + self.camera_mount_radius
-        return 99999999  # infinity to prevent division by zero
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        # OpenCV rectangles are left, top, width, height in the rotated image
+        rects = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int32).reshape(-1, 4)
+        return rects[:, [1, 0, 3, 2]]
 
-    def deg_to_x(self, d, offset=None):
+    def _recognize_balls_windowed(self, windows):
+        """
+        Detect balls only within the windows predicted by the ball tracker,
+        windows are in the coordinates of the wrapped ball mask, 4320 rows by default
         """
-        Convert degrees from the kicker to panorama image x coordinate
+        mask = self.buffers.zeros("balls mask", (self.width + self.lines, self.balls_bottom))
+        scratch = self.buffers.get("balls scratch", self.labels.shape)
+        labels = self.buffers.get("balls labels", mask.shape, np.int32)
+        stats = [np.zeros((0, 4), dtype=np.int32)]
+        for x, y, w, h in windows:
+            roi = mask[x:x + w, y:y + h]
+            self.classifier.mask(self._wrapped_rows(self.labels, "ball window labels", x, y, w, h), "ball",
+                                 dst=scratch[:w, :h])
+            cv2.erode(scratch[:w, :h], None, dst=roi, iterations=self.ball_erosion)
+            cv2.bitwise_and(roi, self._wrapped_rows(self.field_mask, "ball window field", x, y, w, h), dst=roi)
+            stats.append(self._blob_stats(roi, x, y, labels=labels[:w, :h]))
+        return mask, np.vstack(stats)
+
+    def _wrapped_rows(self, image, name, x, y, w, h):
         """
-        d = d % 360
-        if d > 180: d -= 360
-        return int(d * 3840 / 360) + self.kicker_offset
+        Return window of a panorama mask in the wrapped coordinates of the ball mask, a view unless
+        the window crosses the end of the panorama when the two parts are copied into a pooled buffer
+        """
+        x %= self.width  # wraparound rows are copies of the first camera
+        if x + w <= self.width:
+            return image[x:x + w, y:y + h]
+        window = self.buffers.get(name, (self.width, self.balls_bottom), image.dtype)[:w, :h]
+        head = self.width - x
+        window[:head] = image[x:, y:y + h]
+        window[head:] = image[:w - head, y:y + h]
+        return window
+
+    def dist_to_y(self, d):
+        return self.geometry.dist_to_y(d)
+
+    def y_to_dist(self, y):
+        return self.geometry.y_to_dist(y)
+
+    def deg_to_x(self, d):
+        return self.geometry.deg_to_x(d)
 
     def x_to_deg(self, x):
-        d = (x - self.kicker_offset) * 360 / (3840)
-        return d % 360
+        return self.geometry.x_to_deg(x)
 
     def x_to_rad(self, x):
-        """
-        Convert panorama image x coordinate to angle in radians from the center of the image
-        (angle from the the kicker)
-        """
-        d = (x - self.kicker_offset) * (math.pi * 2) / (3840)
-        if d > math.pi:
-            d -= math.pi * 2
-        if d < -math.pi:
-            d += math.pi * 2
-        return d
+        return self.geometry.x_to_rad(x)
 
 
 class ImageRecognizer(ManagedThread):
     last_frame = None
 
-    def __init__(self, upstream_producer=None, framedrop=0, lossy=True, config_manager=None, publisher=None):
+    def __init__(self, upstream_producer=None, framedrop=0, lossy=True, config_manager=None, publisher=None,
+                 ring=None, bundles=None):
+        """
+        Keyword arguments:
+        ring -- shared.FrameRing the frames come from, for their capture timestamps and mask bundle slots
+        bundles -- shared.BundleRing created by the parent process for the masks, the recognizer
+                   creates its own when omitted
+        """
         super().__init__(upstream_producer, framedrop, lossy)
+        self.ring = ring
+        self.bundles = bundles  # Masks of the recognized frames for visualization
+        self.owns_bundles = bundles is None  # Other writers attach to the ring, only the owner recreates it
+        # Shape and dtype of the bundled frames by name
+        self.bundle_layout = bundles and dict(
+            (name, (frames.shape[1:], frames.dtype)) for name, frames in bundles.frames.items())
         self.camera_config = {}
         self.color_config = {}
+        self.classifier = None
+        self.executor = None
+        self.workers = 1
+        self.ball_tracker = None
+        self.camera_timings = {}
+        self.geometry = PanoramaGeometry()
+        self.mode = CaptureMode()
+        # Recognition and its buffers persist between frames, recreated when settings change
+        self.buffers = BufferPool()
+        self.recognition = None
+        self.allocated_bytes = None
         self.config_manager = config_manager
         self.publisher = publisher
         self.counter = 0
+        self.torn_count = 0  # Results dropped because the ring slot was reused
         self.refresh_config()
         self.roundtrip_start = time()
         self.silent = False
 
-        self.br_color = None
-        self.br_field_mask = None
-        self.br_balls_mask = None
-        self.br_goal_blue_mask = None
-        self.br_goal_yellow_mask = None
-
-    def broadcast(self, color: np.ndarray, field_mask: np.ndarray, balls_mask: np.ndarray, goal_blue_mask: np.ndarray,
-                  goal_yellow_mask: np.ndarray):
-        if self.br_color is None:
-            self.br_color = get_image_publisher("shm://recognizer-color", color.shape, color.dtype)
-            self.br_field_mask = get_image_publisher("shm://recognizer-field_mask", field_mask.shape, field_mask.dtype)
-            self.br_balls_mask = get_image_publisher("shm://recognizer-balls_mask", balls_mask.shape, balls_mask.dtype)
-            self.br_goal_blue_mask = get_image_publisher("shm://recognizer-goal_blue_mask", goal_blue_mask.shape,
-                                                         goal_blue_mask.dtype)
-            self.br_goal_yellow_mask = get_image_publisher("shm://recognizer-goal_yellow_mask", goal_yellow_mask.shape,
-                                                           goal_yellow_mask.dtype)
-
-        self.br_color[:, :, :] = color
-        self.br_field_mask[:, :] = field_mask
-        self.br_balls_mask[:, :] = balls_mask
-        self.br_goal_blue_mask[:, :] = goal_blue_mask
-        self.br_goal_yellow_mask[:, :] = goal_yellow_mask
+    def broadcast(self, seq: Optional[int], color: Optional[np.ndarray], field_mask: np.ndarray,
+                  balls_mask: np.ndarray, goal_blue_mask: np.ndarray, goal_yellow_mask: np.ndarray):
+        """
+        Copy masks to shared memory for visualization as one bundle, color frame is bundled only
+        if it does not come from the panorama ring already readable by other processes,
+        bundles of ring frames get the sequence number of the frame
+        """
+        frames = dict(field_mask=field_mask, balls_mask=balls_mask, goal_blue_mask=goal_blue_mask,
+                      goal_yellow_mask=goal_yellow_mask)
+        if color is not None:
+            frames["color"] = color
+
+        layout = dict((name, (frame.shape, frame.dtype)) for name, frame in frames.items())
+        if self.owns_bundles and (self.bundles is None or self.bundle_layout != layout):
+            slots = self.ring.slots if self.ring is not None else 4
+            self.bundles = BundleRing(RECOGNIZER_CHANNEL, slots, layout)
+            self.bundle_layout = layout
+        elif self.bundle_layout is not None and self.bundle_layout != layout:
+            logger.error("masks do not fit the shared ring of %s, not bundling them", self.bundles.channel)
+            self.bundle_layout = None
+        if self.bundle_layout == layout:
+            self.bundles.put(seq, **frames)
 
     def log_roundtrip(self):
         roundtrip = 1 / (time() - self.roundtrip_start)
@@ -542,31 +623,148 @@ class ImageRecognizer(ManagedThread):
         if not self.silent:
             self.publisher.logger.info_throttle(
                 2,
-                "fps:%.0f lat:%.2f roundtrip:%.2f" % (self.average_fps or 0, self.average_latency or 0, roundtrip))
+                "fps:%.0f lat:%.2f roundtrip:%.2f torn:%d" % (
+                    self.average_fps or 0, self.average_latency or 0, roundtrip, self.torn_count))
 
     def refresh_config(self, *_):
         logger.info("settings update received")
         if self.config_manager:
-            self.camera_config = self.config_manager.get_value('camera')
-            self.color_config = self.config_manager.get_value('color')
-
-    def step(self, frame):
-        r = ImageRecognition(
-            frame,
-            camera_config=self.camera_config,
-            color_config=self.color_config,
-        )
+            self.configure(self.config_manager.get_value('camera'), self.config_manager.get_value('color'))
+        else:
+            self.configure(self.camera_config, self.color_config)
 
-        self.counter += 1
-        self.broadcast(r.frame, r.field_mask, r.balls_mask, r.goal_blue_mask, r.goal_yellow_mask)
+    def configure(self, camera_config, color_config):
+        """
+        Apply camera and color settings, derived state is rebuilt only for what changed
+        """
+        # Geometry tables depend only on the capture mode and the kicker offset
+        mode = CaptureMode.from_config(camera_config)
+        if self.camera_config and mode != self.mode:
+            # Grabber, panorama ring and visualizer are laid out for the capture mode at startup
+            logger.error("capture mode can not change while running, restart required to apply it")
+            mode = self.mode
+        if mode != self.mode or mode.scale(camera_config.get('global', {}).get('kicker offset', 0)) != \
+                self.geometry.kicker_offset:
+            self.geometry = PanoramaGeometry.from_config(camera_config, mode=mode)
+            self.buffers = BufferPool()  # Buffers of the previous mode are of no use
+            self.mode = mode
+        self.camera_config = camera_config
+        # Lookup table is rebuilt only when color ranges actually change
+        if color_config and (self.classifier is None or color_config != self.color_config):
+            logger.info("color ranges changed, rebuilding lookup table")
+            self.classifier = ColorClassifier(color_config)
+        self.color_config = color_config
+
+        workers = self.camera_config.get('global', {}).get('recognition workers', 1)
+        if workers != self.workers:
+            logger.info("using %d recognition workers", workers)
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="recognition") if workers > 1 else None
+            self.workers = workers
+
+        full_scan_interval = self.camera_config.get('global', {}).get('ball full scan interval', 0)
+        if not full_scan_interval:
+            self.ball_tracker = None
+        elif not self.ball_tracker or self.ball_tracker.full_scan_interval != full_scan_interval:
+            logger.info("tracking balls with full scan every %d frames", full_scan_interval)
+            self.ball_tracker = BallTracker(full_scan_interval)
+        if self.ball_tracker:
+            self.ball_tracker.height = self.mode.panorama_shape[0]
+            self.ball_tracker.width = self.mode.column(ImageRecognition.BALLS_BOTTOM)
+
+        # Picked up by the next step, buffers are kept
+        self.recognition = None
+
+    def log_camera_timings(self, timings):
+        """
+        Keep running average of per camera processing times and log them periodically
+        """
+        for stage, elapsed in timings.items():
+            averages = self.camera_timings.setdefault(stage, [deque(maxlen=10) for _ in elapsed])
+            for average, value in zip(averages, elapsed):
+                average.append(value)
 
-        if self.publisher:
-            serialized = dict(**r.serialize(), fps=self.average_fps, lat=self.average_latency)
+        if not self.silent and self.publisher:
+            self.publisher.logger.info_throttle(
+                2,
+                "workers:%d per camera ms %s" % (self.workers, " ".join(
+                    "%s:[%s]" % (stage, ",".join("%.1f" % (sum(a) / len(a) * 1000) for a in averages))
+                    for stage, averages in self.camera_timings.items())))
+
+    def log_allocations(self, heap_bytes, pool_bytes):
+        """
+        Log bytes allocated while processing a frame, heap is measured only when
+        allocation tracing is enabled as tracemalloc slows everything down
+        """
+        self.allocated_bytes = heap_bytes
+        if not self.silent and self.publisher:
+            self.publisher.logger.info_throttle(
+                2,
+                "allocated per frame heap:%s pool:%dB buffers:%.1fMB" % (
+                    "-" if heap_bytes is None else "%dB" % heap_bytes, pool_bytes, self.buffers.nbytes / 1e6))
+
+    def recognize(self, frame, seq=None) -> ImageRecognition:
+        """
+        Run recognition on the frame and broadcast the masks, returned recognition
+        is reused for the next frame. Frames with sequence number live in the panorama ring.
+        """
+        r = self.recognition
+        if r is None:
+            r = self.recognition = ImageRecognition(
+                camera_config=self.camera_config,
+                color_config=self.color_config,
+                classifier=self.classifier,
+                executor=self.executor,
+                ball_tracker=self.ball_tracker,
+                ball_limit=self.camera_config.get('global', {}).get('ball limit'),
+                geometry=self.geometry,
+                buffers=self.buffers,
+                mode=self.mode,
+            )
+
+        pool_bytes = self.buffers.allocated_bytes
+        if self.camera_config.get('global', {}).get('trace allocations'):
+            with AllocationMeter() as meter:
+                r.process(frame)
+            heap_bytes = meter.peak_bytes
+        else:
+            r.process(frame)
+            heap_bytes = None
+
+        self.counter += 1
+        self.log_allocations(heap_bytes, self.buffers.allocated_bytes - pool_bytes)
+        self.log_camera_timings(r.camera_timings)
+        self.broadcast(seq, r.frame if seq is None else None, r.field_mask, r.balls_mask, r.goal_blue_mask,
+                       r.goal_yellow_mask)
+        return r
+
+    def step(self, frame, seq=None):
+        r = self.recognize(frame, seq)
+        if seq is not None and self.ring is not None and not self.ring.valid(seq):
+            # Grabber reused the slot while it was recognized, the result mixes two panoramas
+            self.torn_count += 1
+        elif self.publisher:
+            skew = self.ring.skew(seq) if self.ring is not None and seq is not None else None
+            serialized = dict(**r.serialize(), fps=self.average_fps, lat=self.average_latency, seq=seq, skew=skew)
             self.publisher.command(**serialized)
 
         self.log_roundtrip()
 
 
+def rgb_to_yuyv(frame):
+    """
+    Convert recorded RGB panorama to YUYV frame as it comes from the cameras
+    """
+    rotated = np.rot90(frame, 1).copy()
+    yuv = cv2.cvtColor(rotated[:3840], cv2.COLOR_RGB2YCR_CB)
+    y, u, v = np.dsplit(yuv, 3)
+    y = y[:, ::2]
+    u = u[:, ::2]
+    v = v[:, ::2]
+    return np.dstack([y, u, y, v])
+
+
 class Player(ManagedThread):
     """
     Player thread reads RGB frames from a video file and converts them to YUYV frames
@@ -581,14 +779,7 @@ class Player(ManagedThread):
         if not succ:
             self.disable()
             return
-        rotated = np.rot90(frame, 1).copy()
-        yuv = cv2.cvtColor(rotated[:3840], cv2.COLOR_RGB2YCR_CB)
-        y, u, v = np.dsplit(yuv, 3)
-        y = y[:, ::2]
-        u = u[:, ::2]
-        v = v[:, ::2]
-        yuyv = np.dstack([y, u, y, v])
-        self.produce(yuyv)
+        self.produce(rgb_to_yuyv(frame))
 
 
 class Shower(ManagedThread):
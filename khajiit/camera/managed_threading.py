@@ -1,49 +1,238 @@
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock
 import logging
 
 logger = logging.getLogger("threading")
 from collections import deque
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 import ctypes
 
 libc = ctypes.cdll.LoadLibrary('libc.so.6')
 from time import sleep, time
+import os
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")  # Units of CPU times in /proc
+
+
+class Mailbox:
+    """
+    Single slot handing the latest value from a producer to one consumer.
+
+    Every value put gets the next sequence number, the consumer takes values newer
+    than the one it took last, older ones it never got count as overwrites.
+    Putting and taking is a single lock round trip with a condition variable to wake
+    the consumer, where Queue(maxsize=1) needs get_nowait() and put() on the producer side
+    each notifying its own conditions. Lossless mailboxes make the producer wait
+    until the consumer has taken the previous value instead.
+    """
+
+    def __init__(self, lossy=True):
+        self.lossy = lossy
+        self.condition = Condition(Lock())
+        self.value = None
+        self.sequence = -1  # Sequence number of the value in the slot
+        self.taken = -1  # Sequence number of the value the consumer took last
+        self.overwrite_count = 0
+
+    def put(self, value, timeout=None):
+        """
+        Replace the value in the slot and wake the consumer, return the replaced value
+        if the consumer never got it, None otherwise. Lossless mailbox raises queue.Full
+        if the consumer does not take the previous value in timeout seconds.
+        """
+        with self.condition:
+            stale = None
+            if self.sequence > self.taken:
+                if self.lossy:
+                    stale = self.value
+                    self.overwrite_count += 1
+                elif not self.condition.wait_for(lambda: self.sequence == self.taken, timeout):
+                    raise Full
+            self.value = value
+            self.sequence += 1
+            self.condition.notify_all()
+            return stale
+
+    def wait_newer(self, sequence, timeout=None):
+        """
+        Return sequence number and value once the slot holds a value newer than sequence,
+        raise queue.Empty if none arrives in timeout seconds
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > sequence, timeout):
+                raise Empty
+            self.taken = self.sequence
+            if not self.lossy:
+                self.condition.notify_all()
+            return self.sequence, self.value
+
+    def get(self, block=True, timeout=None):
+        """
+        Return value newer than the one taken last, same as Queue.get()
+        """
+        return self.wait_newer(self.taken, timeout if block else 0)[1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+def cpu_time(tid):
+    """
+    Return CPU time the thread of this process has spent in user and kernel mode (s)
+    """
+    with open("/proc/self/task/%d/stat" % tid) as fh:
+        # Fields after the parenthesized command name, which may contain spaces, start from the state
+        fields = fh.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
 
 
 class ThreadManager(Thread):
-    def __init__(self):
+    """
+    Supervise pipeline threads: once per interval compute frame rate, latency and
+    utilization (share of time spent in .step()) of every thread along with the CPU time
+    it used, warn about threads choking on their input and the stage bottlenecking the pipeline.
+
+    Threads are pinned to the cores configured for their class as soon as they have started,
+    threads of a panorama grabber capturing in a thread per camera are pinned along with it
+    as they start, pinning that failed is retried on the next sample.
+    """
+
+    def __init__(self, interval=1.0, affinity=None, warn_interval=10.0):
+        """
+        Keyword arguments:
+        interval -- Time between samples (s)
+        affinity -- Cores by thread class name, e.g. {"ImageRecognizer": [2, 3]}
+        warn_interval -- Shortest time between repeated warnings about the same thread (s)
+        """
         Thread.__init__(self)
         self.daemon = True
         self.threads = set()
+        self.interval = interval
+        self.affinity = affinity or {}
+        self.warn_interval = warn_interval
+        self.warned = {}  # Time of the last warning by thread, or thread and PID
+        self.pinned = {}  # Thread ids pinned so far by thread
+        self.cpu_times = {}  # CPU time of the previous sample by thread
+        self.sampled = None  # Time of the previous sample
+        self.names = {}  # Name of the thread in stats and warnings by thread
+        self.stats = {}  # Stats of the latest sample by thread name
+        self.running = False
+        self.wake = Event()
 
     def register(self, thread):
+        """
+        Supervise the thread, it is named after its class with a number appended
+        to the second and later instances of the same class
+        """
+        if thread in self.threads:
+            return
+        name = thread.__class__.__name__
+        instances = sum(1 for other in self.threads if other.__class__ is thread.__class__)
+        self.names[thread] = "%s%d" % (name, instances + 1) if instances else name
         self.threads.add(thread)
 
+    def pin(self, thread):
+        """
+        Restrict the thread and its slaves to the cores configured for its class,
+        thread ids are remembered only once pinned so the ones that failed
+        or were not known yet are tried again on the next call
+        """
+        cores = self.affinity.get(thread.__class__.__name__)
+        if not cores:
+            return
+        name = self.names[thread]
+        pinned = self.pinned.setdefault(thread, set())
+        for tid in [thread.tid] + [slave.tid for slave in getattr(thread, "slaves", ()) if slave.tid]:
+            if tid in pinned:
+                continue
+            try:
+                os.sched_setaffinity(tid, cores)
+            except OSError as e:
+                self.warn((thread, tid), "Failed to pin %s thread (PID %d) to cores %s: %s", name, tid, cores, e)
+                continue
+            pinned.add(tid)
+            logger.info("%s thread (PID %d) pinned to cores %s", name, tid, cores)
+
+    def warn(self, thread, message, *args):
+        now = time()
+        if now - self.warned.get(thread, 0) >= self.warn_interval:
+            self.warned[thread] = now
+            logger.warning(message, *args)
+
+    def sample(self):
+        """
+        Return stats of every registered thread since the previous sample
+        """
+        now = time()
+        elapsed = now - self.sampled if self.sampled else None
+        self.sampled = now
+
+        stats = {}
+        for thread in self.threads:
+            name = self.names[thread]
+            entry = dict(tid=thread.tid or None, state="not started", fps=None, latency=None, utilization=None,
+                         cpu=None, cores=None)
+            stats[name] = entry
+            if not thread.tid:
+                continue
+            self.pin(thread)
+            try:
+                entry["cores"] = sorted(os.sched_getaffinity(thread.tid))
+                used = cpu_time(thread.tid)
+            except OSError:
+                continue  # Thread has exited
+            previous = self.cpu_times.get(thread)
+            self.cpu_times[thread] = used
+            if previous is not None and elapsed:
+                entry["cpu"] = round((used - previous) * 100 / elapsed)
+
+            if not thread.running:
+                entry["state"] = "stopped"
+            elif not thread.alive:
+                entry["state"] = "disabled"
+            elif now - max(thread.last_product, getattr(thread, "last_step", 0)) < 1.0 and len(thread.rate) > 0:
+                fps = len(thread.rate) / sum(thread.rate)
+                latency = sum(thread.latency) / len(thread.latency)
+                entry.update(state="running", fps=round(fps, 2), latency=round(latency * 1000, 2),
+                             utilization=round(latency * 100 * fps))
+                if entry["utilization"] > 99:
+                    entry["state"] = "choking"
+                    self.warn(thread, "%s thread (PID %d) gets %.2f fps, %.1fms latency, choking",
+                              name, thread.tid, fps, latency * 1000)
+            else:
+                entry["state"] = "stuck"
+                self.warn(thread, "%s thread (PID %d) stuck", name, thread.tid)
+        self.bottleneck(stats)
+        self.stats = stats
+        return stats
+
+    def bottleneck(self, stats):
+        """
+        Warn about the running thread that limits the frame rate of the whole pipeline:
+        it runs slower than the fastest stage as it spends nearly all its time processing
+        or keeps a core busy on its own
+        """
+        running = dict((name, entry) for name, entry in stats.items() if entry["fps"])
+        if len(running) < 2:
+            return
+        slowest = min(running, key=lambda name: running[name]["fps"])
+        entry = running[slowest]
+        fastest = max(entry["fps"] for entry in running.values())
+        busy = entry["utilization"] >= 90 or (entry["cpu"] or 0) >= 90
+        if busy and entry["fps"] < 0.9 * fastest:
+            thread = next(thread for thread in self.threads if self.names[thread] == slowest)
+            self.warn(thread, "%s thread (PID %d) is the bottleneck of the pipeline, %.1f fps of %.1f fps "
+                              "at %d%% utilization and %s%% CPU", slowest, entry["tid"], entry["fps"], fastest,
+                      entry["utilization"], entry["cpu"])
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
     def run(self):
-        while False:
-            sleep(1)
-            now = time()
-            for thread in self.threads:
-                if not thread.tid:
-                    continue
-                if thread.running:
-                    if thread.alive:
-                        if now - thread.last_product < 1.0 and len(thread.rate) > 0:
-                            fps = len(thread.rate) / sum(thread.rate)
-                            latency = sum(thread.latency) / len(thread.latency)
-                            utilization = latency * 100 * fps
-                            if utilization > 99:
-                                logger.warn("%s thread (PID %d) gets %.2f fps, %.1fms latency, choking",
-                                            thread.__class__.__name__, thread.tid, fps, latency * 1000)
-                            else:
-                                logger.info("%s thread (PID %d) gets %.2f fps, %.1fms latency, %d%% utilization",
-                                            thread.__class__.__name__, thread.tid, fps, latency * 1000, utilization)
-                        else:
-                            logger.info("%s thread (PID %d) stuck", thread.__class__.__name__, thread.tid)
-                    else:
-                        logger.info("%s thread (PID %d) not enabled", thread.__class__.__name__, thread.tid)
-                else:
-                    logger.info("%s thread not started yet", thread.__class__.__name__)
+        self.running = True
+        while self.running:
+            self.sample()
+            self.wake.wait(max(self.interval - (time() - self.sampled), 0))
 
 
 class ManagedThread(Thread):
@@ -57,14 +246,16 @@ class ManagedThread(Thread):
         self.alive = False
         self.latency = deque(maxlen=10)
         self.rate = deque(maxlen=10)
-        self.queues = set()  # Consumer queues
+        self.queues = set()  # Consumer mailboxes
         self.framedrop = framedrop
         self.subscribers = set()
         self.last_product = 0
+        self.last_step = 0  # Time the last .step() returned, consumers at the end of the pipeline produce nothing
+        self.overwrite_count = 0  # Products consumers never got as newer ones replaced them in lossy queues
 
         if upstream_producer:
             if hasattr(upstream_producer, "get_queue"):
-                self.queue = upstream_producer.get_queue(lossy)  # Queue of frames
+                self.queue = upstream_producer.get_queue(lossy)  # Mailbox of frames
                 self.args = ()
             else:
                 self.queue = None
@@ -74,22 +265,18 @@ class ManagedThread(Thread):
             self.args = ()
 
     def produce(self, *args):
-        for output_queue, lossy in self.queues:
-            if lossy:
-                try:
-                    output_queue.get_nowait()
-                except Empty:
-                    pass
-            output_queue.put(args)
+        for mailbox in self.queues:
+            if mailbox.put(args) is not None:
+                self.overwrite_count += 1
         self.last_product = time()
 
     def get_queue(self, lossy=True):
         """
-        Create queue for new consumer
+        Create mailbox for new consumer
         """
-        q = Queue(maxsize=1)
-        self.queues.add((q, lossy))
-        return q
+        mailbox = Mailbox(lossy)
+        self.queues.add(mailbox)
+        return mailbox
 
     def enable(self):
         self.alive = True
@@ -156,4 +343,74 @@ class ManagedThread(Thread):
                 now = time()
                 self.latency.append(now - then2)
                 self.rate.append(now - then)
+                self.last_step = now
             self.on_disabled()
+
+
+if __name__ == "__main__":
+    """
+    Compare hop latency of Queue(maxsize=1) with get_nowait()/put() against Mailbox
+    in a pipeline of threads passing timestamps, usage:
+    python3 -m camera.managed_threading [stages] [hops]
+    """
+    import sys
+
+    import numpy as np
+
+    class QueueBox:
+        """
+        Latest value wins the way producers used Queue(maxsize=1) before Mailbox
+        """
+
+        def __init__(self):
+            self.queue = Queue(maxsize=1)
+            self.overwrite_count = 0
+
+        def put(self, value):
+            try:
+                self.queue.get_nowait()
+                self.overwrite_count += 1
+            except Empty:
+                pass
+            self.queue.put(value)
+
+        def get(self):
+            return self.queue.get()
+
+    def measure(factory, stages, hops, interval=0.0005):
+        boxes = [factory() for _ in range(stages + 1)]
+        latencies = []
+
+        def relay(inbox, outbox):
+            while True:
+                sent = inbox.get()
+                outbox.put(sent)
+                if sent is None:
+                    break
+
+        for inbox, outbox in zip(boxes, boxes[1:]):
+            Thread(target=relay, args=(inbox, outbox), daemon=True).start()
+
+        def drain():
+            while True:
+                sent = boxes[-1].get()
+                if sent is None:
+                    break
+                latencies.append((time() - sent) / stages)
+
+        consumer = Thread(target=drain)
+        consumer.start()
+        for _ in range(hops):
+            boxes[0].put(time())
+            sleep(interval)
+        boxes[0].put(None)
+        consumer.join()
+        return np.array(latencies) * 1e6, sum(box.overwrite_count for box in boxes)
+
+    stages = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    hops = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    for name, factory in ("Queue", QueueBox), ("Mailbox", Mailbox):
+        latencies, overwrites = measure(factory, stages, hops)
+        print("%-8s hop latency p50 %6.1fus p90 %6.1fus p99 %6.1fus, %d of %d values overwritten" % (
+            name, np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99),
+            overwrites, hops))
@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+from collections import deque
+from threading import Lock, Thread
+from time import time
+
+from shared import BundleRing, FrameRing, RECOGNIZER_CHANNEL
+from .geometry import CaptureMode
+from .image_recognition import ImageRecognition, ImageRecognizer
+from .managed_threading import ManagedThread
+
+logger = logging.getLogger("recognition_farm")
+
+
+def recognition_worker(index, channel, tasks, results):
+    """
+    Recognize frames of the ring in a worker process. Tasks are ("frame", seq) for frames
+    and ("config", camera_config, color_config) for settings, results are (index, seq, serialized)
+    where serialized is None if the frame was overwritten before it got recognized
+    """
+    ring = FrameRing(channel)
+    # Masks ring is created by the farm, workers only write their slots
+    recognizer = ImageRecognizer(ring=ring, bundles=BundleRing(RECOGNIZER_CHANNEL))
+    recognizer.silent = True
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == "config":
+            recognizer.configure(*task[1:])
+            continue
+
+        _, seq = task
+        serialized = None
+        frame = ring.get(seq)
+        if frame is not None:
+            r = recognizer.recognize(frame, seq)
+            if ring.valid(seq):
+                serialized = r.serialize()
+        results.put((index, seq, serialized))
+
+
+class RecognitionFarm(ManagedThread):
+    """
+    Recognize panoramas in worker processes so that recognition does not compete for
+    the GIL with the grabbers. Frames travel through a shared memory ring and only their
+    sequence numbers through queues. Frames are handed to the workers in turns,
+    busy workers are skipped and frames are dropped only if all of them are busy.
+    Results are published in the order of the frames. Masks ring for visualization is created
+    here before the workers are forked, workers attach to it and write the slots of their frames.
+    """
+
+    def __init__(self, upstream_producer, ring, processes=2, config_manager=None, publisher=None):
+        """
+        Keyword arguments:
+        upstream_producer -- PanoramaGrabber writing to the ring
+        ring -- shared.FrameRing holding more slots than there are processes
+        processes -- Number of worker processes
+        """
+        super().__init__(upstream_producer)
+        self.ring = ring
+        self.config_manager = config_manager
+        self.publisher = publisher
+        self.silent = False
+
+        self.lock = Lock()
+        self.in_flight = [0] * processes  # Frames being recognized per worker
+        self.order = deque()  # Dispatched frames waiting to be published
+        self.pending = {}  # Results that arrived ahead of their turn
+        self.dispatched = {}  # Dispatch time of frames
+        self.latencies = deque(maxlen=10)
+        self.dropped_count = 0
+        self.torn_count = 0
+        self.mode = None  # Capture mode the masks ring is laid out for, fixed at startup
+        self.bundles = None  # shared.BundleRing of the masks
+
+        # Workers are forked in .start(), before any frames are grabbed
+        context = multiprocessing.get_context("fork")
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for _ in range(processes)]
+        self.processes = [
+            context.Process(target=recognition_worker, args=(index, ring.channel, tasks, self.results),
+                            name="recognition%d" % index, daemon=True)
+            for index, tasks in enumerate(self.tasks)]
+        self.collector = Thread(target=self.collect, name="recognition collector", daemon=True)
+        self.refresh_config()
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.collector.start()
+        super().start()
+
+    def stop(self):
+        super().stop()
+        for tasks in self.tasks:
+            tasks.put(None)
+
+    def refresh_config(self, *_):
+        logger.info("settings update received")
+        camera_config = dict(self.config_manager.get_value('camera')) if self.config_manager else {}
+        mode = CaptureMode.from_config(camera_config)
+        if self.mode is None:
+            # Created before the workers are forked, they attach to it by the channel name
+            self.bundles = BundleRing(RECOGNIZER_CHANNEL, self.ring.slots, ImageRecognition.mask_layout(mode))
+            self.mode = mode
+        elif mode != self.mode:
+            # Workers keep the capture mode of the rings as well
+            logger.error("capture mode can not change while running, restart required to apply it")
+        if not self.config_manager:
+            return
+        color_config = dict(self.config_manager.get_value('color'))
+        for tasks in self.tasks:
+            tasks.put(("config", camera_config, color_config))
+
+    def step(self, frame, seq=None):
+        with self.lock:
+            for offset in range(len(self.processes)):
+                index = (seq + offset) % len(self.processes)
+                if not self.in_flight[index]:
+                    break
+            else:
+                self.dropped_count += 1
+                return
+            self.in_flight[index] += 1
+            self.order.append(seq)
+            self.dispatched[seq] = time()
+        self.tasks[index].put(("frame", seq))
+
+    def collect(self):
+        """
+        Receive results from the workers and publish them in the order of frames
+        """
+        while True:
+            index, seq, serialized = self.results.get()
+            ready = []
+            with self.lock:
+                self.in_flight[index] -= 1
+                self.pending[seq] = serialized
+                # Worker died while holding the oldest frame, give up on it
+                if len(self.pending) > 2 * len(self.processes) and self.order[0] not in self.pending:
+                    lost = self.order.popleft()
+                    self.dispatched.pop(lost, None)
+                    logger.error("result of frame %d lost", lost)
+                while self.order and self.order[0] in self.pending:
+                    seq = self.order.popleft()
+                    ready.append((seq, self.pending.pop(seq), self.dispatched.pop(seq)))
+
+            for seq, serialized, dispatched in ready:
+                self.publish(seq, serialized, dispatched)
+
+    def publish(self, seq, serialized, dispatched):
+        if serialized is None:
+            self.torn_count += 1
+            return
+        self.latencies.append(time() - dispatched)
+        latency = sum(self.latencies) / len(self.latencies)
+        if self.publisher:
+            self.publisher.command(**serialized, fps=self.average_fps, lat=latency, seq=seq, skew=self.ring.skew(seq))
+            if not self.silent:
+                self.publisher.logger.info_throttle(
+                    2, "processes:%d fps:%.0f lat:%.2f dropped:%d torn:%d" % (
+                        len(self.processes), self.average_fps or 0, latency, self.dropped_count, self.torn_count))
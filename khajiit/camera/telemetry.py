@@ -0,0 +1,157 @@
+import logging
+import os
+from threading import Thread, Event
+from time import time
+
+import numpy as np
+
+from .grabber import Grabber, PanoramaGrabber
+from .managed_threading import ManagedThread, ThreadManager
+
+logger = logging.getLogger("telemetry")
+
+PERCENTILES = (50, 90)
+
+
+def percentiles(values):
+    """
+    Return percentiles and maximum of timings in milliseconds, None if there are no timings
+    """
+    if not values:
+        return None
+    values = np.array(values) * 1000
+    result = dict(("p%d" % p, round(float(np.percentile(values, p)), 2)) for p in PERCENTILES)
+    result["max"] = round(float(values.max()), 2)
+    return result
+
+
+class Telemetry(Thread):
+    """
+    Sample counters of the capture and processing threads once per interval
+    and publish a compact summary of them as JSON.
+
+    Rates are computed from counter differences between two samples rather than
+    the short timing windows of the threads, so they cover the whole interval.
+    Camera bandwidth is what the frames take on the USB bus, with the PS3 Eye
+    at 640x480 30 fps taking 18.4MB/s of the 35-40MB/s a USB 2.0 bus manages in practice.
+    """
+
+    def __init__(self, publisher=None, interval=1.0):
+        """
+        Keyword arguments:
+        publisher -- messenger.Publisher of Messages.string the summary is sent with, only kept if omitted
+        interval -- Time between samples (s)
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.publisher = publisher
+        self.interval = interval
+        self.sources = []
+        self.counters = {}  # Counters of the previous sample by source
+        self.cpu_time = None  # Process CPU time at the previous sample (s)
+        self.sampled = None  # Time of the previous sample
+        self.summary = None  # Latest summary
+        self.running = False
+        self.wake = Event()
+
+    def register(self, source):
+        """
+        Sample a PanoramaGrabber with its cameras, a single Grabber, a ManagedThread
+        or the threads of a ThreadManager along with their CPU usage and state
+        """
+        self.sources.append(source)
+
+    def rate(self, key, count, elapsed):
+        """
+        Return growth of the counter per second since the previous sample
+        """
+        previous = self.counters.get(key)
+        self.counters[key] = count
+        if previous is None or not elapsed:
+            return None
+        return round((count - previous) / elapsed, 2)
+
+    def sample_camera(self, grabber, elapsed, frame_bytes=None):
+        if frame_bytes is None:
+            frame = grabber.frame
+            frame_bytes = frame.nbytes if frame is not None else 0
+        fps = self.rate((grabber, "frames"), grabber.frame_count, elapsed)
+        return dict(
+            alive=grabber.alive,
+            fps=fps,
+            interval=percentiles(grabber.latencies),
+            bandwidth=round(fps * frame_bytes / 1e6, 2) if fps is not None else None,
+            frames=grabber.frame_count,
+            dropped=grabber.dropped_count,
+            copied=grabber.copied_count,
+            errors=grabber.error_count,
+            overwrites=grabber.overwrite_count,
+            down=round((time() - grabber.died) * 1000) if grabber.died is not None else None,
+            recovery=round(grabber.recovery_times[-1] * 1000) if grabber.recovery_times else None)
+
+    def sample_panorama(self, grabber, elapsed):
+        frame_bytes = int(np.prod(grabber.mode.sensor_shape))
+        cameras = dict((slave.name, self.sample_camera(slave, elapsed, frame_bytes)) for slave in grabber.slaves)
+        bandwidth = [camera["bandwidth"] for camera in cameras.values() if camera["bandwidth"] is not None]
+        panorama = dict(
+            fps=round(len(grabber.rate) / sum(grabber.rate), 2) if grabber.rate else None,
+            latency=percentiles(grabber.publish_latency),
+            spread=percentiles(grabber.spread),
+            overwrites=grabber.overwrite_count,
+            bandwidth=round(sum(bandwidth), 2) if bandwidth else None)
+        return panorama, cameras
+
+    def sample_thread(self, thread):
+        fps = len(thread.rate) / sum(thread.rate) if thread.rate else None
+        latency = sum(thread.latency) / len(thread.latency) if thread.latency else None
+        return dict(
+            alive=thread.alive,
+            fps=round(fps, 2) if fps else None,
+            latency=percentiles(thread.latency),
+            utilization=round(latency * fps * 100) if fps and latency else None,
+            overwrites=thread.overwrite_count)
+
+    def sample(self):
+        """
+        Return summary of every registered source since the previous sample
+        """
+        now = time()
+        elapsed = now - self.sampled if self.sampled else None
+        self.sampled = now
+        cpu_time = sum(os.times()[:2])
+        cpu = round((cpu_time - self.cpu_time) * 100 / elapsed) if elapsed and self.cpu_time is not None else None
+        self.cpu_time = cpu_time
+
+        summary = dict(time=round(now, 3), cpu=cpu, panorama=None, cameras={}, threads={})
+        for source in self.sources:
+            if isinstance(source, PanoramaGrabber):
+                summary["panorama"], cameras = self.sample_panorama(source, elapsed)
+                summary["cameras"].update(cameras)
+            elif isinstance(source, Grabber):
+                summary["cameras"][source.name] = self.sample_camera(source, elapsed)
+            elif isinstance(source, ManagedThread):
+                summary["threads"][source.__class__.__name__] = self.sample_thread(source)
+            elif isinstance(source, ThreadManager):
+                for thread in list(source.threads):
+                    name = source.names[thread]
+                    entry = self.sample_thread(thread)
+                    stats = source.stats.get(name, {})
+                    entry.update(state=stats.get("state"), cpu=stats.get("cpu"), cores=stats.get("cores"))
+                    summary["threads"][name] = entry
+        self.summary = summary
+        return summary
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            summary = self.sample()
+            if self.publisher:
+                try:
+                    self.publisher.command(**summary)
+                except Exception as e:
+                    logger.error("Publishing telemetry failed: %s", e)
+            self.wake.wait(max(self.interval - (time() - self.sampled), 0))
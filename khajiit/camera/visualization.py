@@ -6,8 +6,9 @@ from typing import Tuple, List, Optional
 import numpy as np
 import cv2 as cv
 
+from camera.geometry import CaptureMode, PanoramaGeometry
 from camera.image_recognition import ImageRecognition
-from shared import attach
+from shared import BundleRing, FrameRing, PANORAMA_CHANNEL, RECOGNIZER_CHANNEL
 from utils import RecognitionState
 
 logger = logging.getLogger('visualization')
@@ -29,7 +30,9 @@ class Visualizer:
     type_str = 'VIDEO'
 
     def __init__(self, camera_config):
-        self.kicker_offset = camera_config.get('global', {}).get('kicker offset', 0)
+        self.mode = CaptureMode.from_config(camera_config)
+        self.geometry = PanoramaGeometry.from_config(camera_config)
+        self.kicker_offset = self.geometry.kicker_offset
         self.recognition: Optional[RecognitionState] = None
         self.gamestate: dict = {}
         self.jpeg = None
@@ -40,18 +43,23 @@ class Visualizer:
         """
         Convert degrees from the kicker to panorama image x coordinate
         """
-        d = d % 360
-        if d > 180: d -= 360
-        return int(d * 3840 / 360) + self.kicker_offset
+        return self.geometry.deg_to_x(d)
 
     def run(self):
-        shared: np.ndarray = attach("shm://recognizer-color")
-        br_field_mask: np.ndarray = attach("shm://recognizer-field_mask")
-        br_balls_mask: np.ndarray = attach("shm://recognizer-balls_mask")
-        br_goal_blue_mask: np.ndarray = attach("shm://recognizer-goal_blue_mask")
-        br_goal_yellow_mask: np.ndarray = attach("shm://recognizer-goal_yellow_mask")
+        # Panoramas are read in place from the grabbers' ring, recognizer bundles frames of other sources
+        # with the masks, bundles of ring frames share the sequence number of the frame
+        while True:
+            try:
+                bundles = BundleRing(RECOGNIZER_CHANNEL)
+                break
+            except OSError:
+                sleep(1)  # Nothing recognized yet
+        ring = None if "color" in bundles.frames else FrameRing(PANORAMA_CHANNEL)
 
         const = ImageRecognition
+        lines, width = self.mode.lines, self.mode.panorama_width
+        balls_bottom = self.mode.column(const.BALLS_BOTTOM)
+        goal_field_dilation = self.mode.scale(const.GOAL_FIELD_DILATION)
 
         while True:
             sleep(0.015)
@@ -60,7 +68,22 @@ class Visualizer:
 
             rec = self.recognition
 
-            converted = np.swapaxes(cv.cvtColor(shared.reshape((4320, 640, 2)), cv.COLOR_YUV2BGR_YUYV), 0, 1)
+            # Masks and color of the recognized frame, newest bundle if it is gone already
+            seq = rec.seq if rec.seq is not None and bundles.valid(rec.seq) else bundles.latest()
+            bundle = bundles.get(seq) if seq >= 0 else None
+            if bundle is None:
+                continue
+            shared = ring.get(seq) if ring else bundle["color"]
+            if shared is None:
+                continue
+            br_field_mask = bundle["field_mask"]
+            br_balls_mask = bundle["balls_mask"]
+            br_goal_blue_mask = bundle["goal_blue_mask"]
+            br_goal_yellow_mask = bundle["goal_yellow_mask"]
+
+            converted = np.swapaxes(cv.cvtColor(shared.reshape((shared.shape[0], -1, 2)), cv.COLOR_YUV2BGR_YUYV), 0, 1)
+            if not (ring.valid(seq) if ring else bundles.valid(seq)):
+                continue  # Slot got reused while converting
             frame = converted.copy()  # This speeds up whole lot
 
             # Kicker offset
@@ -70,10 +93,10 @@ class Visualizer:
             # Visualize field edges
             points: List[Tuple[int, int]] = []
             for index, (y, x, h, w) in enumerate(rec.field_contours):
-                points.append((int(x + index * 480 + w / 2), 2 * y))
+                points.append((int(x + index * lines + w / 2), 2 * y))
 
             if points:
-                points = [(points[-1][0] - 3840, points[-1][1])] + points
+                points = [(points[-1][0] - width, points[-1][1])] + points
                 prev = None
                 for i, point in enumerate(points):
                     color = (128, 255, 128)
@@ -88,7 +111,7 @@ class Visualizer:
 
             # Visualize balls
             index = 0
-            prev = (self.kicker_offset, 640)
+            prev = (self.kicker_offset, frame.shape[0])
             for ball in rec.balls:
                 x, y = int(ball.vx), int(ball.vy)
 
@@ -119,7 +142,7 @@ class Visualizer:
 
             closest_ball: Optional[dict] = self.gamestate.get("closest_ball")
             if closest_ball:
-                prev = (self.kicker_offset, 640)
+                prev = (self.kicker_offset, frame.shape[0])
                 x, y = point = int(closest_ball.get('vx', 0)), int(closest_ball.get('vy', 0))
                 cv.circle(frame, point, closest_ball.get('radius', 8), (0, 255, 0), 8)
                 cv.line(frame, prev, point, (0, 255, 0), 4)
@@ -127,7 +150,7 @@ class Visualizer:
 
             # Visualize goals
             if rec.goal_yellow:
-                for delta in -3840, 0, 3840:
+                for delta in -width, 0, width:
                     x = self.deg_to_x(rec.goal_yellow.angle_deg) + delta
                     cv.line(frame, (x, 0), (x, const.GOAL_BOTTOM - 120), (255, 255, 255), 3)
                     cv.putText(frame, "%.1fdeg" % rec.goal_yellow.angle_deg, (x + 90, const.GOAL_BOTTOM + 120),
@@ -140,7 +163,7 @@ class Visualizer:
                     cv.rectangle(frame, (rect[0], rect[1]), (rect[2] + rect[0], rect[3] + rect[1]), (32, 32, 255), 8)
 
             if rec.goal_blue:
-                for delta in -3840, 0, 3840:
+                for delta in -width, 0, width:
                     x = self.deg_to_x(rec.goal_blue.angle_deg) + delta
                     cv.line(frame, (x, 0), (x, const.GOAL_BOTTOM - 120), (255, 255, 255), 3)
                     cv.putText(frame, "%.2fdeg" % rec.goal_blue.angle_deg, (x + 90, const.GOAL_BOTTOM + 120),
@@ -177,7 +200,7 @@ class Visualizer:
 
             # Visualize field mask
             field_mask = np.swapaxes(np.repeat(br_field_mask, 2, axis=1), 0, 1)
-            field_mask = np.hstack([field_mask, field_mask[:, :480]])
+            field_mask = np.hstack([field_mask, field_mask[:, :lines]])
 
             # logger.info(f"converted: {converted.shape} mask {field_mask.shape}")
 
@@ -187,9 +210,9 @@ class Visualizer:
                        (255, 255, 255), 2)
 
             # Visualize yellow mask
-            sliced = converted[:const.BALLS_BOTTOM * 2 - const.GOAL_FIELD_DILATION * 2, :]
+            sliced = converted[:balls_bottom * 2 - goal_field_dilation * 2, :]
             goal_yellow_mask = np.swapaxes(np.repeat(br_goal_yellow_mask, 2, axis=1), 0, 1)
-            goal_yellow_mask = np.hstack([goal_yellow_mask, goal_yellow_mask[:, :480]])
+            goal_yellow_mask = np.hstack([goal_yellow_mask, goal_yellow_mask[:, :lines]])
             # goal_yellow_cutout = cv.bitwise_and(sliced, sliced, mask=goal_yellow_mask)
             goal_yellow_cutout = cv.cvtColor(goal_yellow_mask, cv.COLOR_GRAY2BGR) * 255
             goal_yellow_cutout = cv.cvtColor(goal_yellow_mask, cv.COLOR_GRAY2BGR) * 255
@@ -199,9 +222,9 @@ class Visualizer:
                        cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
 
             # Visualize blue mask
-            sliced = converted[:const.BALLS_BOTTOM * 2 - const.GOAL_FIELD_DILATION * 2, :]
+            sliced = converted[:balls_bottom * 2 - goal_field_dilation * 2, :]
             goal_blue_mask = np.swapaxes(np.repeat(br_goal_blue_mask, 2, axis=1), 0, 1)
-            goal_blue_mask = np.hstack([goal_blue_mask, goal_blue_mask[:, :480]])
+            goal_blue_mask = np.hstack([goal_blue_mask, goal_blue_mask[:, :lines]])
             # goal_blue_cutout = cv.bitwise_and(sliced, sliced, mask=goal_blue_mask)
             goal_blue_cutout = cv.cvtColor(goal_blue_mask, cv.COLOR_GRAY2BGR) * 255
 
@@ -210,13 +233,16 @@ class Visualizer:
                        cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
 
             # Visualize orange balls
-            sliced = converted[:const.BALLS_BOTTOM * 2]
+            sliced = converted[:balls_bottom * 2]
             balls_mask = np.swapaxes(np.repeat(br_balls_mask, 2, axis=1), 0, 1)
             balls_cutout = cv.cvtColor(balls_mask, cv.COLOR_GRAY2BGR) * 255
 
             # cv.line(balls_cutout, (0, 0), (5000, 0), (255, 255, 255), 2)
             cv.putText(balls_cutout, "balls detection", (80, 50), cv.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
 
+            if not bundles.valid(seq):
+                continue  # Recognizer reused the slot while masks were drawn
+
             prev = None
             # for ball in rec.balls:
             #     cv.circle(balls_cutout, (int(ball.vx), int(ball.vy)), int(ball.radius), (255, 255, 255) if index else (0, 0, 255), 3)
@@ -1,5 +1,6 @@
 from math import isnan
 from time import time
+from typing import Optional
 
 import messenger
 from config_manager import ConfigManager, Settings
@@ -55,12 +56,15 @@ class GameplayNode(messenger.Node):
         self.config = ConfigManager.get_value('game')
         self.gameplay = Gameplay(self.config, Controller(), self.logger)
 
-        self.strategy_publisher = messenger.Publisher('/strategy', messenger.Messages.string)
+        self.strategy_publisher = messenger.Publisher(
+            '/strategy', messenger.Messages.binary, messenger.PACKET_STRATEGY, messenger.encode_strategy)
 
         self.settings_listener = messenger.Listener(
             '/settings_changed', messenger.Messages.string, callback=self.refresh_settings)
         self.recognition_listener = messenger.Listener(
-            '/recognition', messenger.Messages.string, callback=self.callback)
+            '/recognition', messenger.Messages.binary, callback=self.callback,
+            decoder=RecognitionState.from_message)
+        self.recognition_seq = 0  # Sequence number of the recognition the gameplay last stepped on
         self.command_listener = messenger.Listener(
             '/command', messenger.Messages.string, callback=self.command_callback)
         self.kicker_listener = messenger.Listener(
@@ -83,10 +87,8 @@ class GameplayNode(messenger.Node):
         self.config = ConfigManager.get_value('game')
         self.gameplay.config = Settings(self.config)
 
-    def get_recognition(self):
-        package = self.recognition_listener.package
-        if package:
-            return RecognitionState.from_dict(package)
+    def get_recognition(self) -> Optional[RecognitionState]:
+        return self.recognition_listener.package
 
     def kicker_callback(self, *_):
         package = self.kicker_listener.package
@@ -134,8 +136,9 @@ class GameplayNode(messenger.Node):
             self.gameplay.motors.apply()
 
     def callback(self, *_):
-        r_state = self.get_recognition()
-        if r_state:
+        seq, _, r_state = self.recognition_listener.latest
+        if r_state and seq != self.recognition_seq:
+            self.recognition_seq = seq
             self.gameplay.step(r_state)
 
             gp = self.gameplay
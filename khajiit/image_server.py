@@ -2,7 +2,7 @@ import cv2 as cv
 
 import messenger
 from config_manager import ConfigManager
-from shared import attach
+from shared import ImageReader
 from utils import RecognitionState
 
 listener_wrapper = messenger.CallbackListenerWrapper()
@@ -14,9 +14,9 @@ visualizer = None
 
 
 def recognition_callback(*args):
-    package = recognition_listener.package
-    if package and visualizer:
-        visualizer.recognition = RecognitionState.from_dict(package)
+    recognition = recognition_listener.package
+    if recognition and visualizer:
+        visualizer.recognition = recognition
 
 
 def strategy_callback(*args):
@@ -26,10 +26,10 @@ def strategy_callback(*args):
 
 
 recognition_listener = messenger.Listener(
-    '/recognition', messenger.Messages.string, callback=recognition_callback)
+    '/recognition', messenger.Messages.binary, callback=recognition_callback, decoder=RecognitionState.from_message)
 
 strategy_listener = messenger.Listener(
-    '/strategy', messenger.Messages.string, callback=strategy_callback)
+    '/strategy', messenger.Messages.binary, callback=strategy_callback)
 
 from gevent import monkey
 
@@ -62,10 +62,13 @@ def generator(type_str):
             yield b'\r\n\r\n'
 
 
-def realsense_generator(type_str):
-    image = attach("shm://depth-color")
+def realsense_generator():
+    reader = ImageReader("shm://depth-color")
     while True:
-        sleep(0.050)  # Fix this stupid thingie
+        received = reader.wait(1.0)
+        if received is None:
+            continue
+        sequence, timestamp, image = received
         try:
             ret, jpeg = cv.imencode('.jpg', image, (cv.IMWRITE_JPEG_QUALITY, 80))
             buf = jpeg.tostring()
@@ -8,6 +8,7 @@ import serial
 import messenger
 from config_manager import ConfigManager
 from serial_wrapper import find_serial
+from utils import RecognitionState
 
 
 class InjectorNode(messenger.Node):
@@ -18,13 +19,13 @@ class InjectorNode(messenger.Node):
         self.command_publisher = messenger.Publisher('/command', messenger.Messages.string)
 
         self.strategy_listener = messenger.Listener(
-            '/strategy', messenger.Messages.string)
+            '/strategy', messenger.Messages.binary)
         self.canbus_listener = messenger.Listener(
             '/canbus_message', messenger.Messages.string)
         self.settings_listener = messenger.Listener(
             '/settings_changed', messenger.Messages.string, callback=self.refresh_settings)
         self.recognition_listener = messenger.Listener(
-            '/recognition', messenger.Messages.string)
+            '/recognition', messenger.Messages.binary, decoder=RecognitionState.from_message)
 
         self.config = ConfigManager.get_value('game')
         self.mock = mock
@@ -105,7 +106,7 @@ class InjectorNode(messenger.Node):
             self.command_publisher.command(align_to_goal=dict(factor=1.0))
             canbus_package = self.canbus_listener.package or {}
             strategy_package = self.strategy_listener.package or {}
-            recognition_package = self.recognition_listener.package or {}
+            recognition = self.recognition_listener.package or RecognitionState()
 
             package_A = (
                 "{:<5}: {}".format('batt', canbus_package.get('voltage')),
@@ -120,8 +121,8 @@ class InjectorNode(messenger.Node):
 
             active_nodes = messenger.list()
             package_B = (
-                "{:<8}: {}".format('recog_fps', f"{round(recognition_package.get('fps') or 0)}fps"),
-                "{:<8}: {}".format('recog_lat', f"{round((recognition_package.get('lat') or 0) * 1000)}ms"),
+                "{:<8}: {}".format('recog_fps', f"{round(recognition.fps or 0)}fps"),
+                "{:<8}: {}".format('recog_lat', f"{round((recognition.lat or 0) * 1000)}ms"),
                 "{:<8}: {}".format('io_srv', '/io_server' in active_nodes),
                 "{:<8}: {}".format('img_srv', '/image_server' in active_nodes),
                 "{:<8}: {}".format('kicker', '/kicker_node' in active_nodes),
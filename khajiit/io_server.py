@@ -6,8 +6,9 @@ from websocket_log_handler import WebsocketLogHandler
 movement_publisher = messenger.Publisher('/movement', messenger.Messages.motion)
 kicker_publisher = messenger.Publisher('/kicker_speed', messenger.Messages.integer)
 command_publisher = messenger.Publisher('/command', messenger.Messages.string)
-strategy_state = messenger.Listener('/strategy', messenger.Messages.string)
+strategy_state = messenger.Listener('/strategy', messenger.Messages.binary)
 canbus_state = messenger.Listener('/canbus_message', messenger.Messages.string)
+telemetry_state = messenger.Listener('/telemetry', messenger.Messages.string)
 websocket_log_handler = WebsocketLogHandler()
 logging_state = messenger.Listener('/rosout_agg', messenger.Messages.logging, callback=websocket_log_handler.emit)
 node = messenger.Node('io_server', disable_signals=True)
@@ -22,7 +23,7 @@ monkey.patch_all(thread=False)
 import json
 from time import time
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, render_template, request, redirect, jsonify
 from flask_sockets import Sockets
 
 
@@ -56,6 +57,15 @@ def group():
 def logging_view():
     return render_template('logging.html')
 
+@app.route('/telemetry')
+def telemetry():
+    # Latest capture and recognition summary of octocamera, published once a second
+    package = telemetry_state.package
+    if package is None:
+        return jsonify(error="no telemetry received"), 503
+    return jsonify(dict(package, age=round(time() - telemetry_state.last_reading_time, 3)))
+
+
 # redirect to image server
 @app.route('/combined/<path:type_str>')
 def video_combined(type_str):
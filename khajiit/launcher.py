@@ -5,13 +5,6 @@ from typing import List
 from argparse import ArgumentParser
 
 import messenger
-from controller_node import ControllerNode
-from gameplay_node import GameplayNode
-from injector_node import InjectorNode
-from kicker_node import KickerNode
-from realsense_node import RealSenseNode
-from remoterf import RemoteRF
-from tfmini import TFMiniNode
 
 parser = ArgumentParser()
 parser.add_argument("-m", "--mock", dest="mock", action="store_true", default=False,
@@ -20,7 +13,20 @@ parser.add_argument("-n", "--nuke", dest="nuke", action="store_true", default=Fa
                     help="nuke ros on exit", )
 parser.add_argument("-r", "--remote", dest="remote", action="store_true", default=False,
                     help="listen to remote", )
+parser.add_argument("-t", "--transport", dest="transport", choices=("ros", "local"),
+                    default=messenger.TRANSPORT,
+                    help="topics over ROS or local sockets without roscore, see messenger.py --benchmark", )
 args = parser.parse_args()
+# Before the nodes are imported, some of them create publishers at import time
+messenger.set_transport(args.transport)
+
+from controller_node import ControllerNode
+from gameplay_node import GameplayNode
+from injector_node import InjectorNode
+from kicker_node import KickerNode
+from realsense_node import RealSenseNode
+from remoterf import RemoteRF
+from tfmini import TFMiniNode
 
 
 class Launcher:
@@ -97,7 +103,7 @@ def nuke_usb():
 
 class NukingWrapper(RestartWrapper):
     def __call__(self, *args, **kwargs):
-        # the node kills itself when the cameras fail so that we could restart it here :)
+        # cameras are reopened within the node, restart it here when it crashes nevertheless
         import subprocess
 
         def count_cameras():
@@ -133,7 +139,8 @@ if __name__ == '__main__':
     # plz  export ROSCONSOLE_FORMAT='[${severity}-${node}]: ${message}'
     launcer = Launcher()
 
-    launcer.launch(messenger.core)
+    if args.transport == "ros":
+        launcer.launch(messenger.core)
     launcer.launch(NukingWrapper(octocamera_node, silent=True))
     launcer.launch(image_server, silent=True)
     launcer.launch(RestartWrapper(RealSenseNode, mock=args.mock))
@@ -1,13 +1,22 @@
+import atexit
+import io
 import json
 import logging
+import math
+import os
+import signal
+import socket
+import struct
 from typing import Callable, Dict, Optional, List
 
+import numpy as np
 import rospy
 import rosnode
 from geometry_msgs.msg import Twist
-from std_msgs.msg import String, Int32, Float64
+from std_msgs.msg import String, Int32, Float64, UInt8MultiArray
 from rosgraph_msgs.msg import Log
 
+from threading import Condition, Event, Lock, Thread
 from time import time, sleep
 
 
@@ -69,7 +78,149 @@ class TwistWrapper:
         self.msg.angular.z = az
 
 
+class BinaryWrapper:
+    """
+    Packet of the binary wire format, see encode_packet()
+    """
+    message = UInt8MultiArray
+
+    def __init__(self, data=b"") -> None:
+        self.msg = self.message()
+        self.msg.data = data
+
+
+# Binary wire format: 4 byte header of magic, version and packet kind followed by the body of the kind.
+# JSON packets are the debug fallback, readable with any decoder version.
+WIRE_MAGIC = b"KH"
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct("<2sBB")
+PACKET_JSON, PACKET_RECOGNITION, PACKET_STRATEGY = range(3)
+# Publish JSON packets instead of binary ones for debugging, e.g. WIRE_FORMAT=json rosrun ...
+WIRE_JSON = os.environ.get("WIRE_FORMAT") == "json"
+
+
+def encode_packet(kind: int, body: bytes) -> bytes:
+    return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, kind) + body
+
+
+def encode_json(packet) -> bytes:
+    return encode_packet(PACKET_JSON, json.dumps(packet, separators=(',', ':')).encode())
+
+
+def decode_packet(data: bytes):
+    """
+    Return kind and body of the packet, raise ValueError for anything else
+    """
+    if len(data) < WIRE_HEADER.size:
+        raise ValueError("Packet of %d bytes is too short" % len(data))
+    magic, version, kind = WIRE_HEADER.unpack_from(data)
+    if magic != WIRE_MAGIC:
+        raise ValueError("Not a packet, magic %r" % magic)
+    if version != WIRE_VERSION and kind != PACKET_JSON:
+        raise ValueError("Packet version %d, expected %d" % (version, WIRE_VERSION))
+    return kind, memoryview(data)[WIRE_HEADER.size:]
+
+
+# Polar points (balls, goals) as packed records, x, y and degrees are derived on decoding
+POINT = np.dtype([('angle_rad', '<f8'), ('dist', '<f8'), ('radius', '<i4'), ('vx', '<i4'), ('vy', '<i4'),
+                  ('suspicious', 'u1')])
+# Identified balls of the strategy
+ID_BALL = np.dtype([('point', POINT), ('id', 'S36'), ('alive', '<f4')])
+
+
+def pack_points(points: List[dict]) -> bytes:
+    """
+    Pack serialized polar points into POINT records
+    """
+    return np.array([(p['angle_rad'], p['dist'], p.get('radius', 8), p.get('vx', 0), p.get('vy', 0),
+                      p.get('suspicious', False)) for p in points], dtype=POINT).tobytes()
+
+
+def point_dicts(records) -> List[dict]:
+    """
+    Return POINT records as serialized polar points
+    """
+    points = []
+    for angle_rad, dist, radius, vx, vy, suspicious in records.tolist():
+        points.append(dict(angle_rad=angle_rad, dist=dist, angle_deg=math.degrees(angle_rad),
+                           x=dist * math.cos(angle_rad), y=dist * math.sin(angle_rad),
+                           suspicious=bool(suspicious), radius=radius, vx=vx, vy=vy))
+    return points
+
+
+def optional(value, missing=math.nan):
+    return missing if value is None else value
+
+
+def present(value, missing=math.nan):
+    return None if value == missing or value != value else value  # NaN is not equal to itself
+
+
+STRATEGY_HEAD = struct.Struct("<?fffffBH")
+STRATEGY_STRINGS = ('goal', 'field', 'robot', 'state')
+
+
+def encode_strategy(packet: dict) -> bytes:
+    """
+    Encode strategy packet of the gameplay: numbers and flags, strings prefixed by length,
+    closest balls as POINT records and identified balls as ID_BALL records
+    """
+    balls = [packet.get('average_closest_ball'), packet.get('closest_ball')]
+    id_balls = packet.get('id_balls') or []
+    parts = [STRATEGY_HEAD.pack(
+        bool(packet.get('is_enabled')), optional(packet.get('target_goal_angle')), optional(packet.get('dist')),
+        optional(packet.get('angle')), optional(packet.get('pwm')), optional(packet.get('real_distance')),
+        sum(1 << i for i, ball in enumerate(balls) if ball), len(id_balls))]
+    for name in STRATEGY_STRINGS:
+        value = str(packet.get(name) or '').encode()[:255]
+        parts.append(struct.pack('<B', len(value)) + value)
+    parts.append(pack_points([ball for ball in balls if ball]))
+    records = np.zeros(len(id_balls), dtype=ID_BALL)
+    if id_balls:
+        records['point'] = np.frombuffer(pack_points(id_balls), dtype=POINT)
+        records['id'] = [ball.get('id', '') for ball in id_balls]
+        records['alive'] = [ball.get('alive', 0) for ball in id_balls]
+    parts.append(records.tobytes())
+    return b''.join(parts)
+
+
+def decode_strategy(body) -> dict:
+    is_enabled, target_goal_angle, dist, angle, pwm, real_distance, flags, count = STRATEGY_HEAD.unpack_from(body)
+    packet = dict(is_enabled=is_enabled, target_goal_angle=present(target_goal_angle), dist=present(dist),
+                  angle=present(angle), pwm=present(pwm), real_distance=present(real_distance))
+    offset = STRATEGY_HEAD.size
+    for name in STRATEGY_STRINGS:
+        length = body[offset]
+        packet[name] = bytes(body[offset + 1:offset + 1 + length]).decode()
+        offset += 1 + length
+    present_balls = [bit for bit in range(2) if flags & (1 << bit)]
+    points = iter(point_dicts(np.frombuffer(body, dtype=POINT, count=len(present_balls), offset=offset)))
+    offset += len(present_balls) * POINT.itemsize
+    balls = [next(points) if bit in present_balls else None for bit in range(2)]
+    packet['average_closest_ball'], packet['closest_ball'] = balls
+    records = np.frombuffer(body, dtype=ID_BALL, count=count, offset=offset)
+    packet['id_balls'] = [dict(id=ball_id.decode(), alive=alive, **point) for point, ball_id, alive in zip(
+        point_dicts(records['point']), records['id'].tolist(), records['alive'].tolist())]
+    return packet
+
+
+# Decoders of packet bodies by kind, others are registered by the modules defining the packets
+decoders = {PACKET_JSON: lambda body: json.loads(bytes(body)), PACKET_STRATEGY: decode_strategy}
+
+
+def register_decoder(kind: int, decoder: Callable) -> None:
+    decoders[kind] = decoder
+
+
+def decode(data: bytes):
+    kind, body = decode_packet(data)
+    if kind not in decoders:
+        raise ValueError("No decoder for packet kind %d" % kind)
+    return decoders[kind](body)
+
+
 class Messages:
+    binary = BinaryWrapper
     motion = TwistWrapper
     string = String
     integer = Int32
@@ -90,43 +241,264 @@ class LoggerWrapper:
     critical_throttle = rospy.logfatal_throttle
 
 
+def default_decoder(msg: Callable) -> Optional[Callable]:
+    """
+    Return decoder of message data for packages of the message type, None if it has no packages
+    """
+    if msg is Messages.binary:
+        return decode
+    if issubclass(msg, Messages.string):
+        return json.loads
+    return None
+
+
+# Transport of the topics: "ros" for rospy TCPROS through roscore,
+# "local" for Unix datagram sockets between the processes of this host without roscore
+TRANSPORT = os.environ.get("MESSENGER_TRANSPORT", "ros")
+LOCAL_DIRECTORY = os.environ.get("MESSENGER_DIRECTORY", "/tmp/khajiit-messenger")
+LOCAL_DATAGRAM = 1 << 18  # Largest message of the local transport (bytes)
+# Topics where only the newest message matters, subscribers skip the ones they fell behind on
+LATEST_TOPICS = {'/movement', '/kicker_speed', '/recognition', '/strategy', '/canbus_message', '/telemetry',
+                 '/distance/realsense', '/distance/tfmini'}
+
+local_shutdown = Event()
+local_hooks = []
+
+
+def set_transport(transport: str) -> None:
+    """
+    Select transport of the nodes created from now on, inherited by the processes started afterwards
+    """
+    global TRANSPORT
+    assert transport in ("ros", "local"), "Unknown transport %s" % transport
+    TRANSPORT = os.environ["MESSENGER_TRANSPORT"] = transport
+
+
+def topic_name(topic: str) -> str:
+    # Relative names resolve to the global namespace like they do for ROS nodes
+    return '/' + topic.strip('/')
+
+
+def queue_size(topic: str) -> int:
+    return 1 if topic_name(topic) in LATEST_TOPICS else 10
+
+
+def topic_directory(topic: str) -> str:
+    return os.path.join(LOCAL_DIRECTORY, 'topics', topic.strip('/').replace('/', '.'))
+
+
+def on_local_shutdown(hook: Callable) -> None:
+    """
+    rospy.on_shutdown of the local transport
+    """
+    local_hooks.append(hook)
+
+
+def local_signal_shutdown(*_) -> None:
+    """
+    Stop the nodes of the process and run the shutdown hooks once, on exit or when terminated.
+    Processes of multiprocessing don't run exit handlers, so termination runs them here.
+    """
+    if local_shutdown.is_set():
+        return
+    local_shutdown.set()
+    while local_hooks:
+        try:
+            local_hooks.pop(0)()
+        except SystemExit:
+            pass  # Hooks exit the node like they do on ROS
+
+
+class LocalPublisher:
+    """
+    Publisher of the local transport with the interface of rospy.Publisher.
+
+    Every subscriber binds a datagram socket in the directory of the topic, the serialized
+    message is sent to each of them. The directory is rescanned periodically to find new subscribers.
+    Latest value topics never block, the message is dropped for subscribers whose queue is full.
+    """
+    RESCAN = 0.5
+
+    def __init__(self, topic: str, message: Callable, queue_size: int = 10) -> None:
+        self.topic = topic
+        self.directory = topic_directory(topic)
+        os.makedirs(self.directory, exist_ok=True)
+        self.latest = queue_size == 1
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.settimeout(0.1)  # Queued topics wait for a busy subscriber, but not forever
+        self.lock = Lock()
+        self.subscribers = []
+        self.scanned = 0
+        self.dropped_count = 0
+
+    def scan(self):
+        self.subscribers = [entry.path for entry in os.scandir(self.directory)]
+        self.scanned = time()
+
+    def publish(self, msg):
+        buff = io.BytesIO()
+        msg.serialize(buff)
+        data = buff.getvalue()
+        with self.lock:
+            if time() - self.scanned > self.RESCAN:
+                self.scan()
+            for path in self.subscribers[:]:
+                try:
+                    self.socket.sendto(data, socket.MSG_DONTWAIT if self.latest else 0, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Subscriber exited without cleaning up
+                    self.subscribers.remove(path)
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                except (BlockingIOError, socket.timeout):
+                    self.dropped_count += 1
+
+    def unregister(self):
+        self.socket.close()
+
+
+class LocalSubscriber(Thread):
+    """
+    Subscriber of the local transport with the interface of rospy.Subscriber,
+    the callback is run in a thread of the subscriber like rospy does
+    """
+
+    def __init__(self, topic: str, message: Callable, callback: Callable, queue_size: int = 10) -> None:
+        Thread.__init__(self)
+        self.daemon = True
+        self.topic = topic
+        self.message = message
+        self.callback = callback
+        self.latest = queue_size == 1
+        directory = topic_directory(topic)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "%d-%x" % (os.getpid(), id(self)))
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.skipped_count = 0
+        on_local_shutdown(self.unregister)
+        atexit.register(local_signal_shutdown)
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                data = self.socket.recv(LOCAL_DATAGRAM)
+                if self.latest:
+                    # Skip to the newest of the messages queued meanwhile
+                    try:
+                        while True:
+                            data = self.socket.recv(LOCAL_DATAGRAM, socket.MSG_DONTWAIT)
+                            self.skipped_count += 1
+                    except BlockingIOError:
+                        pass
+            except OSError:
+                return  # Unregistered
+            msg = self.message()
+            msg.deserialize(data)
+            self.callback(msg)
+
+    def unregister(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.socket.close()
+
+
 class Listener:
-    def __init__(self, topic: str, msg: Callable, callback: Callable = None) -> None:
+    def __init__(self, topic: str, msg: Callable, callback: Callable = None, decoder: Callable = None) -> None:
+        """
+        Keyword arguments:
+        callback -- Called with the message as it arrives, its package is decoded on first access
+        decoder -- Decoder of the message data into package, JSON for Messages.string
+                   and registered packet decoders for Messages.binary if omitted
+        """
         self.topic = topic
         self.msg = msg
+        self.decoder = decoder or default_decoder(msg)
         self.last_reading = None
         self.last_reading_time = 0
+        self.seq = 0  # Number of messages received
+        self._package = None
+        self.decoded = 0  # Sequence number of the message the package was decoded from
+        self.condition = Condition()
         self.callback = callback
 
         msg = getattr(msg, 'message', msg)
-        self.subscriber = rospy.Subscriber(topic, msg, self.receive, queue_size=10)
+        subscriber = LocalSubscriber if TRANSPORT == "local" else rospy.Subscriber
+        self.subscriber = subscriber(topic, msg, self.receive, queue_size=queue_size(topic))
         self.logger = LoggerWrapper
 
     def receive(self, data):
-        self.last_reading = data
-        self.last_reading_time = time()
+        with self.condition:
+            self.last_reading = data
+            self.last_reading_time = time()
+            self.seq += 1
+            self.condition.notify_all()
         if self.callback:
             self.callback(data)
 
+    def _decode(self):
+        """
+        Return package of the latest message decoded on its first access, so plain text topics
+        of Messages.string read only through the callback are never parsed, call with the condition held
+        """
+        if self.decoded != self.seq:
+            self.decoded = self.seq
+            self._package = None
+            if self.decoder:
+                try:
+                    self._package = self.decoder(self.last_reading.data)
+                except Exception as e:
+                    rospy.logerr_throttle(0.5, f'Parse package failed:\n{e}\n{self.last_reading}')
+        return self._package
+
     @property
-    def package(self) -> Optional[Dict]:
-        if not self.last_reading or not issubclass(self.msg, Messages.string):
-            return None
-        try:
-            return json.loads(self.last_reading.data)
-        except Exception as e:
-            rospy.logerr_throttle(0.5, f'Parse package failed:\n{e}\n{self.last_reading}')
-            return None
+    def package(self):
+        """
+        Decoded package of the latest message, shared by every reader so it must not be modified
+        """
+        with self.condition:
+            return self._decode()
+
+    @property
+    def latest(self):
+        """
+        Return sequence number, receive time and package of the latest message
+        """
+        with self.condition:
+            return self.seq, self.last_reading_time, self._decode()
+
+    def wait_newer(self, seq: int, timeout: float = None):
+        """
+        Block until a message newer than seq is received,
+        return its sequence number and package or None on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > seq, timeout):
+                return None
+            return self.seq, self._decode()
 
 
 class Publisher:
-    def __init__(self, topic: str, msg: Callable) -> None:
+    def __init__(self, topic: str, msg: Callable, kind: int = PACKET_JSON, encoder: Callable = None) -> None:
+        """
+        Keyword arguments:
+        kind -- Packet kind of Messages.binary topics
+        encoder -- Encoder of packets on Messages.binary topics, JSON packets if omitted
+        """
         self.topic = topic
         self.msg = msg
+        self.kind = kind
+        self.encoder = encoder
         self.last_reading = None
         self.last_reading_time = 0
         msg = getattr(msg, 'message', msg)
-        self.publisher = rospy.Publisher(topic, msg, queue_size=10)
+        publisher = LocalPublisher if TRANSPORT == "local" else rospy.Publisher
+        self.publisher = publisher(topic, msg, queue_size=queue_size(topic))
         self.logger = LoggerWrapper
 
     def publish(self, *args, **kwargs):
@@ -135,18 +507,31 @@ class Publisher:
         self.publisher.publish(msg)
 
     def command(self, **commands):
-        assert self.msg == Messages.string, 'Commands available only on Messages.string mode'
+        if self.msg == Messages.binary:
+            # Binary packet, JSON one for debugging or if there is no encoder
+            if WIRE_JSON or not self.encoder:
+                self.publish(encode_json(commands))
+            else:
+                self.publish(encode_packet(self.kind, self.encoder(commands)))
+            return
+        assert self.msg == Messages.string, 'Commands available only on Messages.string and Messages.binary mode'
         command = json.dumps(commands, indent=1)
         self.publish(command)
 
 
 class Node:
     def __init__(self, name: str, disable_signals=True, existing_loggers=None, on_shutdown=None) -> None:
-        # TODO: disabled signals so that the damn rosnodes would die peacefully
-        self.node = rospy.init_node(name, anonymous=False, disable_signals=disable_signals)
         self.name = name
-        self.on_shutdown = rospy.on_shutdown
-        self.on_shutdown(on_shutdown or self.shutdown)
+        if TRANSPORT == "local":
+            self.node = None
+            self.on_shutdown = on_local_shutdown
+            self.on_shutdown(on_shutdown or self.shutdown)
+            self.register_local(disable_signals)
+        else:
+            # TODO: disabled signals so that the damn rosnodes would die peacefully
+            self.node = rospy.init_node(name, anonymous=False, disable_signals=disable_signals)
+            self.on_shutdown = rospy.on_shutdown
+            self.on_shutdown(on_shutdown or self.shutdown)
 
         self.logdebug = LoggerWrapper.debug
         self.logdebug_throttle = LoggerWrapper.debug_throttle
@@ -167,22 +552,46 @@ class Node:
         print("Node SHUTDOWN", self.name)
         exit(0)
 
+    def register_local(self, disable_signals):
+        """
+        Announce the node for list() and run the shutdown hooks on exit as there is no roscore
+        """
+        logging.basicConfig(level=logging.INFO, format="[%(levelname)s-" + self.name + "]: %(message)s")
+        directory = os.path.join(LOCAL_DIRECTORY, 'nodes')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, self.name), 'w') as f:
+            f.write(str(os.getpid()))
+        atexit.register(local_signal_shutdown)
+
+        def terminate(*_):
+            local_signal_shutdown()
+            exit(0)
+
+        # Terminated by the launcher
+        signal.signal(signal.SIGTERM, terminate)
+        if not disable_signals:
+            signal.signal(signal.SIGINT, terminate)
+
     @staticmethod
     def register_existing_loggers(*loggers):
         ConnectPythonLoggingToROS.reconnect(*loggers)
 
     def spin(self):
-        rospy.spin()
+        if TRANSPORT == "local":
+            while not local_shutdown.wait(1):
+                pass
+        else:
+            rospy.spin()
 
     def rate(self, hz):
-        self._rate = rospy.Rate(hz)
+        self._rate = LocalRate(hz) if TRANSPORT == "local" else rospy.Rate(hz)
 
     def sleep(self):
         self._rate and self._rate.sleep()
 
     @staticmethod
     def is_alive():
-        return not rospy.is_shutdown()
+        return is_running()
 
     def loop(self, hz=10):
         self.rate(hz)
@@ -195,9 +604,29 @@ class Node:
 
 
 def is_running():
+    if TRANSPORT == "local":
+        return not local_shutdown.is_set()
     return not rospy.is_shutdown()
 
 
+class LocalRate:
+    """
+    rospy.Rate of the local transport, keeps the period even if a step runs late
+    """
+
+    def __init__(self, hz):
+        self.period = 1.0 / hz
+        self.deadline = time() + self.period
+
+    def sleep(self):
+        delay = self.deadline - time()
+        if delay > 0:
+            sleep(delay)
+            self.deadline += self.period
+        else:
+            self.deadline = time() + self.period
+
+
 class Timer:
 
     def __init__(self, count: int, callback: Callable = None) -> None:
@@ -234,18 +663,90 @@ def test():
 
 
 def list() -> List[str]:
+    if TRANSPORT == "local":
+        return local_nodes()
     # no freaking api for getting alive nodes, greato!
     active_nodes = rosnode.get_node_names()
     active_nodes = [node for node in active_nodes if rosnode.rosnode_ping(node, max_count=1)]
     return active_nodes
 
 
+def local_nodes() -> List[str]:
+    directory = os.path.join(LOCAL_DIRECTORY, 'nodes')
+    active_nodes = []
+    for entry in os.scandir(directory) if os.path.isdir(directory) else []:
+        try:
+            with open(entry.path) as f:
+                os.kill(int(f.read()), 0)
+        except (OSError, ValueError):
+            continue
+        active_nodes.append('/' + entry.name)
+    return active_nodes
+
+
 def core():
     import os
     os.system('roscore')  # lives and dies with this process
 
 
+def echo():
+    node = Node("messenger_echo")
+    pong = Publisher("/benchmark/pong", Messages.binary)
+    Listener("/benchmark/ping", Messages.binary, callback=lambda msg: pong.publish(msg.data), decoder=bytes)
+    node.spin()
+
+
+def benchmark(count=2000, size=1000):
+    """
+    Measure latency of a message of size bytes between two processes over the selected transport,
+    half of the round trip to an echoing node. ROS transport requires a running roscore.
+    """
+    from multiprocessing import Process
+
+    process = Process(target=echo, daemon=True)
+    process.start()
+    node = Node("messenger_benchmark")
+    ping = Publisher("/benchmark/ping", Messages.binary)
+    pong = Listener("/benchmark/pong", Messages.binary, decoder=bytes)
+    payload = bytes(size)
+
+    # Until the publishers are connected or have found the subscribers
+    deadline = time() + 10
+    while pong.wait_newer(0, 0.1) is None and time() < deadline:
+        ping.publish(payload)
+    seq = pong.seq
+    latencies = []
+    for _ in range(count):
+        start = time()
+        ping.publish(payload)
+        reply = pong.wait_newer(seq, 1.0)
+        if reply is None:
+            continue
+        seq = reply[0]
+        latencies.append((time() - start) / 2)
+    process.terminate()
+
+    latencies = np.array(latencies) * 1e6
+    print("%s transport, %d byte messages, %d of %d received" % (TRANSPORT, size, len(latencies), count))
+    if len(latencies):
+        print("latency p50 %.0fus p90 %.0fus p99 %.0fus max %.0fus" % (
+            *np.percentile(latencies, (50, 90, 99)), latencies.max()))
+
+
 if __name__ == '__main__':
-    node = Node("messenger")
-    reader = Listener("/messenger", Messages.motion)
-    test()
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", help="measure latency between two nodes")
+    parser.add_argument("--transport", choices=("ros", "local"), default=TRANSPORT)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=1000, help="message size (bytes)")
+    args = parser.parse_args()
+    set_transport(args.transport)
+
+    if args.benchmark:
+        benchmark(args.count, args.size)
+    else:
+        node = Node("messenger")
+        reader = Listener("/messenger", Messages.motion)
+        test()
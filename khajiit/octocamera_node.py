@@ -3,8 +3,13 @@ from time import sleep
 import messenger
 from config_manager import ConfigManager
 
+from shared import FrameRing, PANORAMA_CHANNEL
 from camera.image_recognition import ImageRecognizer
+from camera.geometry import CaptureMode
 from camera.grabber import PanoramaGrabber
+from camera.recognition_farm import RecognitionFarm
+from camera.telemetry import Telemetry
+from utils import RecognitionState
 
 def kill():
     if grabber and grabber.slaves:
@@ -16,6 +21,8 @@ def kill():
         for camera in cameras:
             camera.die("rospy shutdown")
 
+    telemetry.stop()
+
     if manager and manager.threads:
         for t in manager.threads:
             try:
@@ -30,15 +37,29 @@ listener_wrapper = messenger.CallbackListenerWrapper()
 
 node = messenger.Node('octocamera', on_shutdown=kill)
 settings_change = messenger.Listener('/settings_changed', messenger.Messages.string, callback=listener_wrapper.update)
-recognition_publisher = messenger.Publisher('/recognition', messenger.Messages.string)
+recognition_publisher = messenger.Publisher(
+    '/recognition', messenger.Messages.binary, messenger.PACKET_RECOGNITION, RecognitionState.encode)
+telemetry_publisher = messenger.Publisher('/telemetry', messenger.Messages.string)
 
 logger = node.logger
 
 # Build pipeline
 config = ConfigManager.get_value('camera')
-grabber = PanoramaGrabber(config)
-image_recognizer = ImageRecognizer(
-    grabber, config_manager=ConfigManager, publisher=recognition_publisher)
+processes = config.get('global', {}).get('recognition processes', 0)
+# Slots for frames being recognized or visualized, the one queued and the one being grabbed
+ring = FrameRing(PANORAMA_CHANNEL, 2 * max(processes, 1) + 2, CaptureMode.from_config(config).panorama_shape,
+                 stamps=config.get('global', {}).get('cameras', 0))
+grabber = PanoramaGrabber(config, ring=ring)
+if processes:
+    image_recognizer = RecognitionFarm(
+        grabber, ring, processes, config_manager=ConfigManager, publisher=recognition_publisher)
+else:
+    image_recognizer = ImageRecognizer(
+        grabber, config_manager=ConfigManager, publisher=recognition_publisher, ring=ring)
+
+# Capture and recognition counters summarized for io_server
+telemetry = Telemetry(telemetry_publisher, config.get('global', {}).get('telemetry interval', 1))
+telemetry.register(grabber)
 
 # settings listeners
 listener_wrapper.listeners.append(image_recognizer.refresh_config)
@@ -47,11 +68,13 @@ manager = None  # type: ThreadManager
 
 
 def main(silent=False):
+    global manager
     if not silent:
-        messenger.ConnectPythonLoggingToROS.reconnect('image_recognition', 'visualization', 'threading', 'grabber')
+        messenger.ConnectPythonLoggingToROS.reconnect('image_recognition', 'visualization', 'threading', 'grabber',
+                                                      'recognition_farm', 'telemetry')
     else:
         image_recognizer.silent = True
-        messenger.ConnectPythonLoggingToROS.reconnect('grabber', 'image_recognition')
+        messenger.ConnectPythonLoggingToROS.reconnect('grabber', 'image_recognition', 'recognition_farm')
 
     # Quick'n'diry hacks
     image_recognizer.grabber = grabber
@@ -62,10 +85,12 @@ def main(silent=False):
 
     # Register threads for monitoring
     from camera.managed_threading import ThreadManager
-    manager = ThreadManager()
+    manager = ThreadManager(affinity=config.get('global', {}).get('affinity'))
     manager.register(grabber)
     manager.register(image_recognizer)
     manager.start()
+    telemetry.register(manager)
+    telemetry.start()
 
     # Enable some threads
     image_recognizer.enable()
@@ -6,7 +6,7 @@ from pyrealsense2.pyrealsense2 import STDepthTableControl, depth_sensor as Depth
 import numpy as np
 import cv2 as cv
 
-from shared import get_image_publisher
+from shared import ImagePublisher
 from utils import StreamingMovingAverage
 import os
 
@@ -100,8 +100,8 @@ class CaptureDistance:
 
     def broadcast(self, color: np.ndarray):
         if self.color is None:
-            self.color = get_image_publisher("shm://depth-color", color.shape, np.uint8)
-        self.color[:, :, :] = color
+            self.color = ImagePublisher("shm://depth-color", color.shape, np.uint8)
+        self.color.publish(color)
 
     def run(self):
         for is_running in self:
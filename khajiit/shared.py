@@ -1,9 +1,20 @@
+import os
+import socket
 from threading import Thread
 from time import time, sleep
 
 import SharedArray as sa
 import numpy as np
 
+# Panoramas assembled by the grabbers of octocamera
+PANORAMA_CHANNEL = "shm://octocamera-panorama"
+# Color frames and masks of the recognized frames
+RECOGNIZER_CHANNEL = "shm://recognizer-bundle"
+
+# Layout of the int64 header kept next to frames of an image channel
+HEADER_SEQUENCE, HEADER_TIMESTAMP, HEADER_PUBLISHER, HEADER_DTYPE, HEADER_NDIM, HEADER_SHAPE = range(6)
+HEADER_SIZE = 16
+
 
 def get_image_publisher(channel: str, shape: tuple, dtype) -> np.ndarray:
     # Create an array in shared memory.
@@ -15,7 +26,10 @@ def get_image_publisher(channel: str, shape: tuple, dtype) -> np.ndarray:
             return sa.attach(channel)
         sa.delete(short_name)
 
-    return sa.create(channel, shape, dtype)
+    try:
+        return sa.create(channel, shape, dtype)
+    except FileExistsError:
+        return sa.attach(channel)  # Another writer of the channel got to create it first
 
 
 def attach(channel: str) -> np.ndarray:
@@ -23,41 +37,350 @@ def attach(channel: str) -> np.ndarray:
     return frame
 
 
-class ImageSubscriber(Thread):
+class FrameRing:
     """
-    Spin-wait, could be replaced with pub-sub events
+    Fixed number of frame slots in shared memory written round robin by one process.
+    Sequence number of the frame in each slot is kept next to the frames
+    so that readers in other processes can tell if the slot got reused meanwhile,
+    optionally along with capture timestamps of the parts the frame was assembled from.
     """
 
-    def __init__(self, channel: str, callback: callable = None, sync_gain: float = 0.90, **kwargs) -> None:
-        Thread.__init__(self, **kwargs)
-        self.callback = callback
-        self.sync_gain = sync_gain
-        self.max_delay = 0.030
+    def __init__(self, channel: str, slots: int = None, shape: tuple = None, dtype=np.uint8, stamps: int = 0) -> None:
+        """
+        Create the ring when number of slots and frame shape are given, otherwise attach to existing one
+
+        stamps -- Number of capture timestamps kept per frame
+        """
         self.channel = channel
-        self.channel_reset_delay = 60
+        self.stamps = None
+        if slots:
+            self.frames = get_image_publisher(channel, (slots,) + tuple(shape), dtype)
+            self.sequences = get_image_publisher(channel + "-seq", (slots,), np.int64)
+            self.sequences[:] = -1
+            if stamps:
+                self.stamps = get_image_publisher(channel + "-stamps", (slots, stamps), np.float64)
+                self.stamps[:] = np.nan
+        else:
+            self.frames = attach(channel)
+            self.sequences = attach(channel + "-seq")
+            try:
+                self.stamps = attach(channel + "-stamps")
+            except OSError:
+                pass
+        self.slots = len(self.frames)
+        self.sequence = -1  # Last committed frame of the writer
 
-    def run(self) -> None:
-        frame: np.ndarray = sa.attach(self.channel)
-        old = frame.copy()
+    def claim(self) -> tuple:
+        """
+        Return sequence number and slot for the next frame, the slot is invalid until committed
+        """
+        seq = self.sequence + 1
+        index = seq % self.slots
+        self.sequences[index] = -1
+        return seq, self.frames[index]
 
-        start = time()
-        counter = 1
+    def commit(self, seq: int) -> None:
+        self.sequences[seq % self.slots] = seq
+        self.sequence = seq
+
+    def put(self, frame: np.ndarray) -> int:
+        seq, slot = self.claim()
+        slot[...] = frame
+        self.commit(seq)
+        return seq
+
+    def get(self, seq: int):
+        """
+        Return view of the frame or None if the slot already holds another frame
+        """
+        index = seq % self.slots
+        if self.sequences[index] != seq:
+            return None
+        return self.frames[index]
+
+    def latest(self) -> int:
+        """
+        Return sequence number of the newest committed frame, -1 if there is none
+        """
+        return int(self.sequences.max())
+
+    def valid(self, seq: int) -> bool:
+        """
+        Check whether frame returned by .get() was not overwritten meanwhile
+        """
+        return self.sequences[seq % self.slots] == seq
+
+    def skew(self, seq: int):
+        """
+        Return capture time of each part of the frame relative to the earliest one in milliseconds,
+        None for parts without a capture timestamp, or None if unknown or the slot was reused
+        """
+        if self.stamps is None or not self.valid(seq):
+            return None
+        stamps = self.stamps[seq % self.slots].copy()
+        if not self.valid(seq) or np.isnan(stamps).all():
+            return None
+        return [None if np.isnan(stamp) else round(stamp * 1000, 2) for stamp in (stamps - np.nanmin(stamps)).tolist()]
+
+
+class BundleRing:
+    """
+    Fixed number of slots in shared memory, each holding a bundle of frames that belong
+    together, such as a color frame and its masks. Every frame of the bundle lives in its own
+    array of slots, the sequence numbers of the slots act as seqlock: writer marks the slot
+    with -1 before writing and with the sequence number once the whole bundle is written,
+    reader checks the sequence number is unchanged after using the frames. Frames are
+    read in place as read-only views, the writer reuses a slot only after the others.
+
+    Bundles of a frame from a FrameRing are stored with the frame's sequence number
+    in a ring of as many slots, so writers in several processes recognizing different
+    frames of the ring do not collide as long as the frame ring does not.
+    """
+
+    def __init__(self, channel: str, slots: int = None, frames: dict = None) -> None:
+        """
+        Create the ring when number of slots and frames are given, otherwise attach to existing one
+
+        frames -- Shape and dtype of each frame of the bundle by name
+        """
+        self.channel = channel
+        self.frames = {}
+        prefix = channel.split("://")[-1] + "-"
+        existing = [e.name.decode()[len(prefix):] for e in sa.list() if e.name.decode().startswith(prefix)]
+        if slots:
+            for name, (shape, dtype) in frames.items():
+                self.frames[name] = get_image_publisher(channel + "-" + name, (slots,) + tuple(shape), dtype)
+            # Frames of the previous writer not in this bundle would show up in readers
+            for name in existing:
+                if name != "seq" and name not in frames:
+                    sa.delete(prefix + name)
+            self.sequences = get_image_publisher(channel + "-seq", (slots,), np.int64)
+            self.sequences[:] = -1
+        else:
+            for name in existing:
+                if name != "seq":
+                    self.frames[name] = attach(channel + "-" + name)
+            self.sequences = attach(channel + "-seq")
+        self.slots = len(self.sequences)
+        self.sequence = -1  # Last committed bundle of this writer
+
+    def claim(self, seq: int = None) -> tuple:
+        """
+        Return sequence number and writable frames of the slot for the next bundle,
+        or for the bundle of the given sequence number, the slot is invalid until committed
+        """
+        seq = self.sequence + 1 if seq is None else seq
+        index = seq % self.slots
+        self.sequences[index] = -1
+        return seq, dict((name, frames[index]) for name, frames in self.frames.items())
+
+    def commit(self, seq: int) -> None:
+        self.sequences[seq % self.slots] = seq
+        self.sequence = max(self.sequence, seq)
+
+    def put(self, seq: int = None, **frames) -> int:
+        seq, slot = self.claim(seq)
+        for name, frame in frames.items():
+            slot[name][...] = frame
+        self.commit(seq)
+        return seq
+
+    def get(self, seq: int):
+        """
+        Return read-only views of the frames of the bundle by name or None if the slot already holds another bundle
+        """
+        index = seq % self.slots
+        if self.sequences[index] != seq:
+            return None
+        bundle = {}
+        for name, frames in self.frames.items():
+            bundle[name] = frames[index].view()
+            bundle[name].flags.writeable = False
+        return bundle
+
+    def latest(self) -> int:
+        """
+        Return sequence number of the newest committed bundle, -1 if there is none
+        """
+        return int(self.sequences.max())
+
+    def valid(self, seq: int) -> bool:
+        """
+        Check whether bundle returned by .get() was not overwritten meanwhile
+        """
+        return self.sequences[seq % self.slots] == seq
+
+
+def notify_address(channel: str) -> str:
+    """
+    Return abstract Unix socket address subscribers of the channel register at
+    """
+    return "\0khajiit-" + channel.split("://")[-1]
 
+
+class ImagePublisher:
+    """
+    Image in shared memory with a header of sequence number, capture timestamp, shape and dtype
+    of the frame next to it. Subscribers register at the Unix datagram socket of the channel
+    and get the sequence number of every published frame, so they block on the socket instead
+    of polling the image. Python has no named semaphores and an eventfd can not be opened
+    by unrelated processes, datagrams fan out to any number of subscribers.
+    """
+
+    def __init__(self, channel: str, shape: tuple, dtype=np.uint8) -> None:
+        self.channel = channel
+        self.frame = get_image_publisher(channel, tuple(shape), dtype)
+        self.header = get_image_publisher(channel + "-header", (HEADER_SIZE,), np.int64)
+        self.sequence = -1
+        self.header[:] = 0
+        self.header[HEADER_SEQUENCE] = -1
+        # Tells subscribers whether their mapping belongs to the publisher notifying them
+        self.header[HEADER_PUBLISHER] = self.publisher = int.from_bytes(os.urandom(7), "little")
+        self.header[HEADER_DTYPE] = ord(self.frame.dtype.char)
+        self.header[HEADER_NDIM] = self.frame.ndim
+        self.header[HEADER_SHAPE:HEADER_SHAPE + self.frame.ndim] = self.frame.shape
+
+        self.subscribers = set()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(notify_address(channel))
+        self.socket.setblocking(False)
+
+    def publish(self, frame: np.ndarray = None, timestamp: float = None) -> int:
+        """
+        Copy the frame to shared memory unless it was written to .frame in place,
+        bump the sequence number and notify subscribers
+        """
+        if frame is not None:
+            self.frame[...] = frame
+        self.sequence += 1
+        self.header[HEADER_TIMESTAMP] = int((time() if timestamp is None else timestamp) * 1e9)
+        self.header[HEADER_SEQUENCE] = self.sequence
+
+        # Registrations since the last frame
         while True:
-            counter += 1
+            try:
+                _, address = self.socket.recvfrom(16)
+            except BlockingIOError:
+                break
+            self.subscribers.add(address)
+
+        message = np.array([self.publisher, self.sequence], dtype=np.int64).tobytes()
+        for address in list(self.subscribers):
+            try:
+                self.socket.sendto(message, address)
+            except BlockingIOError:
+                pass  # Subscriber has not read the previous notifications yet
+            except OSError:
+                self.subscribers.discard(address)  # Subscriber is gone
+        return self.sequence
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+class ImageReader:
+    """
+    Subscriber of an ImagePublisher channel, waits for notifications of new frames
+    and reads the frame in place
+    """
+
+    def __init__(self, channel: str, resubscribe: float = 1.0) -> None:
+        """
+        Keyword arguments:
+        resubscribe -- Time without frames after which the channel is attached and subscribed again,
+                       in case the publisher was restarted (s)
+        """
+        self.channel = channel
+        self.resubscribe = resubscribe
+        self.frame = None
+        self.header = None
+        self.sequence = -1  # Sequence number of the last frame returned
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind("")  # Autobind to a unique abstract address the publisher replies to
+
+    def subscribe(self) -> None:
+        try:
+            header = attach(self.channel + "-header")
+            frame = attach(self.channel)
+            self.socket.sendto(b"subscribe", notify_address(self.channel))
+        except OSError:
+            return  # Publisher not running yet
+        ndim = int(header[HEADER_NDIM])
+        if frame.dtype.char == chr(header[HEADER_DTYPE]) and \
+                frame.shape == tuple(header[HEADER_SHAPE:HEADER_SHAPE + ndim]):
+            self.header, self.frame = header, frame
+
+    def wait(self, timeout: float = None):
+        """
+        Block until a frame newer than the last one returned is published,
+        return its sequence number, capture timestamp and view of the frame in shared memory,
+        None if there was no new frame in timeout seconds
+        """
+        deadline = time() + timeout if timeout is not None else None
+        while deadline is None or time() < deadline:
+            if self.header is None:
+                self.subscribe()
+            wait = self.resubscribe if deadline is None else min(self.resubscribe, max(deadline - time(), 0))
+            self.socket.settimeout(wait)
+            try:
+                notified = self.socket.recv(16)
+            except socket.timeout:
+                self.header = None
+                continue
+            except OSError:
+                sleep(wait)
+                continue
+            # Skip notifications queued while the subscriber was busy
+            self.socket.setblocking(False)
+            while True:
+                try:
+                    notified = self.socket.recv(16)
+                except OSError:
+                    break
+            publisher, _ = np.frombuffer(notified, dtype=np.int64)
+            if self.header is None or self.header[HEADER_PUBLISHER] != publisher:
+                self.header = None  # Publisher restarted and may have recreated the channel
+                continue
+            sequence = int(self.header[HEADER_SEQUENCE])
+            if sequence != self.sequence:  # Sequence restarts along with the publisher
+                self.sequence = sequence
+                return sequence, self.header[HEADER_TIMESTAMP] / 1e9, self.frame
+        return None
+
+    def valid(self, sequence: int) -> bool:
+        """
+        Check whether the frame returned by .wait() was not overwritten meanwhile
+        """
+        return self.header is not None and self.header[HEADER_SEQUENCE] == sequence
 
-            if counter % self.channel_reset_delay == 0:
-                frame: np.ndarray = sa.attach(self.channel)
+    def close(self) -> None:
+        self.socket.close()
 
-            if not np.array_equal(old, frame):
-                old = frame.copy()
 
-                estimated_cap_delay = time() - start
-                self.callback and self.callback(old, estimated_cap_delay)
-                start = time()
-                sleep(min(self.max_delay, estimated_cap_delay * self.sync_gain))
-            else:
-                sleep(0.001)
+class ImageSubscriber(Thread):
+    """
+    Call back with a copy of every frame of an ImagePublisher channel and time since the previous one
+    """
+
+    def __init__(self, channel: str, callback: callable = None, **kwargs) -> None:
+        Thread.__init__(self, **kwargs)
+        self.callback = callback
+        self.channel = channel
+
+    def run(self) -> None:
+        reader = ImageReader(self.channel)
+        start = time()
+        while True:
+            received = reader.wait()
+            if received is None:
+                continue
+            sequence, timestamp, frame = received
+            frame = frame.copy()
+            if not reader.valid(sequence):
+                continue  # Publisher wrote the next frame while copying
+            now = time()
+            self.callback and self.callback(frame, now - start)
+            start = now
 
 
 if __name__ == '__main__':
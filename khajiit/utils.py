@@ -1,6 +1,9 @@
+import struct
+
 import numpy as np
 from typing import List, Optional, Dict, Tuple
 
+import messenger
 from camera.image_recognition import Point, PolarPoint
 
 try:
@@ -27,6 +30,11 @@ class StreamingMovingAverage:
 
 Centimeter = float
 
+# Packed recognition state: seq (-1 if none), fps, latency, goal angle adjust (NaN if none), goal heights (-1 if none),
+# present special points, counts of balls, field contours, goal rects and camera skews
+RECOGNITION_HEAD = struct.Struct("<qfffiiBHHBBB")
+SPECIAL_POINTS = ('goal_yellow', 'goal_blue', 'closest_edge')
+
 
 @dataclass
 class RecognitionState:
@@ -41,6 +49,10 @@ class RecognitionState:
     field_contours: List[Tuple[int, int, int, int]] = None
     goal_yellow_rect: List[Tuple[int, int, int, int]] = None
     goal_blue_rect: List[Tuple[int, int, int, int]] = None
+    seq: Optional[int] = None  # Panorama ring slot of the recognized frame
+    skew: Optional[List[Optional[float]]] = None  # Capture time of each camera relative to the earliest (ms)
+    fps: Optional[float] = None  # Recognition rate
+    lat: Optional[float] = None  # Recognition latency (s)
 
     @staticmethod  # for some reason type analysis didn't work for classmethod
     def from_dict(packet: dict) -> 'RecognitionState':
@@ -52,7 +64,113 @@ class RecognitionState:
         field_contours = packet.get('field_contours', [])
         goal_yellow_rect = packet.get('goal_yellow_rect', [])
         goal_blue_rect = packet.get('goal_blue_rect', [])
+        seq = packet.get('seq')
+        skew = packet.get('skew')
+        fps = packet.get('fps')
+        lat = packet.get('lat')
 
         return RecognitionState(
             balls, goal_yellow, goal_blue, closest_edge, angle_adjust, h_bigger, h_smaller,
-            field_contours, goal_yellow_rect, goal_blue_rect)
+            field_contours, goal_yellow_rect, goal_blue_rect, seq, skew, fps, lat)
+
+    @staticmethod
+    def from_package(package) -> 'RecognitionState':
+        """
+        Return state of a /recognition package, decoded already unless the JSON fallback is used
+        """
+        if isinstance(package, RecognitionState):
+            return package
+        return RecognitionState.from_dict(package)
+
+    @staticmethod
+    def from_message(data: bytes) -> 'RecognitionState':
+        """
+        Decoder of /recognition messages for messenger.Listener
+        """
+        return RecognitionState.from_package(messenger.decode(data))
+
+    @staticmethod
+    def encode(packet: dict) -> bytes:
+        """
+        Encode serialized recognition of ImageRecognizer: header followed by balls and special points
+        as messenger.POINT records, field contours and goal rects as int32 and camera skews as float32
+        """
+        angle_adjust, h_bigger, h_smaller = packet.get('goal_angle_adjust') or (None, None, None)
+        points = [packet.get(name) for name in SPECIAL_POINTS]
+        balls = packet.get('balls') or []
+        field_contours = packet.get('field_contours') or []
+        yellow_rect = packet.get('goal_yellow_rect') or []
+        blue_rect = packet.get('goal_blue_rect') or []
+        skew = packet.get('skew') or []
+        seq = packet.get('seq')
+        return b''.join((
+            RECOGNITION_HEAD.pack(
+                -1 if seq is None else seq, messenger.optional(packet.get('fps')),
+                messenger.optional(packet.get('lat')), messenger.optional(angle_adjust),
+                messenger.optional(h_bigger, -1), messenger.optional(h_smaller, -1),
+                sum(1 << i for i, point in enumerate(points) if point),
+                len(balls), len(field_contours), len(yellow_rect), len(blue_rect), len(skew)),
+            messenger.pack_points(balls + [point for point in points if point]),
+            np.array(field_contours, dtype='<i4').tobytes(),
+            np.array(yellow_rect, dtype='<i4').tobytes(),
+            np.array(blue_rect, dtype='<i4').tobytes(),
+            np.array([messenger.optional(s) for s in skew], dtype='<f4').tobytes()))
+
+    @staticmethod
+    def decode(body) -> 'RecognitionState':
+        seq, fps, lat, angle_adjust, h_bigger, h_smaller, flags, balls, contours, yellow, blue, cameras = \
+            RECOGNITION_HEAD.unpack_from(body)
+        offset = RECOGNITION_HEAD.size
+        present = [bit for bit in range(len(SPECIAL_POINTS)) if flags & (1 << bit)]
+        records = np.frombuffer(body, dtype=messenger.POINT, count=balls + len(present), offset=offset)
+        offset += records.nbytes
+        points = [PolarPoint(angle_rad, dist, bool(suspicious), radius, vx, vy)
+                  for angle_rad, dist, radius, vx, vy, suspicious in records.tolist()]
+        special = dict(zip(present, points[balls:]))
+
+        def rects(count):
+            nonlocal offset
+            array = np.frombuffer(body, dtype='<i4', count=count * 4, offset=offset)
+            offset += array.nbytes
+            return [tuple(rect) for rect in array.reshape(count, 4).tolist()]
+
+        field_contours, goal_yellow_rect, goal_blue_rect = rects(contours), rects(yellow), rects(blue)
+        skew = np.frombuffer(body, dtype='<f4', count=cameras, offset=offset).tolist()
+        return RecognitionState(
+            points[:balls], special.get(0), special.get(1), special.get(2), messenger.present(angle_adjust),
+            messenger.present(h_bigger, -1), messenger.present(h_smaller, -1), field_contours, goal_yellow_rect,
+            goal_blue_rect, None if seq < 0 else seq, [messenger.present(s) for s in skew] if cameras else None,
+            messenger.present(fps), messenger.present(lat))
+
+
+messenger.register_decoder(messenger.PACKET_RECOGNITION, RecognitionState.decode)
+
+
+if __name__ == '__main__':
+    # Compare the binary encoding of a busy recognition packet with the indented JSON published before
+    import json
+    import math
+    from timeit import timeit
+
+    balls = [PolarPoint(math.radians(i * 17 - 170), 0.3 + i * 0.2, i % 3 == 0, 6 + i, i, -i).serialize()
+             for i in range(20)]
+    packet = dict(
+        balls=balls, goal_yellow=balls[0], goal_blue=balls[1], closest_edge=balls[2],
+        goal_angle_adjust=[0.12, 84, 62], field_contours=[(10 * i, 0, 40, 320) for i in range(8)],
+        goal_yellow_rect=[(100, 20, 60, 30)], goal_blue_rect=[(2900, 22, 58, 31), (2980, 20, 12, 8)],
+        fps=58.2, lat=0.0213, seq=123456, skew=[0.0, 1.2, 3.4, None, 0.8, 2.1, 4.0, 0.3])
+    count = 2000
+
+    json_payload = json.dumps(packet, indent=1).encode()
+    binary_payload = messenger.encode_packet(messenger.PACKET_RECOGNITION, RecognitionState.encode(packet))
+    assert RecognitionState.from_package(messenger.decode(binary_payload)).balls[5].dist == balls[5]['dist']
+    print("%-8s %8s %12s %12s" % ("format", "bytes", "encode (us)", "decode (us)"))
+    print("%-8s %8d %12.1f %12.1f" % (
+        "json", len(json_payload),
+        timeit(lambda: json.dumps(packet, indent=1).encode(), number=count) * 1e6 / count,
+        timeit(lambda: RecognitionState.from_dict(json.loads(json_payload)), number=count) * 1e6 / count))
+    print("%-8s %8d %12.1f %12.1f" % (
+        "binary", len(binary_payload),
+        timeit(lambda: messenger.encode_packet(messenger.PACKET_RECOGNITION, RecognitionState.encode(packet)),
+               number=count) * 1e6 / count,
+        timeit(lambda: messenger.decode(binary_payload), number=count) * 1e6 / count))